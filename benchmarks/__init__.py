@@ -0,0 +1,8 @@
+""" Performance benchmarks of TargQC steps on synthetic data.
+
+    python -m benchmarks.run --scale medium -o results.json --baseline baseline.json
+
+Data is generated deterministically from a seed (see generators.py) and kept in the data
+directory between runs. Each benchmark runs in a forked process, so the reported peak memory
+belongs to that benchmark only.
+"""
@@ -0,0 +1,199 @@
+""" Deterministic synthetic inputs: target panels, BAMs, paired FastQ, sambamba depth outputs and cohorts
+    of per-sample region reports. Same parameters and seed always give the same files.
+"""
+import gzip
+import random
+import subprocess
+from os.path import join, isfile
+
+from targqc.utilz.file_utils import file_transaction, safe_mkdir
+from targqc.utilz.logger import info
+
+BASES = 'ACGT'
+DEFAULT_CHROM_LENGTHS = [('chr' + str(i), 250000000 - i * 8000000) for i in range(1, 23)] + \
+                        [('chrX', 155000000), ('chrY', 59000000)]
+
+
+def get_chrom_lengths(genome=None):
+    """ [(chrom, length)] of the genome, or of a synthetic genome of a human-like size
+    """
+    if genome:
+        from targqc.utilz import reference_data
+        return list(reference_data.get_chrom_lengths(genome))
+    return list(DEFAULT_CHROM_LENGTHS)
+
+
+def gen_regions(n_regions, chrom_lengths, seed=0, min_size=80, max_size=400):
+    """ Random non-sorted regions as (chrom, start, end), chromosomes picked proportionally to length
+    """
+    rnd = random.Random(seed)
+    total = sum(l for _, l in chrom_lengths)
+    regions = []
+    for _ in range(n_regions):
+        pos = rnd.randrange(total)
+        for chrom, length in chrom_lengths:
+            if pos < length:
+                break
+            pos -= length
+        size = rnd.randint(min_size, max_size)
+        start = max(0, min(pos, length - size))
+        regions.append((chrom, start, start + size))
+    return regions
+
+
+def sorted_regions(regions, chrom_lengths):
+    order = dict((c, i) for i, (c, _) in enumerate(chrom_lengths))
+    return sorted(regions, key=lambda r: (order[r[0]], r[1], r[2]))
+
+
+def make_panel_bed(output_fpath, n_regions, chrom_lengths, seed=0, with_genes=False, sort=False):
+    """ Panel of n_regions; 4th column with gene names when with_genes
+    """
+    if isfile(output_fpath):
+        return output_fpath
+    regions = gen_regions(n_regions, chrom_lengths, seed)
+    if sort:
+        regions = sorted_regions(regions, chrom_lengths)
+    with file_transaction(None, output_fpath) as tx:
+        with open(tx, 'w') as out:
+            for i, (chrom, start, end) in enumerate(regions):
+                fs = [chrom, str(start), str(end)]
+                if with_genes:
+                    fs.append('GENE' + str(i // 20))
+                out.write('\t'.join(fs) + '\n')
+    return output_fpath
+
+
+def _sam_read(rnd, name, flag, chrom, pos, read_len, mate_pos, tlen):
+    seq = ''.join(rnd.choice(BASES) for _ in range(read_len))
+    return '\t'.join([name, str(flag), chrom, str(pos + 1), '60', str(read_len) + 'M', '=', str(mate_pos + 1),
+                      str(tlen), seq, 'I' * read_len]) + '\n'
+
+
+def make_bam(output_fpath, regions, chrom_lengths, depth=None, num_pairs=None, read_len=100, insert_size=300,
+             on_target_rate=0.8, dup_rate=0.05, seed=0):
+    """ Coordinate-sorted indexed BAM of read pairs. The number of pairs is num_pairs, or enough
+        for the mean on-target depth; on_target_rate of fragments start in the regions.
+        Requires sambamba in PATH.
+    """
+    from targqc.utilz.sambamba import get_executable, index_bam
+    if isfile(output_fpath):
+        return output_fpath
+    rnd = random.Random(seed)
+    target_size = sum(e - s for _, s, e in regions)
+    if num_pairs is None:
+        num_pairs = int((depth or 30) * target_size / (2 * read_len * on_target_rate)) + 1
+    info('Generating ' + str(num_pairs) + ' read pairs for ' + output_fpath)
+
+    frags = []
+    for _ in range(num_pairs):
+        if regions and rnd.random() < on_target_rate:
+            chrom, start, end = regions[rnd.randrange(len(regions))]
+            pos = max(0, rnd.randint(start - insert_size // 2, end))
+        else:
+            chrom, length = chrom_lengths[rnd.randrange(len(chrom_lengths))]
+            pos = rnd.randrange(length - insert_size)
+        frags.append((chrom, pos))
+    for _ in range(int(num_pairs * dup_rate)):
+        frags[rnd.randrange(num_pairs)] = frags[rnd.randrange(num_pairs)]
+
+    reads = []
+    for i, (chrom, pos) in enumerate(frags):
+        mate_pos = pos + insert_size - read_len
+        reads.append((chrom, pos, i, 99, mate_pos, insert_size))
+        reads.append((chrom, mate_pos, i, 147, pos, -insert_size))
+    reads = _sort_reads(reads, chrom_lengths)
+
+    sam_fpath = output_fpath + '.sam'
+    with open(sam_fpath, 'w') as out:
+        out.write('@HD\tVN:1.4\tSO:coordinate\n')
+        for chrom, length in chrom_lengths:
+            out.write('@SQ\tSN:' + chrom + '\tLN:' + str(length) + '\n')
+        out.write('@RG\tID:bench\tSM:bench\n')
+        for chrom, pos, i, flag, mate_pos, tlen in reads:
+            out.write(_sam_read(rnd, 'r' + str(i), flag, chrom, pos, read_len, mate_pos, tlen))
+    with file_transaction(None, output_fpath) as tx:
+        subprocess.check_call([get_executable(), 'view', '-S', '-f', 'bam', '-o', tx, sam_fpath])
+    subprocess.check_call(['rm', sam_fpath])
+    index_bam(output_fpath)
+    return output_fpath
+
+
+def _sort_reads(reads, chrom_lengths):
+    order = dict((c, j) for j, (c, _) in enumerate(chrom_lengths))
+    return sorted(reads, key=lambda r: (order[r[0]], r[1]))
+
+
+def make_fastq_pair(l_fpath, r_fpath, num_pairs, read_len=100, seed=0):
+    """ Gzipped paired FastQ files with num_pairs random reads
+    """
+    if isfile(l_fpath) and isfile(r_fpath):
+        return l_fpath, r_fpath
+    rnd = random.Random(seed)
+    with file_transaction(None, [l_fpath, r_fpath]) as (tx_l, tx_r):
+        with gzip.open(tx_l, 'wt') as l_out, gzip.open(tx_r, 'wt') as r_out:
+            for i in range(num_pairs):
+                for out, mate in [(l_out, 1), (r_out, 2)]:
+                    seq = ''.join(rnd.choice(BASES) for _ in range(read_len))
+                    out.write('@r' + str(i) + '/' + str(mate) + '\n' + seq + '\n+\n' + 'I' * read_len + '\n')
+    return l_fpath, r_fpath
+
+
+def make_sambamba_depth_output(output_fpath, regions, depth_thresholds, sample_name='bench', seed=0):
+    """ Output of "sambamba depth region" for a BED annotated with ensembl.BedCols columns
+    """
+    if isfile(output_fpath):
+        return output_fpath
+    rnd = random.Random(seed)
+    header = ['# chrom', 'chromStart', 'chromEnd'] + ['F' + str(i) for i in range(3, 13)] + \
+             ['readCount', 'meanCoverage'] + ['percentage' + str(t) for t in depth_thresholds] + ['sampleName']
+    with file_transaction(None, output_fpath) as tx:
+        with open(tx, 'w') as out:
+            out.write('\t'.join(header) + '\n')
+            for i, (chrom, start, end) in enumerate(regions):
+                depth = rnd.expovariate(1.0 / 100)
+                pcts = [max(0.0, min(100.0, 100.0 * (1 - t / (2 * depth + 1)))) for t in depth_thresholds]
+                fs = [chrom, str(start), str(end), 'GENE' + str(i // 20), str(i % 20 + 1), '+', 'CDS',
+                      'protein_coding', 'ENST' + str(i // 20).zfill(11), '1', '100', '100', '100', '.',
+                      str(int(depth * (end - start) / 100)), '%.2f' % depth] + ['%.2f' % p for p in pcts] + [sample_name]
+                out.write('\t'.join(fs) + '\n')
+    return output_fpath
+
+
+def make_cohort(dirpath, n_samples, regions, depth_thresholds, seed=0):
+    """ targqc.main.Sample objects with synthetic regions.tsv reports, as made by _proc_sambamba_depth
+    """
+    from targqc.main import Sample
+    from targqc.region_coverage import _proc_sambamba_depth
+    samples = []
+    for i in range(n_samples):
+        name = 'sample' + str(i + 1)
+        s = Sample(name, safe_mkdir(join(dirpath, name)), work_dir=safe_mkdir(join(dirpath, 'work', name)))
+        depth_fpath = make_sambamba_depth_output(join(s.work_dir, 'sambamba_depth.txt'), regions,
+                                                 depth_thresholds, name, seed + i)
+        if not isfile(s.targqc_region_tsv):
+            _proc_sambamba_depth(depth_fpath, s.targqc_region_tsv, name, depth_thresholds)
+        samples.append(s)
+    return samples
+
+
+def make_sample_reports(dirpath, n_samples, depth_thresholds, seed=0):
+    """ Sample JSON summary reports with every metric of the TargQC header filled with random values.
+        Returns samples with targqc_json_fpath set.
+    """
+    from targqc.main import Sample
+    from targqc.general_report import get_header_metric_storage
+    from targqc.utilz.reporting.reporting import SampleReport
+    rnd = random.Random(seed)
+    samples = []
+    for i in range(n_samples):
+        name = 'sample' + str(i + 1)
+        s = Sample(name, safe_mkdir(join(dirpath, name)), work_dir=safe_mkdir(join(dirpath, 'work', name)))
+        if not isfile(s.targqc_json_fpath):
+            report = SampleReport(s, metric_storage=get_header_metric_storage(depth_thresholds))
+            for m in report.metric_storage.get_metrics():
+                value = rnd.random() if m.unit == '%' else rnd.randint(1, 10 ** 7)
+                report.add_record(m.name, value, silent=True)
+            report.save_json(s.targqc_json_fpath)
+        samples.append(s)
+    return samples
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+""" Runs the benchmarks and compares the results with a baseline.
+
+    python -m benchmarks.run [--scale small|medium|large] [--only sort_bed,annotate]
+                             [-o results.json] [--baseline baseline.json] [--tolerance 0.2]
+
+Exits with code 1 if any benchmark is slower or uses more memory than the baseline by more than the tolerance.
+"""
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from optparse import OptionParser
+from os.path import join, abspath, dirname
+
+from targqc.utilz.file_utils import safe_mkdir
+from targqc.utilz.logger import info, err
+
+from benchmarks import generators as gen
+
+TARGQC_SCRIPT = join(dirname(dirname(abspath(__file__))), 'scripts', 'targqc')
+DEPTH_THRESHOLDS = [1, 5, 10, 20, 50, 100, 250, 500, 1000, 5000, 10000, 50000]
+
+SCALES = OrderedDict([
+    ('small',  dict(n_regions=100,     sort_n_regions=10000,   num_pairs=10000,    fastq_pairs=10000,    n_samples=3)),
+    ('medium', dict(n_regions=100000,  sort_n_regions=200000,  num_pairs=1000000,  fastq_pairs=1000000,  n_samples=10)),
+    ('large',  dict(n_regions=2000000, sort_n_regions=2000000, num_pairs=10000000, fastq_pairs=10000000, n_samples=50)),
+])
+
+
+# Each benchmark is prepare(data_dir, scale) -> run(out_dir), where prepare generates (or reuses)
+# the inputs in the parent process, and run is timed in a forked child.
+
+def bench_sort_bed(data_dir, scale):
+    from targqc.utilz.bed_utils import sort_bed
+    bed_fpath = gen.make_panel_bed(join(data_dir, 'panel_unsorted_' + str(scale['sort_n_regions']) + '.bed'),
+                                   scale['sort_n_regions'], gen.get_chrom_lengths('hg19'), with_genes=True)
+    return lambda out_dir: sort_bed(bed_fpath, join(out_dir, 'sorted.bed'), work_dir=out_dir, genome='hg19')
+
+
+def bench_annotate(data_dir, scale):
+    from ensembl.bed_annotation import annotate
+    bed_fpath = gen.make_panel_bed(join(data_dir, 'panel_' + str(scale['n_regions']) + '.bed'),
+                                   scale['n_regions'], gen.get_chrom_lengths('hg19'), sort=True)
+    return lambda out_dir: annotate(bed_fpath, join(out_dir, 'annotated.bed'), out_dir, genome='hg19')
+
+
+def bench_proc_sambamba_depth(data_dir, scale):
+    from targqc.region_coverage import _proc_sambamba_depth
+    regions = gen.sorted_regions(gen.gen_regions(scale['n_regions'], gen.DEFAULT_CHROM_LENGTHS), gen.DEFAULT_CHROM_LENGTHS)
+    depth_fpath = gen.make_sambamba_depth_output(
+        join(data_dir, 'sambamba_depth_' + str(scale['n_regions']) + '.txt'), regions, DEPTH_THRESHOLDS)
+    return lambda out_dir: _proc_sambamba_depth(depth_fpath, join(out_dir, 'regions.tsv'), 'bench', DEPTH_THRESHOLDS)
+
+
+def bench_count_in_bam(data_dir, scale):
+    from targqc.utilz.sambamba import count_in_bam
+    chrom_lengths = gen.DEFAULT_CHROM_LENGTHS
+    regions = gen.sorted_regions(gen.gen_regions(scale['n_regions'], chrom_lengths), chrom_lengths)
+    bed_fpath = gen.make_panel_bed(join(data_dir, 'panel_sorted_synthetic_' + str(scale['n_regions']) + '.bed'),
+                                   scale['n_regions'], chrom_lengths, sort=True)
+    bam_fpath = gen.make_bam(join(data_dir, 'reads_' + str(scale['num_pairs']) + '.bam'),
+                             regions, chrom_lengths, num_pairs=scale['num_pairs'])
+    return lambda out_dir: count_in_bam(out_dir, bam_fpath, 'not unmapped', dedup=True, bed=bed_fpath)
+
+
+def bench_downsample(data_dir, scale):
+    from targqc.fastq import downsample
+    l_fpath, r_fpath = gen.make_fastq_pair(join(data_dir, 'reads_' + str(scale['fastq_pairs']) + '_R1.fq.gz'),
+                                           join(data_dir, 'reads_' + str(scale['fastq_pairs']) + '_R2.fq.gz'),
+                                           scale['fastq_pairs'])
+    return lambda out_dir: downsample(out_dir, 'bench', l_fpath, r_fpath, 0.05, num_pairs=scale['fastq_pairs'])
+
+
+def bench_combined_regional_reports(data_dir, scale):
+    from targqc.summarize import combined_regional_reports
+    regions = gen.sorted_regions(gen.gen_regions(scale['n_regions'], gen.DEFAULT_CHROM_LENGTHS), gen.DEFAULT_CHROM_LENGTHS)
+    samples = gen.make_cohort(join(data_dir, 'cohort_' + str(scale['n_samples']) + 'x' + str(scale['n_regions'])),
+                              scale['n_samples'], regions, DEPTH_THRESHOLDS)
+    return lambda out_dir: combined_regional_reports(out_dir, out_dir, samples)
+
+
+def bench_save_html(data_dir, scale):
+    from targqc.utilz.reporting.reporting import FullReport
+    samples = gen.make_sample_reports(join(data_dir, 'reports_' + str(scale['n_samples'])),
+                                      scale['n_samples'], DEPTH_THRESHOLDS)
+
+    def _run(out_dir):
+        full_report = FullReport.construct_from_sample_report_jsons(
+            samples, out_dir, dict((s.name, s.targqc_json_fpath) for s in samples), dict())
+        return full_report.save_html(join(out_dir, 'summary.html'), 'TargQC')
+    return _run
+
+
+def bench_cli_startup(data_dir, scale):
+    """ "targqc --help" in a new interpreter, which should not import the heavy modules.
+        The slowest imports reported by python -X importtime are logged.
+    """
+    def _run(out_dir):
+        p = subprocess.Popen([sys.executable, '-X', 'importtime', TARGQC_SCRIPT, '--help'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        _, stderr = p.communicate()
+        if p.returncode != 0:
+            raise RuntimeError('targqc --help failed: ' + stderr[-1000:])
+        for cumulative_us, module in slowest_imports(stderr):
+            info('  %8.1f ms  %s' % (cumulative_us / 1000.0, module))
+    return _run
+
+
+def slowest_imports(importtime_output, n=10):
+    """ [(cumulative microseconds, module)] of top-level imports in python -X importtime output, slowest first
+    """
+    imports = []
+    for l in importtime_output.splitlines():
+        fs = l.split('|')
+        if len(fs) == 3 and l.startswith('import time:') and fs[1].strip().isdigit():
+            module = fs[2].rstrip()
+            if not module.startswith('  '):  # nested imports are counted in the top-level cumulative time
+                imports.append((int(fs[1]), module.strip()))
+    return sorted(imports, reverse=True)[:n]
+
+
+BENCHMARKS = OrderedDict([
+    ('cli_startup',              bench_cli_startup),
+    ('sort_bed',                 bench_sort_bed),
+    ('annotate',                 bench_annotate),
+    ('proc_sambamba_depth',      bench_proc_sambamba_depth),
+    ('count_in_bam',             bench_count_in_bam),
+    ('downsample',               bench_downsample),
+    ('combined_regional_reports', bench_combined_regional_reports),
+    ('save_html',                bench_save_html),
+])
+
+
+def _measure_in_child(run_fn, out_dir):
+    """ Runs run_fn(out_dir) in a forked process. Returns dict(wall_s, user_s, sys_s, max_rss_mb, children_max_rss_mb)
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        res = dict()
+        try:
+            start = time.time()
+            run_fn(out_dir)
+            res['wall_s'] = time.time() - start
+            ru_self = resource.getrusage(resource.RUSAGE_SELF)
+            ru_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            res['user_s'] = ru_self.ru_utime + ru_children.ru_utime
+            res['sys_s'] = ru_self.ru_stime + ru_children.ru_stime
+            res['max_rss_mb'] = ru_self.ru_maxrss / 1024.0
+            res['children_max_rss_mb'] = ru_children.ru_maxrss / 1024.0
+        except Exception as e:
+            res['error'] = repr(e)
+        with os.fdopen(write_fd, 'w') as f:
+            json.dump(res, f)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(data) if data else dict(error='benchmark process died')
+
+
+def run_benchmarks(names, scale_name, data_dir, repeat=1):
+    scale = SCALES[scale_name]
+    results = OrderedDict()
+    for name in names:
+        info('Preparing ' + name + ' (' + scale_name + ')...')
+        run_fn = BENCHMARKS[name](safe_mkdir(join(data_dir, scale_name)), scale)
+        best = None
+        for _ in range(repeat):
+            out_dir = tempfile.mkdtemp(prefix='targqc_bench_' + name + '_')
+            try:
+                res = _measure_in_child(run_fn, out_dir)
+            finally:
+                shutil.rmtree(out_dir, ignore_errors=True)
+            if 'error' in res:
+                err(name + ' failed: ' + res['error'])
+                best = res
+                break
+            if best is None or res['wall_s'] < best['wall_s']:
+                best = res
+        results[name] = best
+        if 'error' not in best:
+            info('  %s: %.2fs wall, %.2fs cpu, %.0f MB RSS, %.0f MB RSS of subprocesses' % (
+                name, best['wall_s'], best['user_s'] + best['sys_s'], best['max_rss_mb'], best['children_max_rss_mb']))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Returns names of benchmarks that regressed in time or memory by more than tolerance
+    """
+    regressed = []
+    info()
+    info('%-28s %10s %10s %8s %10s %10s %8s' % ('Benchmark', 'Wall, s', 'Base, s', 'Ratio', 'RSS, MB', 'Base, MB', 'Ratio'))
+    for name, res in results.items():
+        base = baseline.get(name)
+        if not base or 'error' in res or 'error' in base:
+            continue
+        rss = max(res['max_rss_mb'], res['children_max_rss_mb'])
+        base_rss = max(base['max_rss_mb'], base['children_max_rss_mb'])
+        time_ratio = res['wall_s'] / base['wall_s'] if base['wall_s'] else 1.0
+        mem_ratio = rss / base_rss if base_rss else 1.0
+        flag = ''
+        if time_ratio > 1 + tolerance or mem_ratio > 1 + tolerance:
+            regressed.append(name)
+            flag = '  <- regression'
+        info('%-28s %10.2f %10.2f %8.2f %10.0f %10.0f %8.2f%s' % (
+            name, res['wall_s'], base['wall_s'], time_ratio, rss, base_rss, mem_ratio, flag))
+    return regressed
+
+
+def main():
+    parser = OptionParser(usage=__doc__.strip())
+    parser.add_option('--scale', dest='scale', choices=list(SCALES), default='small',
+                      help='Data size: ' + ', '.join(SCALES) + '. Default is small')
+    parser.add_option('--only', dest='only', help='Comma-separated benchmarks to run, out of: ' + ', '.join(BENCHMARKS))
+    parser.add_option('--data-dir', dest='data_dir', default=join(dirname(abspath(__file__)), 'data'),
+                      help='Where to keep generated inputs between runs')
+    parser.add_option('--repeat', dest='repeat', type='int', default=1, help='Take the best of N runs')
+    parser.add_option('-o', '--output', dest='output', help='Save results into this JSON file')
+    parser.add_option('--baseline', dest='baseline', help='JSON results of a previous run to compare with')
+    parser.add_option('--tolerance', dest='tolerance', type='float', default=0.2,
+                      help='Allowed relative increase of time and memory over the baseline. Default is 0.2')
+    opts, args = parser.parse_args()
+
+    names = opts.only.split(',') if opts.only else list(BENCHMARKS)
+    for n in names:
+        if n not in BENCHMARKS:
+            parser.error('Unknown benchmark ' + n)
+
+    results = run_benchmarks(names, opts.scale, safe_mkdir(opts.data_dir), opts.repeat)
+    data = OrderedDict([
+        ('scale', opts.scale),
+        ('python', platform.python_version()),
+        ('host', platform.node()),
+        ('date', time.strftime('%Y-%m-%d %H:%M:%S')),
+        ('results', results),
+    ])
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(data, f, indent=2)
+        info('Saved results to ' + opts.output)
+
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('scale') != opts.scale:
+            err('Baseline was run at scale ' + str(baseline.get('scale')) + ', not ' + opts.scale)
+            sys.exit(2)
+        regressed = compare(results, baseline['results'], opts.tolerance)
+        if regressed:
+            err('Regressions: ' + ', '.join(regressed))
+            sys.exit(1)
+    if any('error' in r for r in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@ from os.path import dirname, join, abspath, isfile, pardir
 from pybedtools import BedTool
 from targqc.utilz.file_utils import which, open_gzipsafe, verify_file
 from targqc.utilz.logger import debug, critical
+from ensembl import canonical
 
 SUPPORTED_GENOMES = ['GRCh37', 'hg19', 'hg19-noalt', 'hg38', 'hg38-noalt', 'mm10', 'hg19-chr21']
 
@@ -51,7 +52,10 @@ def check_genome(genome):
 #################
 ### INTERFACE ###
 #################
-def get_all_features(genome, high_confidence=False, features=None, gene_names=None, only_canonical=False):
+def get_all_features(genome, high_confidence=False, features=None, gene_names=None, only_canonical=False, chrom=None):
+    """ chrom: if set, only features on this chromosome (named as in the genome) are returned,
+               fetched through the tabix index when available
+    """
     _canon_filt = get_only_canonical_filter(genome) if only_canonical else None
 
     ori_genome = genome
@@ -59,6 +63,9 @@ def get_all_features(genome, high_confidence=False, features=None, gene_names=No
     genome = genome.replace('GRCh38', 'hg38')
 
     bed = _get_ensembl_file('ensembl.bed', genome)
+    if chrom:
+        bed = _select_chrom(bed, chrom if not ori_genome.startswith('GRCh') else
+                                 'chrM' if chrom == 'MT' else 'chr' + chrom)
     def _filter(x):
         if features:
             if x[BedCols.FEATURE] not in features:
@@ -86,6 +93,13 @@ def get_all_features(genome, high_confidence=False, features=None, gene_names=No
 
     return bed
 
+def _select_chrom(bed, chrom):
+    if isinstance(bed.fn, str) and isfile(bed.fn + '.tbi'):
+        if chrom not in bed.tabix_contigs():
+            return BedTool('', from_string=True)
+        return bed.tabix_intervals(chrom)
+    return bed.filter(lambda r: r.chrom == chrom)
+
 def get_merged_cds(genome):
     """
     Returns all CDS merged, used:
@@ -105,6 +119,15 @@ def get_merged_cds(genome):
 def ensembl_gtf_fpath(genome):
     return _get_ensembl_file(join('gtf', 'ref-transcripts.gtf'), genome.split('-')[0])  # no -alt
 
+def ensembl_bed_fpath(genome):
+    """ Path to the annotation BED behind get_all_features, without any filtering applied
+    """
+    genome = genome.replace('GRCh37', 'hg19').replace('GRCh38', 'hg38')
+    path = abspath(join(dirname(__file__), genome.split('-')[0], 'ensembl.bed'))
+    if not isfile(path) and isfile(path + '.gz'):
+        path += '.gz'
+    return path
+
 def biomart_fpath(genome='hg38'):
     """ bm_fpath downloaded from http://www.ensembl.org/biomart
 
@@ -171,7 +194,7 @@ def _get_ensembl_file(fname, genome=None):
 ###################
 ### TRANSCRIPTS ###
 ###################
-def get_canonical_transcripts_ids(genome):
+def get_canonical_fpaths(genome):
     short_genome = genome.split('-')[0]
     if short_genome.startswith('GRCh37'):
         short_genome = 'hg19'
@@ -184,6 +207,10 @@ def get_canonical_transcripts_ids(genome):
 
     canon_fpath = verify_file(canon_fpath, description='Canonical transcripts path')
     replacement_fpath = verify_file(replacement_fpath, description='Canonical cancer transcripts replacement path')
+    return canon_fpath, replacement_fpath
+
+def get_canonical_transcripts_ids(genome):
+    canon_fpath, replacement_fpath = get_canonical_fpaths(genome)
 
     if not canon_fpath:
         return None
@@ -196,6 +223,47 @@ def get_canonical_transcripts_ids(genome):
 
     return canon_tx_by_gname
 
+_canon_index_by_genome = dict()
+_canon_index_dirs = dict(cache_dir=None, work_dir=None)
+
+def set_canonical_index_dirs(cache_dir=None, work_dir=None):
+    """ Where get_canonical_index builds the index files: the shared cache_dir, or work_dir if caching is off
+    """
+    _canon_index_dirs['cache_dir'] = cache_dir
+    _canon_index_dirs['work_dir'] = work_dir
+
+def get_canonical_index(genome):
+    """ Memory-mapped canonical transcripts index (see ensembl.canonical), built once per genome
+        (see set_canonical_index_dirs) and opened once per process. Returns None if there is no canonical
+        transcripts file for the genome.
+    """
+    if genome not in _canon_index_by_genome:
+        from targqc.utilz.cache import content_hash
+        canon_fpath, replacement_fpath = get_canonical_fpaths(genome)
+        if not canon_fpath:
+            _canon_index_by_genome[genome] = None
+        else:
+            key = content_hash([f for f in [canon_fpath, replacement_fpath] if f], [canonical.VERSION])
+            index_fpath = canonical.build_index_file(lambda: get_canonical_transcripts_ids(genome),
+                                                     cache_dir=_canon_index_dirs['cache_dir'], key=key,
+                                                     work_dir=_canon_index_dirs['work_dir'])
+            _canon_index_by_genome[genome] = canonical.CanonicalIndex(index_fpath)
+    return _canon_index_by_genome[genome]
+
+def get_canonical_index_fpath(genome):
+    """ Path of the index of the genome, to be opened by worker processes with open_canonical_index
+    """
+    canon_index = get_canonical_index(genome) if genome else None
+    return canon_index.index_fpath if canon_index is not None else None
+
+def open_canonical_index(genome, index_fpath):
+    """ Makes get_canonical_index return the index at index_fpath, built by the parent process,
+        so that worker processes only open it
+    """
+    canon_index = _canon_index_by_genome.get(genome)
+    if canon_index is None or canon_index.index_fpath != index_fpath:
+        _canon_index_by_genome[genome] = canonical.CanonicalIndex(index_fpath) if index_fpath else None
+
 
 def _get(relative_path, genome=None):
     """
@@ -240,8 +308,8 @@ def high_confidence_filter(x):
     return x[BedCols.TSL] in ['1', '2', 'NA', '.', None]
 
 def get_only_canonical_filter(genome):
-    canon_tx_by_gname = get_canonical_transcripts_ids(genome)
-    return lambda x: x[BedCols.ENSEMBL_ID] == canon_tx_by_gname.get(x[BedCols.GENE])
+    canon_index = get_canonical_index(genome)
+    return lambda x: canon_index is not None and x[BedCols.ENSEMBL_ID] == canon_index.get(x[BedCols.GENE])
 
 def protein_coding_filter(x):
     return x[BedCols.BIOTYPE] == 'protein_coding'
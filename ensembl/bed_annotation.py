@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import ensembl as ebl
+import numpy as np
 import os
 import pybedtools
 import tempfile
@@ -51,12 +52,10 @@ canon_tx_by_gname = dict()
 
 def annotate(input_bed_fpath, output_fpath, work_dir, genome=None,
              reannotate=True, high_confidence=False, only_canonical=False,
-             coding_only=False, short=False, extended=False, is_debug=False, **kwargs):
-
-    debug('Getting features from storage')
-    features_bed = ebl.get_all_features(genome)
-    if features_bed is None:
-        critical('Genome ' + genome + ' is not supported. Supported: ' + ', '.join(ebl.SUPPORTED_GENOMES))
+             coding_only=False, short=False, extended=False, is_debug=False, threads=1, **kwargs):
+    """ threads: if more than 1, regions are annotated by chromosome in a pool of processes,
+                 each intersecting its own chromosome of the features; the output is the same
+    """
 
     if genome:
         fai_fpath = reference_data.get_fai(genome)
@@ -67,45 +66,110 @@ def annotate(input_bed_fpath, output_fpath, work_dir, genome=None,
 
     input_bed_fpath = sort_bed(input_bed_fpath, work_dir=work_dir, chr_order=chr_order, genome=genome)
 
-    ori_bed = BedTool(input_bed_fpath)
-    ori_col_num = ori_bed.field_count()
+    ori_col_num = BedTool(input_bed_fpath).field_count()
     reannotate = reannotate or ori_col_num == 3
     pybedtools.set_tempdir(safe_mkdir(join(work_dir, 'bedtools')))
-    ori_bed = BedTool(input_bed_fpath)
-        # if reannotate:
-        #     bed = BedTool(input_bed_fpath).cut([0, 1, 2])
-        #     keep_gene_column = False
-        # else:
-        #     if col_num > 4:
-        #         bed = BedTool(input_bed_fpath).cut([0, 1, 2, 3])
-        #     keep_gene_column = True
-
-    # features_bed = features_bed.saveas()
-    # cols = features_bed.field_count()
-    # if cols < 12:
-    #     features_bed = features_bed.each(lambda f: f + ['.']*(12-cols))
-    if high_confidence:
-        features_bed = features_bed.filter(ebl.high_confidence_filter)
-    if only_canonical:
-        features_bed = features_bed.filter(ebl.get_only_canonical_filter(genome))
-    if coding_only:
-        features_bed = features_bed.filter(ebl.protein_coding_filter)
-    # unique_tx_by_gene = find_best_tx_by_gene(features_bed)
+    shard_params = dict(genome=genome, chr_order=chr_order, fai_fpath=fai_fpath, ori_col_num=ori_col_num,
+                        reannotate=reannotate, high_confidence=high_confidence, only_canonical=only_canonical,
+                        coding_only=coding_only, is_debug=is_debug, **kwargs)
+    if threads > 1:
+        shards = _split_bed_by_chrom(input_bed_fpath, safe_mkdir(join(work_dir, 'shards')))
+        info('Annotating ' + str(len(shards)) + ' chromosomes in ' + str(threads) + ' processes')
+        from joblib import Parallel, delayed
+        canon_index_fpath = ebl.get_canonical_index_fpath(genome) if only_canonical else None
+        annotated_shards = Parallel(n_jobs=threads)(
+            delayed(_annotate_shard)(shard_fpath, safe_mkdir(join(work_dir, 'shards', chrom)), chrom=chrom,
+                                     canon_index_fpath=canon_index_fpath, **shard_params)
+            for chrom, shard_fpath in shards)
+        annotated = [fs for shard in annotated_shards for fs in shard]  # shards are in the order of the sorted input
+    else:
+        annotated = _annotate_shard(input_bed_fpath, work_dir, **shard_params)
+
+    return _write_annotated(annotated, output_fpath, work_dir, ori_col_num, reannotate,
+                            short=short, extended=extended)
+
+
+def annotate_batch(input_bed_fpaths, output_fpaths, work_dir, genome,
+                   reannotate=True, high_confidence=False, only_canonical=False,
+                   coding_only=False, short=False, extended=False, is_debug=False, threads=1, **kwargs):
+    """ Annotates several BED files with a single load of the features and a single intersect:
+        regions of all files are tagged with row ids and sorted into one BED, and the intersection
+        is split back by source file. Each output is the same as from annotate() on its input.
+        threads: if more than 1, the ambiguities of the files are resolved in a pool of processes
+    """
+    if not genome:
+        critical('Genome is required for batch annotation')
+    fai_fpath = reference_data.get_fai(genome)
+    chr_order = reference_data.get_chrom_order(genome)
+    pybedtools.set_tempdir(safe_mkdir(join(work_dir, 'bedtools')))
 
-    info('Extracting features from Ensembl GTF')
-    features_bed = features_bed.filter(lambda x:
-        x[ebl.BedCols.FEATURE] in ['exon', 'CDS', 'stop_codon', 'transcript'])
-        # x[ebl.BedCols.ENSEMBL_ID] == unique_tx_by_gene[x[ebl.BedCols.GENE]])
+    col_nums = []
+    src_and_extra_by_row_id = []  # row id -> (index of the input, extra columns of the region)
+    regions = []
+    for src_i, input_bed_fpath in enumerate(input_bed_fpaths):
+        input_bed_fpath = sort_bed(input_bed_fpath, work_dir=safe_mkdir(join(work_dir, 'batch_' + str(src_i))),
+                                   chr_order=chr_order, genome=genome)
+        ori_col_num = BedTool(input_bed_fpath).field_count()
+        col_nums.append(ori_col_num)
+        with open(input_bed_fpath) as f:
+            for l in f:
+                if not l.strip() or l.startswith('#'):
+                    continue
+                fs = l.rstrip('\n').split('\t')
+                row_id = len(src_and_extra_by_row_id)  # assigned after sorting, so row ids keep the order of each input
+                src_and_extra_by_row_id.append((src_i, fs[3:ori_col_num]))
+                regions.append((chr_order.get(fs[0], -1), int(fs[1]), int(fs[2]), row_id, fs[0]))
+    regions.sort()
+
+    combined_bed_fpath = join(work_dir, 'batch_regions.bed')
+    with file_transaction(work_dir, combined_bed_fpath) as tx:
+        with open(tx, 'w') as out:
+            for _, start, end, row_id, chrom in regions:
+                out.write('\t'.join([chrom, str(start), str(end), str(row_id)]) + '\n')
+    del regions
+    info('Annotating ' + str(len(src_and_extra_by_row_id)) + ' regions from ' + str(len(input_bed_fpaths)) + ' BED files')
 
+    features_bed = _get_features(genome, high_confidence=high_confidence, only_canonical=only_canonical,
+                                 coding_only=coding_only)
     info('Overlapping regions with Ensembl data')
-    if is_debug:
-        ori_bed = ori_bed.saveas(join(work_dir, 'bed.bed'))
-        debug(f'Saved regions to {ori_bed.fn}')
-        features_bed = features_bed.saveas(join(work_dir, 'features.bed'))
-        debug(f'Saved features to {features_bed.fn}')
-    annotated = _annotate(ori_bed, features_bed, chr_order, fai_fpath, work_dir, ori_col_num,
-                          high_confidence=False, reannotate=reannotate, is_debug=is_debug, **kwargs)
+    intersection_bed = _intersect(BedTool(combined_bed_fpath), features_bed, fai_fpath, work_dir,
+                                  is_debug=is_debug, intersection_fname='batch_intersection.bed')
+
+    rows_by_src = [[] for _ in input_bed_fpaths]
+    for intersection_fields in intersection_bed:
+        fs = list(intersection_fields)
+        src_i, extra_columns = src_and_extra_by_row_id[int(fs[3])]
+        rows_by_src[src_i].append(fs[:3] + extra_columns + fs[4:])
+
+    src_params = [dict(input_bed_fpath=input_bed_fpaths[src_i], output_fpath=output_fpath,
+                       ori_col_num=col_nums[src_i], reannotate=reannotate or col_nums[src_i] == 3)
+                  for src_i, output_fpath in enumerate(output_fpaths)]
+    write_params = dict(work_dir=work_dir, genome=genome, chr_order=chr_order, short=short, extended=extended, **kwargs)
+    if threads > 1:
+        info('Resolving ambiguities for ' + str(len(output_fpaths)) + ' BED files in ' + str(threads) + ' processes')
+        from joblib import Parallel, delayed
+        Parallel(n_jobs=threads)(
+            delayed(_resolve_and_write)(rows, **dict(params, **write_params))
+            for rows, params in zip(rows_by_src, src_params))
+    else:
+        for params in src_params:
+            _resolve_and_write(rows_by_src.pop(0), **dict(params, **write_params))  # rows are freed once collected
+    return output_fpaths
+
+
+def _resolve_and_write(rows, input_bed_fpath, output_fpath, work_dir, genome, chr_order, ori_col_num, reannotate,
+                       short=False, extended=False, **kwargs):
+    """ Resolves the overlaps of one input of annotate_batch and writes its output
+    """
+    info('Resolving ambiguities for ' + input_bed_fpath)
+    overlaps_by_tx_by_gene_by_loc = _collect_overlaps(rows, ori_col_num, reannotate)
+    del rows
+    annotated = _resolve_ambiguities(overlaps_by_tx_by_gene_by_loc, chr_order, **kwargs)
+    return _write_annotated(annotated, output_fpath, work_dir, ori_col_num, reannotate,
+                            short=short, extended=extended)
+
 
+def _write_annotated(annotated, output_fpath, work_dir, ori_col_num, reannotate, short=False, extended=False):
     full_header = [ebl.BedCols.names[i] for i in ebl.BedCols.cols]
     add_ori_extra_fields = ori_col_num > 3
     if not reannotate and ori_col_num == 4:
@@ -147,6 +211,85 @@ def annotate(input_bed_fpath, output_fpath, work_dir, genome=None,
     return output_fpath
 
 
+def _split_bed_by_chrom(bed_fpath, shards_dir):
+    """ Splits a sorted BED file into one file per chromosome. Returns [(chrom, fpath)] in the order of the input
+    """
+    shards = []
+    out = None
+    with open(bed_fpath) as f:
+        for l in f:
+            if not l.strip() or l.startswith('#'):
+                continue
+            chrom = l.split('\t', 1)[0]
+            if not shards or shards[-1][0] != chrom:
+                if out:
+                    out.close()
+                shards.append((chrom, join(shards_dir, chrom + '.bed')))
+                out = open(shards[-1][1], 'w')
+            out.write(l)
+    if out:
+        out.close()
+    return shards
+
+
+def _annotate_shard(bed_fpath, work_dir, genome, chr_order, fai_fpath, ori_col_num, reannotate,
+                    high_confidence=False, only_canonical=False, coding_only=False, is_debug=False, chrom=None,
+                    canon_index_fpath=None, **kwargs):
+    """ Intersects regions with the features (of one chromosome if chrom is set) and resolves the overlaps.
+        Returns the list of annotated regions.
+    """
+    if canon_index_fpath:  # in case of a fresh worker process: open the parent's index instead of building one
+        ebl.open_canonical_index(genome, canon_index_fpath)
+    pybedtools.set_tempdir(safe_mkdir(join(work_dir, 'bedtools')))
+    features_bed = _get_features(genome, high_confidence=high_confidence, only_canonical=only_canonical,
+                                 coding_only=coding_only, chrom=chrom)
+
+    ori_bed = BedTool(bed_fpath)
+    info('Overlapping regions with Ensembl data')
+    if is_debug:
+        ori_bed = ori_bed.saveas(join(work_dir, 'bed.bed'))
+        debug(f'Saved regions to {ori_bed.fn}')
+        features_bed = features_bed.saveas(join(work_dir, 'features.bed'))
+        debug(f'Saved features to {features_bed.fn}')
+    return _annotate(ori_bed, features_bed, chr_order, fai_fpath, work_dir, ori_col_num,
+                     high_confidence=False, reannotate=reannotate, is_debug=is_debug, **kwargs)
+
+
+def _get_features(genome, high_confidence=False, only_canonical=False, coding_only=False, chrom=None):
+    """ Ensembl features used to annotate: transcripts, exons, CDS and stop codons, filtered as requested
+    """
+    debug('Getting features from storage')
+    features_bed = ebl.get_all_features(genome, chrom=chrom)
+    if features_bed is None:
+        critical('Genome ' + genome + ' is not supported. Supported: ' + ', '.join(ebl.SUPPORTED_GENOMES))
+
+    # if reannotate:
+    #     bed = BedTool(input_bed_fpath).cut([0, 1, 2])
+    #     keep_gene_column = False
+    # else:
+    #     if col_num > 4:
+    #         bed = BedTool(input_bed_fpath).cut([0, 1, 2, 3])
+    #     keep_gene_column = True
+
+    # features_bed = features_bed.saveas()
+    # cols = features_bed.field_count()
+    # if cols < 12:
+    #     features_bed = features_bed.each(lambda f: f + ['.']*(12-cols))
+    if high_confidence:
+        features_bed = features_bed.filter(ebl.high_confidence_filter)
+    if only_canonical:
+        features_bed = features_bed.filter(ebl.get_only_canonical_filter(genome))
+    if coding_only:
+        features_bed = features_bed.filter(ebl.protein_coding_filter)
+    # unique_tx_by_gene = find_best_tx_by_gene(features_bed)
+
+    info('Extracting features from Ensembl GTF')
+    features_bed = features_bed.filter(lambda x:
+        x[ebl.BedCols.FEATURE] in ['exon', 'CDS', 'stop_codon', 'transcript'])
+        # x[ebl.BedCols.ENSEMBL_ID] == unique_tx_by_gene[x[ebl.BedCols.GENE]])
+    return features_bed
+
+
 class Region(SortableByChrom):
     def __init__(self, chrom, start, end, ref_chrom_order, gene_symbol=None, exon=None,
                  strand=None, other_fields=None):
@@ -204,35 +347,51 @@ def _format_field(value):
 #     return unique_tx_by_gene
 
 
+_BIOTYPE_RANK = ['protein_coding', 'rna', 'decay', 'sense_', 'antisense', '__default__', 'translated_', 'transcribed_']
+_TSL_RANK = {'1': 0, '2': 2, '3': 3, '4': 4, '5': 5}
+_OVERLAP_COLS = [ebl.BedCols.TX_OVERLAP_PERCENTAGE,
+                 ebl.BedCols.EXON_OVERLAPS_PERCENTAGE,
+                 ebl.BedCols.CDS_OVERLAPS_PERCENTAGE]
+
+_tx_ranks_by_key = dict()
+
+
+def _tx_ranks(x):
+    """ (biotype_key, tsl_key, canon_tx_key) of a transcript, computed once per transcript
+    """
+    key = x[ebl.BedCols.ENSEMBL_ID], x[ebl.BedCols.GENE], x[ebl.BedCols.BIOTYPE], x[ebl.BedCols.TSL]
+    ranks = _tx_ranks_by_key.get(key)
+    if ranks is None:
+        ens_id, gene, biotype, tsl = key
+        biotype = biotype.lower()
+        biotype_key = next((i for i, bt in enumerate(_BIOTYPE_RANK) if bt in biotype),
+                           _BIOTYPE_RANK.index('__default__'))
+        tsl_key = _TSL_RANK.get(tsl, 1)
+        canon_tx_key = 0 if ens_id == canon_tx_by_gname.get(gene) else 1
+        ranks = _tx_ranks_by_key[key] = biotype_key, tsl_key, canon_tx_key
+    return ranks
+
+
 def tx_priority_sort_key(x):
-    # overlaps_cds_key = 0
-    # ind = x[ebl.BedCols.CDS_OVERLAPS_PERCENTAGE]
-    # if len(x) > ind and x[ind] and x[ind] > 0:
-    #     overlaps_cds_key = 1
-
-    overlap_key = tuple([(-x[ind] if len(x) > ind and x[ind] is not None else 0)
-       for ind in [ebl.BedCols.TX_OVERLAP_PERCENTAGE,
-                   ebl.BedCols.EXON_OVERLAPS_PERCENTAGE,
-                   ebl.BedCols.CDS_OVERLAPS_PERCENTAGE]])
-    
-    biotype_rank = ['protein_coding', 'rna', 'decay', 'sense_', 'antisense', '__default__', 'translated_', 'transcribed_']
-    biotype = '__default__'
-    for bt in biotype_rank:
-        if bt in x[ebl.BedCols.BIOTYPE].lower():
-            biotype = bt
-            break
-    biotype_key = biotype_rank.index(biotype)
-
-    tsl_key = {'1': 0, '2': 2, '3': 3, '4': 4, '5': 5}.get(x[ebl.BedCols.TSL], 1)
-
-    is_canon = x[ebl.BedCols.ENSEMBL_ID] == canon_tx_by_gname.get(x[ebl.BedCols.GENE])
-    canon_tx_key = 0 if is_canon else 1
-    
+    overlap_key = tuple([(-x[ind] if len(x) > ind and x[ind] is not None else 0) for ind in _OVERLAP_COLS])
+    biotype_key, tsl_key, canon_tx_key = _tx_ranks(x)
     length_key = -(int(x[ebl.BedCols.END]) - int(x[ebl.BedCols.START]))
-
     return overlap_key, biotype_key, tsl_key, canon_tx_key, length_key
 
 
+def _sort_by_tx_priority(xs):
+    """ Same as sorted(xs, key=tx_priority_sort_key), as a single stable np.lexsort over
+        the key columns (overlap percentages, biotype, TSL, canonical, length)
+    """
+    if len(xs) < 2:
+        return list(xs)
+    keys = np.array([[(-x[ind] if len(x) > ind and x[ind] is not None else 0) for ind in _OVERLAP_COLS] +
+                     list(_tx_ranks(x)) +
+                     [-(int(x[ebl.BedCols.END]) - int(x[ebl.BedCols.START]))]
+                     for x in xs], dtype=float)
+    return [xs[i] for i in np.lexsort(keys.T[::-1])]
+
+
 # def select_best_tx(overlaps_by_tx):
 #     tx_overlaps = [(o, size) for os in overlaps_by_tx.values() for (o, size) in os if o[ebl.BedCols.FEATURE] == 'transcript']
 #     tsl1_overlaps = [(o, size) for (o, size) in tx_overlaps if o[ebl.BedCols.TSL] in ['1', 'NA']]
@@ -290,7 +449,7 @@ def _resolve_ambiguities(overlaps_by_tx_by_gene_by_loc, chrom_order,
             # for x in tx_by_key.values():
             #     overlaps.extend(overlaps_by_tx[x[ebl.BedCols.ENSEMBL_ID]])
 
-            tx_sorted_list = [x[ebl.BedCols.ENSEMBL_ID] for x in sorted(all_tx, key=tx_priority_sort_key)]
+            tx_sorted_list = [x[ebl.BedCols.ENSEMBL_ID] for x in _sort_by_tx_priority(all_tx)]
             if not tx_sorted_list:
                 annotated.append(consensus)
                 continue
@@ -337,7 +496,7 @@ def _resolve_ambiguities(overlaps_by_tx_by_gene_by_loc, chrom_order,
             annotation_alternatives.append(consensus)
 
         if len(annotation_alternatives) > 1:  # unless asked for all, selecting the top best annotation
-            annotation_alternatives.sort(key=tx_priority_sort_key)
+            annotation_alternatives = _sort_by_tx_priority(annotation_alternatives)
             # annotation_alternatives = [a for a in annotation_alternatives if a[ebl.BedCols.CDS_OVERLAPS_PERCENTAGE] > 50]
             # choices=['best_one', 'best_ask', 'best_all', 'all_ask', 'all'],
             if 'best_' in ambiguities_method:
@@ -362,6 +521,15 @@ def _resolve_ambiguities(overlaps_by_tx_by_gene_by_loc, chrom_order,
 
 def _annotate(bed, ref_bed, chr_order, fai_fpath, work_dir, ori_col_num,
               high_confidence=False, reannotate=False, is_debug=False, **kwargs):
+    intersection_bed = _intersect(bed, ref_bed, fai_fpath, work_dir, is_debug=is_debug)
+    overlaps_by_tx_by_gene_by_loc = _collect_overlaps(intersection_bed, ori_col_num, reannotate)
+    info('Resolving ambiguities...')
+    annotated = _resolve_ambiguities(overlaps_by_tx_by_gene_by_loc, chr_order, **kwargs)
+
+    return annotated
+
+
+def _intersect(bed, ref_bed, fai_fpath, work_dir, is_debug=False, intersection_fname='intersection.bed'):
     # if genome:
         # genome_fpath = cut(fai_fpath, 2, output_fpath=intermediate_fname(work_dir, fai_fpath, 'cut2'))
         # intersection = bed.intersect(ref_bed, sorted=True, wao=True, g='<(cut -f1,2 ' + fai_fpath + ')')
@@ -373,7 +541,7 @@ def _annotate(bed, ref_bed, chr_order, fai_fpath, work_dir, ori_col_num,
     
     pybedtools.set_tempdir(safe_mkdir(join(work_dir, 'bedtools')))
     if is_debug:
-        intersection_fpath = join(work_dir, 'intersection.bed')
+        intersection_fpath = join(work_dir, intersection_fname)
         if isfile(intersection_fpath):
             info('Loading from ' + intersection_fpath)
             intersection_bed = BedTool(intersection_fpath)
@@ -387,6 +555,14 @@ def _annotate(bed, ref_bed, chr_order, fai_fpath, work_dir, ori_col_num,
     if is_debug and not isfile(intersection_fpath):
         intersection_bed.saveas(intersection_fpath)
         debug('Saved intersection to ' + intersection_fpath)
+    return intersection_bed
+
+
+def _collect_overlaps(intersection_rows, ori_col_num, reannotate):
+    """ Groups bedtools intersect -wao rows (region fields, then feature fields and overlap size)
+        by region, gene and transcript
+    """
+    overlaps_by_tx_by_gene_by_loc = OrderedDefaultDict(lambda: OrderedDefaultDict(lambda: defaultdict(list)))
 
     total_annotated = 0
     total_uniq_annotated = 0
@@ -394,11 +570,10 @@ def _annotate(bed, ref_bed, chr_order, fai_fpath, work_dir, ori_col_num,
 
     met = set()
 
-    overlaps_by_tx_by_gene_by_loc = OrderedDefaultDict(lambda: OrderedDefaultDict(lambda: defaultdict(list)))
     # off_targets = list()
 
     expected_fields_num = ori_col_num + len(ebl.BedCols.cols[:-4]) + 1
-    for i, intersection_fields in enumerate(intersection_bed):
+    for i, intersection_fields in enumerate(intersection_rows):
         inters_fields_list = list(intersection_fields)
         if len(inters_fields_list) < expected_fields_num:
             critical(f'Cannot parse the reference BED file - unexpected number of lines '
@@ -446,10 +621,7 @@ def _annotate(bed, ref_bed, chr_order, fai_fpath, work_dir, ori_col_num,
     info('  Total annotated regions: ' + str(total_annotated))
     info('  Total unique annotated regions: ' + str(total_uniq_annotated))
     info('  Total off target regions: ' + str(total_off_target))
-    info('Resolving ambiguities...')
-    annotated = _resolve_ambiguities(overlaps_by_tx_by_gene_by_loc, chr_order, **kwargs)
-
-    return annotated
+    return overlaps_by_tx_by_gene_by_loc
 
 
 def _save_regions(regions, fpath):
@@ -0,0 +1,96 @@
+""" Memory-mapped index of canonical transcripts.
+
+The index file has a header line "TXIDX1 <gene_width> <tx_width> <num_genes> <num_txs>\n" followed by
+two sections of fixed-width space-padded records: "<gene><tx_id>" sorted by gene, then "<tx_id>" sorted
+by transcript id. Lookups are binary searches over the mapped file, so the index is built once per genome
+and shared read-only between processes through the page cache.
+"""
+import mmap
+import tempfile
+from os.path import join
+
+MAGIC = b'TXIDX1'
+VERSION = 1
+
+
+def write_index(canon_tx_by_gname, index_fpath):
+    gene_width = max([len(g.encode()) for g in canon_tx_by_gname] or [1])
+    tx_width = max([len(t.encode()) for t in canon_tx_by_gname.values()] or [1])
+    txs = sorted(set(t.encode() for t in canon_tx_by_gname.values()))
+    with open(index_fpath, 'wb') as out:
+        out.write(b' '.join([MAGIC] + [str(v).encode() for v in
+                                       [gene_width, tx_width, len(canon_tx_by_gname), len(txs)]]) + b'\n')
+        for gname, tx_id in sorted((g.encode(), t.encode()) for g, t in canon_tx_by_gname.items()):
+            out.write(gname.ljust(gene_width) + tx_id.ljust(tx_width))
+        for tx_id in txs:
+            out.write(tx_id.ljust(tx_width))
+    return index_fpath
+
+
+class CanonicalIndex:
+    def __init__(self, index_fpath):
+        self.index_fpath = index_fpath
+        with open(index_fpath, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_end = self._mm.find(b'\n') + 1
+        magic, gene_width, tx_width, num_genes, num_txs = self._mm[:header_end].split()
+        assert magic == MAGIC, 'Unexpected canonical transcripts index format in ' + index_fpath
+        self._gene_width, self._tx_width = int(gene_width), int(tx_width)
+        self._num_genes, self._num_txs = int(num_genes), int(num_txs)
+        self._genes_offset = header_end
+        self._txs_offset = header_end + self._num_genes * (self._gene_width + self._tx_width)
+        self._cache = dict()
+
+    def _bisect(self, key, offset, num, width, key_width):
+        lo, hi = 0, num
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = offset + mid * width
+            val = self._mm[start:start + key_width].rstrip(b' ')
+            if val < key:
+                lo = mid + 1
+            elif val > key:
+                hi = mid
+            else:
+                return start
+        return None
+
+    def get(self, gname):
+        """ Canonical transcript id of gname, or None
+        """
+        tx_id = self._cache.get(gname, False)
+        if tx_id is False:
+            tx_id = None
+            if gname:
+                start = self._bisect(gname.encode(), self._genes_offset, self._num_genes,
+                                     self._gene_width + self._tx_width, self._gene_width)
+                if start is not None:
+                    start += self._gene_width
+                    tx_id = self._mm[start:start + self._tx_width].rstrip(b' ').decode()
+            self._cache[gname] = tx_id
+        return tx_id
+
+    def is_canonical(self, tx_id):
+        return bool(tx_id) and self._bisect(tx_id.encode(), self._txs_offset, self._num_txs,
+                                            self._tx_width, self._tx_width) is not None
+
+    def __len__(self):
+        return self._num_genes
+
+
+def build_index_file(get_canon_tx_by_gname, cache_dir=None, key=None, work_dir=None):
+    """ Writes the index of get_canon_tx_by_gname() into the shared cache entry for key, or into
+        <work_dir>/canonical_<key>.idx without cache_dir. Either is built only if it doesn't exist yet.
+    """
+    if cache_dir and key:
+        from targqc.utilz.cache import get_or_create_entry
+        entry_dirpath = get_or_create_entry(cache_dir, 'canonical', key,
+            lambda dirpath: write_index(get_canon_tx_by_gname(), join(dirpath, 'canonical.idx')))
+        return join(entry_dirpath, 'canonical.idx')
+    from targqc.utilz.file_utils import file_transaction, verify_file
+    work_dir = work_dir or tempfile.gettempdir()
+    index_fpath = join(work_dir, 'canonical_' + (key or 'index') + '.idx')
+    if not verify_file(index_fpath, silent=True):
+        with file_transaction(work_dir, index_fpath) as tx:
+            write_index(get_canon_tx_by_gname(), tx)
+    return index_fpath
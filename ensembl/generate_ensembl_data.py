@@ -1,14 +1,16 @@
 #!/usr/bin/env python
 import csv
 import ensembl as ebl
-import os
+import shutil
+import tempfile
 import targqc.utilz.reference_data as ref
+from collections import OrderedDict
+from multiprocessing import Pool
 from optparse import OptionParser
 from os.path import join, isfile, dirname
-from targqc.utilz.bed_utils import bgzip_and_tabix, sort_bed
-from targqc.utilz import gtf
+from targqc.utilz.bed_utils import bgzip_and_tabix
 from targqc.utilz import logger
-from targqc.utilz.file_utils import verify_file, add_suffix
+from targqc.utilz.file_utils import verify_file, file_transaction, open_gzipsafe
 from targqc.utilz.logger import debug, warn, critical
 
 
@@ -20,6 +22,8 @@ Usage:
 
     options = [
         (['--debug'], dict(dest='debug', action='store_true', default=False)),
+        (['-t', '--threads'], dict(dest='threads', type='int', default=1,
+                                   help='Number of processes to convert chromosomes in parallel')),
     ]
     parser = OptionParser(description=description)
     for args, kwargs in options:
@@ -39,102 +43,208 @@ Usage:
         if not gtf_fpath.endswith('.gz'):
             gtf_fpath += '.gz'
     gtf_fpath = verify_file(gtf_fpath)
-    debug('Reading the GTF database')
-    db = gtf.get_gtf_db(gtf_fpath)
 
     debug('Reading biomart data')
     features_by_ens_id = read_biomart(genome_name)
 
-    chroms = [c for c, l in ref.get_chrom_lengths(genome_name)]
-    
     output_fpath = join(dirname(__file__), genome_name, 'ensembl.bed')
-    unsorted_output_fpath = add_suffix(output_fpath, 'unsorted')
-    debug('Processing features, writing to ' + unsorted_output_fpath)
+    gtf_to_bed(gtf_fpath, output_fpath, features_by_ens_id, genome_name, threads=opts.threads)
+    bgzip_and_tabix(output_fpath)
+
+
+def gtf_to_bed(gtf_fpath, output_fpath, features_by_ens_id, genome_name, threads=1):
+    """ Writes GTF records on the chromosomes of the genome into a sorted Ensembl BED,
+        with gene names, biotypes and TSL checked against the biomart features
+    """
+    chroms = [c for c, l in ref.get_chrom_lengths(genome_name)]
+    chr_order = ref.get_chrom_order(genome_name)
+
+    work_dir = tempfile.mkdtemp(dir=dirname(output_fpath), prefix='.ensembl_bed_')
+    try:
+        debug('Splitting ' + gtf_fpath + ' by chromosome')
+        gtf_fpath_by_chrom, has_transcripts = split_gtf_by_chrom(gtf_fpath, chroms, work_dir)
+
+        debug('Converting ' + str(len(gtf_fpath_by_chrom)) + ' chromosomes in ' + str(threads) + ' processes')
+        params = [(chrom, fpath, join(work_dir, chrom + '.bed'), not has_transcripts)
+                  for chrom, fpath in gtf_fpath_by_chrom.items()]
+        pool = Pool(threads, initializer=_init_worker, initargs=(_compact_biomart(features_by_ens_id),))
+        try:
+            results = pool.map(_convert_chrom, params)
+        finally:
+            pool.close()
+            pool.join()
+
+        num_tx_not_in_biomart = sum(r[2] for r in results)
+        num_tx_diff_gene_in_biomart = sum(r[3] for r in results)
+        if num_tx_not_in_biomart:
+            warn(str(num_tx_not_in_biomart) + ' transcripts not found in biomart')
+        if num_tx_diff_gene_in_biomart:
+            warn(str(num_tx_diff_gene_in_biomart) + ' transcripts have a different gene name in biomart')
+
+        debug('Writing sorted results to ' + output_fpath)
+        _write_sorted(output_fpath, [(out_chrom, bed_fpath) for out_chrom, bed_fpath, _, _ in results], chr_order)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return output_fpath
+
+
+def parse_gtf_attributes(attr_str):
+    """ 'gene_id "ENSG01"; tag "basic"; tag "CCDS";' -> {'gene_id': ['ENSG01'], 'tag': ['basic', 'CCDS']}
+    """
+    attributes = dict()
+    for attr in attr_str.split(';'):
+        attr = attr.strip()
+        if not attr:
+            continue
+        key, _, val = attr.partition(' ')
+        attributes.setdefault(key, []).append(val.strip().strip('"'))
+    return attributes
+
+
+def split_gtf_by_chrom(gtf_fpath, chroms, work_dir):
+    """ One streaming pass over the GTF: writes records of each chromosome from chroms into a separate file,
+        skipping genes. Returns ({chrom: gtf_fpath}, whether the GTF has transcript records)
+    """
+    chroms = set(chroms)
+    handle_by_chrom = OrderedDict()
+    has_transcripts = False
+    with open_gzipsafe(gtf_fpath) as f:
+        for l in f:
+            if l.startswith('#'):
+                continue
+            fs = l.split('\t', 3)
+            if len(fs) < 4 or fs[2] == 'gene' or fs[0] not in chroms:
+                continue
+            if fs[2] == 'transcript':
+                has_transcripts = True
+            out = handle_by_chrom.get(fs[0])
+            if out is None:
+                out = handle_by_chrom[fs[0]] = open(join(work_dir, fs[0] + '.gtf'), 'w')
+            out.write(l)
+    for out in handle_by_chrom.values():
+        out.close()
+    return OrderedDict((c, join(work_dir, c + '.gtf')) for c in handle_by_chrom), has_transcripts
+
+
+def _compact_biomart(features_by_ens_id):
+    """ Keeps only the biomart fields used to annotate: {tx_id: (gene name, transcript type, TSL)}
+    """
+    return {tx_id: (r['Associated Gene Name'], r['Transcript type'], r.get('Transcript Support Level (TSL)'))
+            for tx_id, r in features_by_ens_id.items()}
 
-    def _get(_rec, _key):
-        val = _rec.attributes.get(_key)
-        if val is None:
-            return None
-        assert len(val) == 1, (_key, str(val))
-        return val[0]
+
+_biomart_by_tx_id = None
+
+
+def _init_worker(biomart_by_tx_id):
+    global _biomart_by_tx_id
+    _biomart_by_tx_id = biomart_by_tx_id
+
+
+def _read_gtf_records(gtf_fpath, infer_transcripts=False):
+    """ Yields (chrom, featuretype, start, end, strand, attributes). If infer_transcripts,
+        also yields transcript records spanning the features of each transcript_id.
+    """
+    tx_extent_by_id = OrderedDict()
+    with open(gtf_fpath) as f:
+        for l in f:
+            fs = l.rstrip('\n').split('\t')
+            chrom, featuretype, start, end, strand = fs[0], fs[2], int(fs[3]), int(fs[4]), fs[6]
+            attributes = parse_gtf_attributes(fs[8])
+            yield chrom, featuretype, start, end, strand, attributes
+            if infer_transcripts and 'transcript_id' in attributes:
+                tx_id = attributes['transcript_id'][0]
+                ext = tx_extent_by_id.get(tx_id)
+                if ext is None:
+                    tx_attributes = {k: v for k, v in attributes.items() if not k.startswith('exon_')}
+                    tx_extent_by_id[tx_id] = [chrom, start, end, strand, tx_attributes]
+                else:
+                    ext[1] = min(ext[1], start)
+                    ext[2] = max(ext[2], end)
+    for tx_id, (chrom, start, end, strand, attributes) in tx_extent_by_id.items():
+        yield chrom, 'transcript', start, end, strand, attributes
+
+
+def _convert_chrom(params):
+    """ Converts GTF records of one chromosome into sorted Ensembl BED rows.
+        Returns (output chrom name, bed_fpath, num tx not in biomart, num tx with different gene in biomart)
+    """
+    chrom, gtf_fpath, bed_fpath, infer_transcripts = params
+    out_chrom = chrom if chrom.startswith('chr') else 'chr' + chrom.replace('MT', 'M')
+
+    def _get(_attributes, _key):
+        val = _attributes.get(_key)
+        return val[0] if val else None
 
     num_tx_not_in_biomart = 0
     num_tx_diff_gene_in_biomart = 0
-    with open(unsorted_output_fpath, 'w') as out:
-        out.write('\t'.join(ebl.BedCols.names[i] for i in ebl.BedCols.cols[:-4]) + '\n')
-
-        for rec in db.all_features(order_by=('seqid', 'start', 'end')):
-            if rec.featuretype == 'gene': continue
-            if rec.chrom not in chroms: continue
-            if rec.end - rec.start < 0: continue
-            
-            tx_id = _get(rec, 'transcript_id')
-            gname = _get(rec, 'gene_name')
-            tx_biotype = _get(rec, 'transcript_biotype')
-            if not tx_biotype: tx_biotype = _get(rec, 'gene_biotype')
-            tsl = _get(rec, 'transcript_support_level')
-            hugo_gene = None
-
-            biomart_rec = features_by_ens_id.get(tx_id)
-            if not biomart_rec:
-                if rec.featuretype == 'transcript':
-                    num_tx_not_in_biomart += 1
-            else:
-                bm_gname = biomart_rec['Associated Gene Name']
-                bm_tx_biotype = biomart_rec['Transcript type']
-                bm_tsl = biomart_rec.get('Transcript Support Level (TSL)')
-                hugo_gene = biomart_rec['HGNC symbol']
-                if bm_gname != gname:
-                    if rec.featuretype == 'transcript':
-                        num_tx_diff_gene_in_biomart += 1
-                    continue
-                tx_biotype = bm_tx_biotype
-                tsl = bm_tsl.split()[0].replace('tsl', '') if bm_tsl else None
-
-            fs = [None] * len(ebl.BedCols.cols[:-3])
-            if not rec.chrom.startswith('chr'):
-                rec.chrom = 'chr' + rec.chrom.replace('MT', 'M')
-            fs[:6] = [rec.chrom,
-                      str(rec.start - 1),
-                      str(rec.end),
-                      gname,
-                      rec.attributes.get('exon_number', ['.'])[0],
-                      rec.strand]
-            fs[ebl.BedCols.FEATURE] = rec.featuretype or '.'
-            fs[ebl.BedCols.BIOTYPE] = tx_biotype or '.'
-            fs[ebl.BedCols.ENSEMBL_ID] = tx_id or '.'
-            # fs[ebl.BedCols.REFSEQ_ID] = refseq_id or '.'
-            # fs[ebl.BedCols.IS_CANONICAL] = 'canonical' if refseq_id in canonical_transcripts_ids else ''
-            fs[ebl.BedCols.TSL] = tsl or '.'
-            # fs[ebl.BedCols.HUGO] = hugo_gene or '.'
-            # fs[ebl.BedCols.names[ensembl.BedCols.GC]] = gc
+    rows = []
+    for _, featuretype, start, end, strand, attributes in _read_gtf_records(gtf_fpath, infer_transcripts):
+        if end - start < 0: continue
+
+        tx_id = _get(attributes, 'transcript_id')
+        gname = _get(attributes, 'gene_name')
+        tx_biotype = _get(attributes, 'transcript_biotype')
+        if not tx_biotype: tx_biotype = _get(attributes, 'gene_biotype')
+        tsl = _get(attributes, 'transcript_support_level')
+
+        biomart_rec = _biomart_by_tx_id.get(tx_id)
+        if not biomart_rec:
+            if featuretype == 'transcript':
+                num_tx_not_in_biomart += 1
+        else:
+            bm_gname, bm_tx_biotype, bm_tsl = biomart_rec
+            if bm_gname != gname:
+                if featuretype == 'transcript':
+                    num_tx_diff_gene_in_biomart += 1
+                continue
+            tx_biotype = bm_tx_biotype
+            tsl = bm_tsl.split()[0].replace('tsl', '') if bm_tsl else None
+
+        fs = [None] * len(ebl.BedCols.cols[:-4])
+        fs[:6] = [out_chrom,
+                  str(start - 1),
+                  str(end),
+                  gname or '.',
+                  attributes.get('exon_number', ['.'])[0],
+                  strand]
+        fs[ebl.BedCols.FEATURE] = featuretype or '.'
+        fs[ebl.BedCols.BIOTYPE] = tx_biotype or '.'
+        fs[ebl.BedCols.ENSEMBL_ID] = tx_id or '.'
+        fs[ebl.BedCols.TSL] = tsl or '.'
+        rows.append(fs)
+
+    rows.sort(key=_row_sort_key)
+    with open(bed_fpath, 'w') as out:
+        for fs in rows:
             out.write('\t'.join(fs) + '\n')
+    return out_chrom, bed_fpath, num_tx_not_in_biomart, num_tx_diff_gene_in_biomart
 
-    if num_tx_not_in_biomart:
-        warn(str(num_tx_not_in_biomart) + ' transcripts not found in biomart')
-    if num_tx_diff_gene_in_biomart:
-        warn(str(num_tx_diff_gene_in_biomart) + ' transcripts have a different gene name in biomart')
 
-    debug('Sorting results')
-    sort_bed(unsorted_output_fpath, output_fpath, fai_fpath=ref.get_fai(genome_name), genome=genome_name)
-    os.remove(unsorted_output_fpath)
-    bgzip_and_tabix(output_fpath)
+def _row_sort_key(fs):
+    return int(fs[1]), int(fs[2]), fs[3:]
+
 
-    # with open(output_fpath, 'w') as out:
-    #     for feature in db.features_of_type('transcript', order_by=("seqid", "start", "end")):
-    #         chrom = feature.chrom
-    #         start = feature.start
-    #         end = feature.end
-    #         attributes = feature.attributes.keys()
-    #         strand = feature.strand
-    #         name = (feature['gene_name'][0] if 'gene_name' in attributes else
-    #                 feature['gene_id'][0])
-    #         line = "\t".join([str(x) for x in [chrom, start, end, name, ".",
-    #                                            strand]])
-    #         out.write(line + "\n")
-
-
-    # db_bed = gtf.gtf_to_bed(gtf_db_fpath, out_dir)
+def _write_sorted(output_fpath, bed_fpath_by_chrom, chr_order):
+    """ Concatenates per-chromosome BED files in the reference order, same as sort_bed would.
+        Chromosomes missing in the reference go first, sorted together.
+    """
+    unknown = [fpath for c, fpath in bed_fpath_by_chrom if c not in chr_order]
+    known = sorted([(chr_order[c], fpath) for c, fpath in bed_fpath_by_chrom if c in chr_order])
+    with file_transaction(None, output_fpath) as tx:
+        with open(tx, 'w') as out:
+            out.write('\t'.join(ebl.BedCols.names[i] for i in ebl.BedCols.cols[:-4]) + '\n')
+            if unknown:
+                rows = []
+                for fpath in unknown:
+                    with open(fpath) as f:
+                        rows.extend(l.rstrip('\n').split('\t') for l in f)
+                rows.sort(key=_row_sort_key)
+                for fs in rows:
+                    out.write('\t'.join(fs) + '\n')
+            for _, fpath in known:
+                with open(fpath) as f:
+                    shutil.copyfileobj(f, out)
 
 
 def read_biomart(genome_name):
@@ -7,17 +7,17 @@ from os.path import join, basename
 from tempfile import mkdtemp
 
 import ensembl as ebl
-from ensembl.bed_annotation import annotate
+from ensembl.bed_annotation import annotate, annotate_batch
 from ngs_utils.bed_utils import verify_bed, clean_bed
 from ngs_utils import logger
-from ngs_utils.file_utils import adjust_path, safe_mkdir, verify_file
+from ngs_utils.file_utils import adjust_path, safe_mkdir, verify_file, add_suffix
 from ngs_utils.logger import info
 from ngs_utils.logger import debug
 
 
 @click.command()
-@click.argument('input_bed', type=click.Path(exists=True))
-@click.option('-o', '--output-file', type=click.Path(), help='Output file path')
+@click.argument('input_beds', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('-o', '--output-file', type=click.Path(), help='Output file path, or output directory if multiple BED files are given')
 @click.option('--output-features', is_flag=True, help='Also output featues that was used to annotate')
 @click.option('-g', 'genome', default='GRCh37', type=click.Choice(ebl.SUPPORTED_GENOMES), help='Genome build')
 @click.option('--canonical', '--only-canonical', is_flag=True, help='Use only features from canonical transcripts to annotate')
@@ -29,11 +29,13 @@ from ngs_utils.logger import debug
 @click.option('--coding-only', is_flag=True, help='Use only protein coding genes to annotate')
 @click.option('--collapse-exons', is_flag=True)
 @click.option('--work-dir', default=None, type=click.Path())
+@click.option('-t', '--threads', default=1, type=int, help='Number of processes to annotate chromosomes (or, for multiple BED files, the files) in parallel')
 @click.option('-d', '--debug', '--is-debug', is_flag=True)
-def main(input_bed, output_file, output_features=False, genome=None,
+def main(input_beds, output_file, output_features=False, genome=None,
          only_canonical=False, short=False, extended=False, high_confidence=False,
-         ambiguities_method=False, coding_only=False, collapse_exons=False, work_dir=False, is_debug=False):
-    """ Annotating BED file based on reference features annotations.
+         ambiguities_method=False, coding_only=False, collapse_exons=False, work_dir=False, threads=1, is_debug=False):
+    """ Annotating BED file based on reference features annotations. Multiple BED files are annotated
+        in one batch, sharing a single pass over the features.
     """
     logger.init(is_debug_=is_debug)
 
@@ -47,37 +49,54 @@ def main(input_bed, output_file, output_features=False, genome=None,
         extended = True
         short    = False
 
-    if not verify_file(input_bed):
-        click.BadParameter(f'Usage: {__file__} Input_BED_file -g hg19 -o Annotated_BED_file [options]', param='input_bed')
-    input_bed = verify_file(input_bed, is_critical=True, description=f'Input BED file for {__file__}')
+    input_beds = [verify_file(b, is_critical=True, description=f'Input BED file for {__file__}') for b in input_beds]
+    output_fnames = [add_suffix(basename(b), 'anno') for b in input_beds]
+    if len(set(output_fnames)) < len(output_fnames):
+        dups = sorted(set(b for b in input_beds if output_fnames.count(add_suffix(basename(b), 'anno')) > 1))
+        raise click.BadParameter('input BED files must have different file names, as outputs are named after them: ' +
+                                 ', '.join(dups), param_hint='input_beds')
 
     if work_dir:
-        work_dir = join(adjust_path(work_dir), os.path.splitext(basename(input_bed))[0])
+        work_dir = join(adjust_path(work_dir), os.path.splitext(basename(input_beds[0]))[0]
+                        if len(input_beds) == 1 else 'batch')
         safe_mkdir(work_dir)
         info(f'Created work directory {work_dir}')
     else:
         work_dir = mkdtemp('bed_annotate')
         debug('Created temporary work directory {work_dir}')
-
-    input_bed = clean_bed(input_bed, work_dir)
-    input_bed = verify_bed(input_bed, is_critical=True, description=f'Input BED file for {__file__} after cleaning')
-
-    output_file = adjust_path(output_file)
-
-    output_file = annotate(
-        input_bed, output_file, work_dir, genome=genome,
-        only_canonical=only_canonical, short=short, extended=extended,
-        high_confidence=high_confidence, collapse_exons=collapse_exons,
-        output_features=output_features,
-        ambiguities_method=ambiguities_method, coding_only=coding_only,
-        is_debug=is_debug)
+    ebl.set_canonical_index_dirs(work_dir=work_dir)
+
+    input_beds = [verify_bed(clean_bed(b, work_dir), is_critical=True,
+                             description=f'Input BED file for {__file__} after cleaning') for b in input_beds]
+
+    if len(input_beds) == 1:
+        output_file = adjust_path(output_file)
+
+        output_file = annotate(
+            input_beds[0], output_file, work_dir, genome=genome,
+            only_canonical=only_canonical, short=short, extended=extended,
+            high_confidence=high_confidence, collapse_exons=collapse_exons,
+            output_features=output_features,
+            ambiguities_method=ambiguities_method, coding_only=coding_only,
+            threads=threads, is_debug=is_debug)
+        info(f'Done, saved to {output_file}')
+    else:
+        output_dir = safe_mkdir(adjust_path(output_file or os.getcwd()))
+        output_files = [join(output_dir, fname) for fname in output_fnames]
+
+        annotate_batch(
+            input_beds, output_files, work_dir, genome=genome,
+            only_canonical=only_canonical, short=short, extended=extended,
+            high_confidence=high_confidence, collapse_exons=collapse_exons,
+            output_features=output_features,
+            ambiguities_method=ambiguities_method, coding_only=coding_only,
+            threads=threads, is_debug=is_debug)
+        info(f'Done, saved {len(output_files)} annotated BED files to {output_dir}')
 
     if not work_dir:
         debug(f'Removing work directory {work_dir}')
         shutil.rmtree(work_dir)
 
-    info(f'Done, saved to {output_file}')
-
 
 if __name__ == '__main__':
     main()
@@ -26,7 +26,7 @@ setup(
     url='https://github.com/vladsaveliev/TargQC',
     download_url='https://github.com/vladsaveliev/TargQC/releases',
     license='GPLv3',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     package_data={
         package_name: setup_utils.find_package_files('', package_name, skip_exts=['.sass', '.coffee']),
         'ensembl': [
@@ -44,6 +44,7 @@ setup(
     scripts=[
         join('scripts', script_name),
         join('scripts', 'annotate_bed.py'),
+        join('scripts', 'targqc_db'),
         join('scripts', 'cols'),
         join('scripts', 'tsv'),
         join('scripts', 'tabutils'),
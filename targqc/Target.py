@@ -1,29 +1,51 @@
+import json
+import os
+import shutil
+import numpy as np
 import ensembl as ebl
 from collections import defaultdict
 from ensembl.bed_annotation import overlap_with_features, get_sort_key, tx_priority_sort_key
-from os.path import join, basename
+from os.path import join, basename, isfile
 from pybedtools import BedTool
 from targqc import config as cfg
-from targqc.utilz.bed_utils import sort_bed, verify_bed, get_genes_from_bed
+from targqc.utilz.bed_utils import sort_bed, verify_bed, get_genes_from_bed, RegionSet
 from targqc.utilz import reference_data
+from targqc.utilz.cache import content_hash, get_or_create_entry
 from targqc.utilz.file_utils import add_suffix, intermediate_fname, file_transaction, verify_file, can_reuse
 from targqc.utilz.logger import debug
 from targqc.utilz.utils import OrderedDefaultDict
 
 
+PANEL_CACHE_VERSION = 3  # bump when the way target BED files are prepared changes
+GENOME_CACHE_VERSION = 3  # bump when the way WGS regions or merged CDS are built changes
+
+# Target attribute -> file name in a panel cache entry
+_PANEL_CACHE_BEDS = [
+    ('bed_fpath', 'target.bed'),
+    ('qualimap_bed_fpath', 'qualimap_ready.bed'),
+    ('padded_bed_fpath', 'padded.bed'),
+]
+
+
 class Target:
     def __init__(self, work_dir, output_dir, fai_fpath, bed_fpath=None,
-                 padding=None, reannotate=False, genome=None, is_debug=False):
+                 padding=None, reannotate=False, genome=None, is_debug=False, cache_dir=None):
         self.bed = None
         self.original_bed_fpath = None
         self.bed_fpath = None  # with genomic features
         self.capture_bed_fpath = None  # w/o genomic features
+        self.capture_bed3_fpath = None  # w/o genomic features, 3 columns
         self.qualimap_bed_fpath = None
         self.padded_bed_fpath = None
 
+        self.wgs_bed_fpath = None  # features to report for WGS
+        self.cds_bed_fpath = None  # merged CDS for WGS
+
         self.gene_keys_set = set()  # set of pairs (gene_name, chrom)
         self.gene_keys_list = list()  # list of pairs (gene_name, chrom)
         self.regions_num = None
+        self.regions = None  # RegionSet of bed_fpath
+        self.capture_mask = None  # capture rows in regions
 
         self.bases_num = None
         self.fraction = None
@@ -33,22 +55,56 @@ class Target:
             self.is_wgs = False
             verify_bed(bed_fpath, is_critical=True)
             self.original_bed_fpath = bed_fpath
-            self._make_target_bed(bed_fpath, work_dir, output_dir, padding=padding,
-                is_debug=is_debug, fai_fpath=fai_fpath, genome=genome, reannotate=reannotate)
+            if cache_dir:
+                self._load_or_make_target_bed(cache_dir, bed_fpath, work_dir, output_dir, padding=padding,
+                    is_debug=is_debug, fai_fpath=fai_fpath, genome=genome, reannotate=reannotate)
+            else:
+                self._make_target_bed(bed_fpath, work_dir, output_dir, padding=padding,
+                    is_debug=is_debug, fai_fpath=fai_fpath, genome=genome, reannotate=reannotate)
         else:
             debug('No input BED. Assuming whole genome. For region-based reports, analysing RefSeq CDS.')
             self.is_wgs = True
-            self._make_wgs_regions_file(work_dir, genome=genome)
+            self._make_wgs_regions_file(work_dir, genome=genome, cache_dir=cache_dir)
 
     def get_capture_bed(self):
         if not self.is_wgs:
-            if self.bed.field_count() > ebl.BedCols.FEATURE:
-                return self.bed.filter(lambda x: x[ebl.BedCols.FEATURE] == 'capture')
-            else:
-                return self.bed
+            return BedTool(self.capture_bed_fpath)
         else:
             return None
 
+    def _load_or_make_target_bed(self, cache_dir, bed_fpath, work_dir, output_dir, is_debug,
+                                 padding=None, fai_fpath=None, genome=None, reannotate=False):
+        """ Loads prepared BED files from the shared panel cache, keyed by the contents of the BED and fai,
+            genome, padding, annotation options and the version of the Ensembl annotation. Prepares them
+            with _make_target_bed and populates the cache if the panel wasn't seen before.
+        """
+        key = content_hash([f for f in [bed_fpath, fai_fpath] if f],
+                           [genome, padding, reannotate, PANEL_CACHE_VERSION] + _annotation_stamp(genome))
+
+        def _populate(entry_dirpath):
+            self._make_target_bed(bed_fpath, work_dir, output_dir, padding=padding,
+                is_debug=is_debug, fai_fpath=fai_fpath, genome=genome, reannotate=reannotate)
+            for attr, fname in _PANEL_CACHE_BEDS:
+                if getattr(self, attr):
+                    shutil.copy(getattr(self, attr), join(entry_dirpath, fname))
+            with open(join(entry_dirpath, 'panel.json'), 'w') as f:
+                json.dump(dict(gene_keys_list=self.gene_keys_list), f)
+
+        entry_dirpath = get_or_create_entry(cache_dir, 'panels', key, _populate)
+        if self.bed_fpath:  # just prepared
+            return
+
+        debug('Using prepared target BED files from ' + entry_dirpath)
+        for attr, fname in _PANEL_CACHE_BEDS:
+            fpath = join(entry_dirpath, fname)
+            setattr(self, attr, fpath if verify_file(fpath, silent=True) else None)
+        self.bed = BedTool(self.bed_fpath)
+        with open(join(entry_dirpath, 'panel.json')) as f:
+            panel = json.load(f)
+        self.gene_keys_list = panel['gene_keys_list']
+        self.gene_keys_set = set(self.gene_keys_list)
+        self._load_regions(work_dir, output_dir)
+
     def _make_target_bed(self, bed_fpath, work_dir, output_dir, is_debug,
                          padding=None, fai_fpath=None, genome=None, reannotate=False):
         clean_target_bed_fpath = intermediate_fname(work_dir, bed_fpath, 'clean')
@@ -101,34 +157,50 @@ class Target:
 
         self.bed_fpath = final_clean_target_bed_fpath
         self.bed = BedTool(self.bed_fpath)
-        
-        self.capture_bed_fpath = add_suffix(join(output_dir, basename(bed_fpath)), 'clean_sorted_ann')
-        if not can_reuse(self.capture_bed_fpath, self.bed_fpath):
-            with file_transaction(work_dir, self.capture_bed_fpath) as tx:
-                self.get_capture_bed().saveas(tx)
+        self._load_regions(work_dir, output_dir)
 
         gene_key_set, gene_key_list = get_genes_from_bed(bed_fpath)
         self.gene_keys_set = gene_key_set
         self.gene_keys_list = gene_key_list
-        self.regions_num = self.get_capture_bed().count()
 
         self._make_qualimap_bed(work_dir)
         if padding:
             self._make_padded_bed(work_dir, fai_fpath, padding)
 
+    def _load_regions(self, work_dir, output_dir):
+        """ Reads the prepared BED once into a RegionSet and writes the capture-only views of it
+        """
+        self.regions = RegionSet.from_bed(self.bed_fpath)
+        features = self.regions.column(ebl.BedCols.FEATURE)
+        if any(f is not None for f in features):
+            self.capture_mask = np.array([f == 'capture' for f in features], dtype=bool)
+        else:
+            self.capture_mask = np.ones(len(self.regions), dtype=bool)
+        self.regions_num = int(self.capture_mask.sum())
+
+        self.capture_bed_fpath = add_suffix(join(output_dir, basename(self.original_bed_fpath)), 'clean_sorted_ann')
+        if not can_reuse(self.capture_bed_fpath, self.bed_fpath):
+            self.regions.save(work_dir, self.capture_bed_fpath, mask=self.capture_mask)
+
+        self.capture_bed3_fpath = intermediate_fname(work_dir, self.capture_bed_fpath, 'bed3')
+        if not can_reuse(self.capture_bed3_fpath, self.bed_fpath):
+            self.regions.save(work_dir, self.capture_bed3_fpath, mask=self.capture_mask, cols=3)
+
     def _make_padded_bed(self, work_dir, fai_fpath, padding):
         if self.is_wgs:
             return None
 
         self.padded_bed_fpath = intermediate_fname(work_dir, self.capture_bed_fpath, 'padded')
         if can_reuse(self.padded_bed_fpath, self.capture_bed_fpath):
-            return BedTool(self.padded_bed_fpath)
+            return self.padded_bed_fpath
 
-        padded_bed = self.bed.slop(b=padding, g=fai_fpath).sort().merge()
+        chrom_lengths = dict(reference_data.get_chrom_lengths(fai_fpath=fai_fpath)) if fai_fpath else None
         with file_transaction(work_dir, self.padded_bed_fpath) as tx:
-            padded_bed.saveas(tx)
+            with open(tx, 'w') as out:
+                for chrom, start, end in self.regions.merged(padding=padding, chrom_lengths=chrom_lengths):
+                    out.write('\t'.join([chrom, str(start), str(end)]) + '\n')
         verify_file(self.padded_bed_fpath, is_critical=True)
-        return BedTool(self.padded_bed_fpath)
+        return self.padded_bed_fpath
 
     def _make_qualimap_bed(self, work_dir):
         if self.is_wgs:
@@ -139,42 +211,83 @@ class Target:
             return self.qualimap_bed_fpath
 
         debug('Merging and saving BED into required bed6 format for Qualimap')
-        bed = self.bed.sort().merge()
         with file_transaction(work_dir, self.qualimap_bed_fpath) as tx:
             with open(tx, 'w') as out:
-                for i, region in enumerate(x for x in bed):
-                    region = [x for x in list(region) if x]
-                    fillers = [str(i), "1.0", "+"]
-                    full = region + fillers[:6 - len(region)]
+                for i, (chrom, start, end) in enumerate(self.regions.merged()):
+                    full = [chrom, str(start), str(end), str(i), "1.0", "+"]
                     out.write("\t".join(full) + "\n")
         verify_file(self.qualimap_bed_fpath, is_critical=True)
         return self.qualimap_bed_fpath
 
-    def _make_wgs_regions_file(self, work_dir, genome=None):
-        self.wgs_bed_fpath = join(work_dir, 'targqc_features_to_report.bed')
-        if can_reuse(self.wgs_bed_fpath, ebl.ensembl_gtf_fpath(genome)):
-            return self.wgs_bed_fpath
+    def _make_wgs_regions_file(self, work_dir, genome=None, cache_dir=None):
+        """ Builds the regions to report for WGS (best transcript per gene) and the merged CDS.
+            Both depend only on the genome and the Ensembl annotation, so with cache_dir they're
+            built once per installation in a shared genome cache entry.
+        """
+        genome = genome or cfg.genome
+        if cache_dir:
+            key = content_hash(params=[genome, GENOME_CACHE_VERSION] + _annotation_stamp(genome))
 
-        chr_order = reference_data.get_chrom_order(genome or cfg.genome)
+            def _populate(entry_dirpath):
+                _write_wgs_regions(None, join(entry_dirpath, 'features_to_report.bed'), genome)
+                _write_merged_cds(None, join(entry_dirpath, 'cds_merged.bed'), genome)
 
-        r_by_tx_by_gene = OrderedDefaultDict(lambda: defaultdict(list))
-        all_features = ebl.get_all_features(genome or cfg.genome, high_confidence=True)
+            entry_dirpath = get_or_create_entry(cache_dir, 'genomes', key, _populate)
+            self.wgs_bed_fpath = join(entry_dirpath, 'features_to_report.bed')
+            self.cds_bed_fpath = join(entry_dirpath, 'cds_merged.bed')
+        else:
+            self.wgs_bed_fpath = join(work_dir, 'targqc_features_to_report.bed')
+            if not can_reuse(self.wgs_bed_fpath, ebl.ensembl_gtf_fpath(genome)):
+                _write_wgs_regions(work_dir, self.wgs_bed_fpath, genome)
+            self.cds_bed_fpath = join(work_dir, 'targqc_cds_merged.bed')
+            if not can_reuse(self.cds_bed_fpath, ebl.ensembl_gtf_fpath(genome)):
+                _write_merged_cds(work_dir, self.cds_bed_fpath, genome)
+        return self.wgs_bed_fpath
 
-        debug('Select best transcript to report')
-        for r in all_features:
-            if r[ebl.BedCols.FEATURE] != 'gene':
-                gene = r[ebl.BedCols.GENE]
-                tx = r[ebl.BedCols.ENSEMBL_ID]
-                r_by_tx_by_gene[gene][tx].append(r.fields)
 
-        with file_transaction(work_dir, self.wgs_bed_fpath) as tx:
-            with open(tx, 'w') as out:
-                for gname, r_by_tx in r_by_tx_by_gene.items():
-                    all_tx = (x for xx in r_by_tx.values() for x in xx if x[ebl.BedCols.FEATURE] == 'transcript')
-                    tx_sorted_list = [x[ebl.BedCols.ENSEMBL_ID] for x in sorted(all_tx, key=tx_priority_sort_key)]
-                    if not tx_sorted_list:
-                        continue
-                    tx_id = tx_sorted_list[0]
-                    for r in sorted(r_by_tx[tx_id], key=get_sort_key(chr_order)):
-                        out.write('\t'.join(str(f) for f in r) + '\n')
-        return self.wgs_bed_fpath
\ No newline at end of file
+def _annotation_stamp(genome):
+    """ Identifies the version of the Ensembl data that regions are annotated with: the path, modification time
+        and size of the Ensembl BED, and a hash of the canonical transcripts files
+    """
+    if genome not in ebl.SUPPORTED_GENOMES:
+        return []
+    ensembl_bed_fpath = ebl.ensembl_bed_fpath(genome)
+    ensembl_stat = os.stat(ensembl_bed_fpath) if isfile(ensembl_bed_fpath) else None
+    canon_fpaths = [f for f in ebl.get_canonical_fpaths(genome) if f]
+    return [ensembl_bed_fpath,
+            ensembl_stat.st_mtime if ensembl_stat else None,
+            ensembl_stat.st_size if ensembl_stat else None,
+            content_hash(canon_fpaths) if canon_fpaths else None]
+
+
+def _write_wgs_regions(work_dir, output_fpath, genome):
+    chr_order = reference_data.get_chrom_order(genome)
+
+    r_by_tx_by_gene = OrderedDefaultDict(lambda: defaultdict(list))
+    all_features = ebl.get_all_features(genome, high_confidence=True)
+
+    debug('Select best transcript to report')
+    for r in all_features:
+        if r[ebl.BedCols.FEATURE] != 'gene':
+            gene = r[ebl.BedCols.GENE]
+            tx = r[ebl.BedCols.ENSEMBL_ID]
+            r_by_tx_by_gene[gene][tx].append(r.fields)
+
+    with file_transaction(work_dir, output_fpath) as tx:
+        with open(tx, 'w') as out:
+            for gname, r_by_tx in r_by_tx_by_gene.items():
+                all_tx = (x for xx in r_by_tx.values() for x in xx if x[ebl.BedCols.FEATURE] == 'transcript')
+                tx_sorted_list = [x[ebl.BedCols.ENSEMBL_ID] for x in sorted(all_tx, key=tx_priority_sort_key)]
+                if not tx_sorted_list:
+                    continue
+                tx_id = tx_sorted_list[0]
+                for r in sorted(r_by_tx[tx_id], key=get_sort_key(chr_order)):
+                    out.write('\t'.join(str(f) for f in r) + '\n')
+    return output_fpath
+
+
+def _write_merged_cds(work_dir, output_fpath, genome):
+    debug('Merging CDS for ' + genome)
+    with file_transaction(work_dir, output_fpath) as tx:
+        ebl.get_merged_cds(genome).saveas(tx)
+    return output_fpath
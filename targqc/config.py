@@ -7,10 +7,14 @@ padding = 200
 depth_thresholds = [1, 5, 10, 20, 50, 100, 250, 500, 1000, 5000, 10000, 50000]
 downsample_fraction = 0.05
 downsample_pairs_num = 5e5
+saturation = False  # library saturation curve; an extra pass over on-target reads, memory grows with library size
+saturation_fractions = [0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 1.0]  # nested subsets for the saturation curve
 genome = 'hg19'
 dedup = True
 
 reuse_intermediate = False
 is_debug = False
 threads = 1
+max_mem = None  # memory budget for local jobs, e.g. '48G'; default is the available memory
+cache_dir = None  # shared cache for prepared panels, e.g. ~/.cache/targqc; falls back to $TARGQC_CACHE_DIR, off if neither is set
 reannotate = False  # reannotate BED even if the number of columns is 4 or higher
\ No newline at end of file
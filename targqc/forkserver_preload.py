@@ -0,0 +1,16 @@
+""" Imported by the fork server that daemon jobs are started from (see targqc.server), so that the jobs start
+with the reference data of the server's default genome loaded. The fork server is started from a fresh
+interpreter, so the server passes the genome in PRELOAD_GENOME_ENV_VAR.
+"""
+import os
+
+PRELOAD_GENOME_ENV_VAR = 'TARGQC_PRELOAD_GENOME'
+
+
+def preload(genome):
+    import targqc.utilz.reference_data as ref
+    ref.get_chrom_lengths(fai_fpath=ref.get_fai(genome))
+
+
+if os.environ.get(PRELOAD_GENOME_ENV_VAR):
+    preload(os.environ[PRELOAD_GENOME_ENV_VAR])
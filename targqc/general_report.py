@@ -1,13 +1,13 @@
 # coding=utf-8
 import os
-from collections import OrderedDict
-from ensembl import get_merged_cds
 from os.path import join, abspath, realpath, dirname, relpath
 from pybedtools import BedTool
+from targqc import config as cfg
+from targqc import saturation
 from targqc.qualimap import report_parser, runner
 from targqc.utilz.bed_utils import get_padded_bed_file, intersect_bed, calc_sum_of_regions, count_bed_cols, \
     calc_bases_within_threshs, calc_rate_within_normal
-from targqc.utilz import reference_data, logger
+from targqc.utilz import reference_data, logger, telemetry
 from targqc.utilz.file_utils import intermediate_fname, verify_file, safe_mkdir, can_reuse
 from targqc.utilz.logger import critical, info, err, warn, debug
 from targqc.utilz.reporting.reporting import ReportSection, Metric, MetricStorage, SampleReport
@@ -66,7 +66,9 @@ def get_header_metric_storage(depth_threshs, is_wgs=False, padding=None):
         name = 'Part of ' + trg_name + ' covered at least by ' + str(depth) + 'x'
         depth_section.add_metric(Metric(name,                             short_name=str(depth) + 'x', multiqc=dict(hidden=True, kind='cov'),                         unit='%', description=name))
     depth_section.add_metric(
-        Metric('Estimated ' + trg_name + ' full coverage depth',          short_name='Est full mean',  multiqc=dict(title='Est mean depth', order=7, kind='cov', min=0), description='Estimated mean coverage of full dataset. Calculated as (the total number of raw reads * downsampled mapped reads fraction / total downsampled mapped reads) * downsampled average coverage'),
+        Metric('Estimated ' + trg_name + ' full coverage depth',          short_name='Est full mean',  multiqc=dict(title='Est mean depth', order=7, kind='cov', min=0), description='Estimated mean coverage of full dataset. Projected from the library saturation curve when available, '
+                                                                                                                                                                                      'otherwise calculated as (the total number of raw reads * downsampled mapped reads fraction / total downsampled mapped reads) * downsampled average coverage'),
+        Metric('Library saturation',                                      short_name='Saturation',     multiqc=dict(hidden=True, kind='cov'),                         unit='%', description='Unique on-' + trg_name + ' reads as a share of the library complexity estimated from the saturation curve'),
     )
     sections.append(depth_section)
 
@@ -115,81 +117,17 @@ def get_header_metric_storage(depth_threshs, is_wgs=False, padding=None):
 #     return bam_stats  # dedup_bam_fpath, bam_stats, dedup_bam_stats
 
 
-def parse_qualimap_insert_size(qualimap_insert_size_fpath):
-    d = dict()
-    zero_insertsize = 0
-    with open(qualimap_insert_size_fpath) as f:
-        for l in f:
-            if not l.strip() or l.startswith('#'):
-                continue
-            insertsize, count = l.split(None, 1)
-            insertsize = int(round(float(insertsize)))
-            count = float(count) / 1000000
-            if insertsize == 0:
-                zero_insertsize = count
-            else:
-                d[insertsize] = count
-
-    # Find median without importing anything to do it for us
-    num_counts = sum(d.values())
-    cum_counts = 0
-    median_insert_size = None
-    for thisins, thiscount in d.items():
-        cum_counts += thiscount
-        if cum_counts >= num_counts/2:
-            median_insert_size = thisins
-            break
-    return median_insert_size
-
-
-def parse_qualimap_gc_content(qualimap_gc_content_fpath):
-    avg_gc = 0
-    avg_human_gc = 0
-    with open(qualimap_gc_content_fpath) as f:
-        for l in f:
-            if l.startswith('#'):
-                continue
-            sections = l.split(None, 3)
-            gc = int(round(float(sections[0])))         # %
-            content = float(sections[1]) / 100.0        # share of reads with this GC %
-            avg_gc += gc * content
-            if len(sections) > 2:
-                human_content = float(sections[2]) / 100.0  # share of human reference with this GC %
-                avg_human_gc += gc * human_content
-    return avg_gc, avg_human_gc
-
-
-def parse_qualimap_coverage_hist(qualimap_coverage_hist_fpath):
-    bases_by_depth = OrderedDict()
-    with open(qualimap_coverage_hist_fpath) as f:
-        for l in f:
-            if l.startswith('#'):
-                pass
-            else:
-                cov, bases = map(int, map(float, l.strip().split()))
-                bases_by_depth[cov] = bases
-
-    # calculating median coverage
-    num_counts = sum(bases_by_depth.values())
-    cum_counts = 0
-    median_coverage = None
-    for thiscov, thiscount in bases_by_depth.items():
-        cum_counts += thiscount
-        if cum_counts >= num_counts/2:
-            median_coverage = thiscov
-            break
-
-    return bases_by_depth, median_coverage
-
-
-def parse_qualimap_results(sample):
-    if not verify_file(sample.qualimap_html_fpath):
-        critical('QualiMap report was not found')
-
-    qualimap_value_by_metric = report_parser.parse_qualimap_sample_report(sample.qualimap_html_fpath)
-    bases_by_depth, median_depth = parse_qualimap_coverage_hist(sample.qualimap_cov_hist_fpath)
-    median_gc, median_human_gc = parse_qualimap_gc_content(sample.qualimap_gc_hist_fpath)
-    median_ins_size = parse_qualimap_insert_size(sample.qualimap_ins_size_hist_fpath)
+@telemetry.profiled('parse_qualimap_results')
+def parse_qualimap_results(sample, qualimap_results=None):
+    """ qualimap_results: output of report_parser.parse_qualimap_outputs for the sample, parsed here if not provided
+    """
+    if qualimap_results is None:
+        qualimap_results = report_parser.parse_qualimap_outputs(*_qualimap_parser_params(sample))
+    qualimap_value_by_metric = qualimap_results['value_by_metric']
+    bases_by_depth = qualimap_results['bases_by_depth']
+    median_depth = qualimap_results['median_depth']
+    median_gc, median_human_gc = qualimap_results['median_gc'], qualimap_results['median_human_gc']
+    median_ins_size = qualimap_results['median_ins_size']
 
     def find_rec(name, percent=False, on_target=True):
         if on_target:
@@ -335,57 +273,84 @@ def get_mean_cov(bedcov_output_fpath):
     return mean_cov
 
 
+def _qualimap_parser_params(sample):
+    return [sample.qualimap_genome_results_fpath, sample.qualimap_html_fpath, sample.qualimap_cov_hist_fpath,
+            sample.qualimap_gc_hist_fpath, sample.qualimap_ins_size_hist_fpath]
+
+
 def _qualimap_outputs(sample):
     return [v for k, v in sample.__dict__.items() if k.startswith('qualimap_') and k.endswith('_fpath')]
 
 
 def make_general_reports(view, samples, target, genome, depth_threshs, bed_padding,
-                         num_pairs_by_sample=None, reuse=False, is_debug=False, reannotate=False, fai_fpath=None):
+                         num_pairs_by_sample=None, reuse=False, is_debug=False, reannotate=False, fai_fpath=None,
+                         saturation_curve=False):
     if all(all(can_reuse(fp, [s.bam, target.qualimap_bed_fpath] if target.bed else s.bam)
                for fp in _qualimap_outputs(s))
            for s in samples):
         debug('All QualiMap files for all samples exist and newer than BAMs and BEDs, reusing')
     else:
         info('Running QualiMap...')
-        view.run(runner.run_qualimap,
-            [[s.work_dir, s.qualimap_dirpath, _qualimap_outputs(s), s.bam, genome, target.qualimap_bed_fpath, view.cores_per_job]
-             for s in samples])
+        with telemetry.timed('qualimap'):
+            view.run_within_memory(runner.run_qualimap,
+                [[s.work_dir, s.qualimap_dirpath, _qualimap_outputs(s), s.bam, genome, target.qualimap_bed_fpath]
+                 for s in samples],
+                [runner.get_qualimap_mem_estimate(s.bam) for s in samples],
+                [runner.QUALIMAP_MIN_HEAP_M + runner.JVM_OVERHEAD_M] * len(samples))
 
         for s in samples:
             for fp in _qualimap_outputs(s):
                 verify_file(fp, is_critical=True)
 
+    if saturation_curve and not target.is_wgs:
+        info('Building saturation curves...')
+        with telemetry.timed('saturation'):
+            view.run(saturation.calc_saturation,
+                [[s.work_dir, s.bam, target.qualimap_bed_fpath, s.targqc_saturation_tsv, cfg.saturation_fractions, s.name]
+                 for s in samples])
+
+    info('Parsing QualiMap results...')
+    with telemetry.timed('parse_qualimap'):
+        qualimap_results_by_sample = view.run(report_parser.parse_qualimap_outputs,
+            [_qualimap_parser_params(s) for s in samples])
+
     summary_reports = []
 
-    for sample in samples:
+    for sample, qualimap_results in zip(samples, qualimap_results_by_sample):
         info('-'*70)
         info(sample.name)
         debug('-'*70)
-        debug('Parsing QualiMap results...')
-        depth_stats, reads_stats, indels_stats, target_stats = parse_qualimap_results(sample)
+        with telemetry.timed('sample_report', sample.name):
+            depth_stats, reads_stats, indels_stats, target_stats = parse_qualimap_results(sample, qualimap_results)
 
-        _prep_report_data(sample, depth_stats, reads_stats, indels_stats, target_stats,
-                          target, num_pairs_by_sample, genome, depth_threshs, fai_fpath=fai_fpath)
+            _prep_report_data(sample, depth_stats, reads_stats, indels_stats, target_stats,
+                              target, num_pairs_by_sample, genome, depth_threshs, fai_fpath=fai_fpath,
+                              saturation_curve=saturation_curve)
 
-        r = _build_report(depth_stats, reads_stats, indels_stats, sample, target,
-                          depth_threshs, bed_padding, sample_num=len(samples), is_debug=is_debug,
-                          reannotate=reannotate)
+            r = _build_report(depth_stats, reads_stats, indels_stats, sample, target,
+                              depth_threshs, bed_padding, sample_num=len(samples), is_debug=is_debug,
+                              reannotate=reannotate)
         summary_reports.append(r)
 
     return summary_reports
 
 
 def _prep_report_data(sample, depth_stats, reads_stats, indels_stats, target_stats,
-                      target, num_pairs_by_sample, genome, depth_threshs, fai_fpath=None):
+                      target, num_pairs_by_sample, genome, depth_threshs, fai_fpath=None, saturation_curve=False):
     sample.avg_depth = depth_stats['ave_depth']
 
+    # a curve left from an earlier run is only used if it's newer than the BAM and BED
+    if saturation_curve and not target.is_wgs and \
+            verify_file(sample.targqc_saturation_tsv, cmp_f=[sample.bam, target.qualimap_bed_fpath], silent=True):
+        depth_stats['saturation'] = saturation.read_saturation(sample.targqc_saturation_tsv)
+
     if num_pairs_by_sample and sample.name in num_pairs_by_sample:
         reads_stats['original_num_reads'] = num_pairs_by_sample[sample.name] * 2
 
     chrom_lengths = reference_data.get_chrom_lengths(genome=genome, fai_fpath=fai_fpath)
     if 'Y' in chrom_lengths or 'chrY' in chrom_lengths:
         reads_stats['gender'] = determine_sex(sample.work_dir, sample.bam, depth_stats['ave_depth'],
-                                              genome, target.get_capture_bed())
+                                              genome, target.capture_bed3_fpath)
         info()
 
     if 'bases_by_depth' in depth_stats:
@@ -410,20 +375,20 @@ def _prep_report_data(sample, depth_stats, reads_stats, indels_stats, target_sta
 
     if not target.is_wgs:
         reads_stats['mapped_dedup_on_target'] = number_mapped_reads_on_target(
-            sample.work_dir, target.get_capture_bed().cut(range(3)).saveas().fn, sample.bam, dedup=True, target_name='target') or 0
+            sample.work_dir, target.capture_bed3_fpath, sample.bam, dedup=True, target_name='target') or 0
 
         reads_stats['mapped_dedup_on_padded_target'] = number_mapped_reads_on_target(
             sample.work_dir, target.padded_bed_fpath, sample.bam, dedup=True, target_name='padded_target') or 0
 
     else:
-        cds_bed = get_merged_cds(genome)
         info('Using the CDS reference BED to calc "reads on CDS"')
         reads_stats['mapped_dedup_on_exome'] = number_mapped_reads_on_target(
-            sample.work_dir, cds_bed, sample.bam, dedup=True, target_name='exome') or 0
+            sample.work_dir, target.cds_bed_fpath, sample.bam, dedup=True, target_name='exome') or 0
 
     return depth_stats, reads_stats, indels_stats
 
 
+@telemetry.profiled('build_report')
 def _build_report(depth_stats, reads_stats, mm_indels_stats, sample, target,
                   depth_threshs, bed_padding, sample_num, is_debug=False, reannotate=False):
     report = SampleReport(sample, metric_storage=get_header_metric_storage(depth_threshs, is_wgs=target.bed_fpath is None, padding=bed_padding))
@@ -536,8 +501,13 @@ def _build_report(depth_stats, reads_stats, mm_indels_stats, sample, target,
     if 'original_num_reads' in reads_stats:
         _add('Original reads', reads_stats['original_num_reads'])
         times_downsampled = 1.0 * reads_stats['original_num_reads'] / reads_stats['total']
-        est_full_cov = times_downsampled * depth_stats['ave_depth']
+        est_full_cov = saturation.project_depth(depth_stats.get('saturation'), times_downsampled,
+                                                observed_depth=depth_stats['ave_depth'])
+        if est_full_cov is None:
+            est_full_cov = times_downsampled * depth_stats['ave_depth']
         _add('Estimated ' + trg_type + ' full coverage depth', est_full_cov)
+    if depth_stats.get('saturation'):
+        _add('Library saturation', saturation.calc_library_saturation(depth_stats['saturation']))
     _add('Median ' + trg_type + ' coverage depth', depth_stats['median_depth'])
     if depth_stats['median_depth'] > 0:
         _add('Std. dev. of ' + trg_type + ' coverage depth', depth_stats['stddev_depth'])
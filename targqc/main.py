@@ -2,16 +2,10 @@ import os
 import targqc.utilz.reference_data as ref
 from os.path import join, splitext, dirname
 from targqc import config
-from targqc.Target import Target
-from targqc.fastq import proc_fastq
-from targqc.general_report import make_general_reports
-from targqc.region_coverage import make_region_reports
-from targqc.summarize import make_tarqc_html_report, combined_regional_reports
 from targqc.utilz.Sample import BaseSample
-from targqc.utilz import logger
+from targqc.utilz import logger, telemetry
 from targqc.utilz.file_utils import safe_mkdir, can_reuse
 from targqc.utilz.logger import info, critical, debug
-from targqc.utilz.sambamba import index_bam, sort_bam
 
 targqc_repr              = 'TargQC'
 targqc_name              = 'targqc'
@@ -35,10 +29,14 @@ fastqc_repr              = 'FastQC'
 fastqc_report_fname      = 'fastqc_report.html'
 
 
-from targqc.general_report import get_mean_cov as get_mean_cov
 from .config import depth_thresholds
 
 
+def get_mean_cov(bedcov_output_fpath):
+    from targqc.general_report import get_mean_cov as _get_mean_cov
+    return _get_mean_cov(bedcov_output_fpath)
+
+
 def get_version():
     from targqc import version
     return version.__version__
@@ -59,25 +57,59 @@ def start_targqc(work_dir, output_dir, samples, target_bed_fpath, parallel_cfg,
                  downsample_to=config.downsample_fraction,
                  padding=config.padding,
                  dedup=config.dedup,
+                 saturation=config.saturation,
                  num_pairs_by_sample=None,
                  reannotate=config.reannotate,
+                 cache_dir=None,
+                 profile=False,
+                 profile_python=False,
+                 target=None,
+                 results_db_fpath=None,
+                 append=False,
+                 compact_html=None,
                  ):
+    """ profile: write a Chrome trace of the run into <output_dir>/trace.json
+        profile_python: also dump cProfile stats of the Python stages into <output_dir>/profile
+        target: already prepared Target for target_bed_fpath (used by the daemon mode)
+        results_db_fpath: SQLite database to add the results of the run to (see utilz/results_db.py)
+        append: add the samples to the cohort already summarized in output_dir. Only the samples passed are
+                processed, and the summary reports are updated to include both the old and the new samples.
+        compact_html: see make_tarqc_html_report
+        saturation: build library saturation curves (see saturation.py), off by default as it takes
+                    another pass over the reads and memory proportional to the number of distinct fragments
+    """
+    # The pipeline is imported here rather than at the top, so that the command line starts fast
+    # (pybedtools, numpy, the Ensembl and reporting modules take seconds to import)
+    from targqc.Target import Target
+    from targqc.fastq import proc_fastq
+    from targqc.general_report import make_general_reports
+    from targqc.region_coverage import make_region_reports
+    from targqc.summarize import make_tarqc_html_report, combined_regional_reports, load_summary_state, \
+        save_summary_state, get_cohort
+    from targqc.utilz.sambamba import index_bam, sort_bam, SORT_MEM_M, SORT_MIN_MEM_M
+    import ensembl as ebl
+
     d = get_description()
     info('*'*len(d))
     info(d)
     info('*'*len(d))
     info()
+    telemetry.init(work_dir, profile_dirpath=join(output_dir, 'profile') if profile_python else None)
+    ebl.set_canonical_index_dirs(cache_dir=cache_dir, work_dir=work_dir)
 
     fai_fpath = fai_fpath or ref.get_fai(genome)
-    target = Target(work_dir, output_dir, fai_fpath, padding=padding, bed_fpath=target_bed_fpath,
-         reannotate=reannotate, genome=genome, is_debug=logger.is_debug)
+    if target is None:
+        with telemetry.timed('prepare_target'):
+            target = Target(work_dir, output_dir, fai_fpath, padding=padding, bed_fpath=target_bed_fpath,
+                 reannotate=reannotate, genome=genome, is_debug=logger.is_debug, cache_dir=cache_dir)
 
     fastq_samples = [s for s in samples if not s.bam and s.l_fpath and s.r_fpath]
     from targqc.utilz.parallel import parallel_view
     if fastq_samples:
         if not bwa_prefix:
             critical('--bwa-prefix is required when running from fastq')
-        with parallel_view(len(fastq_samples), parallel_cfg, join(work_dir, 'sge_fastq')) as view:
+        with parallel_view(len(fastq_samples), parallel_cfg, join(work_dir, 'sge_fastq'),
+                           [s.name for s in fastq_samples]) as view, telemetry.timed('fastq'):
             num_pairs_by_sample = proc_fastq(fastq_samples, view, work_dir, bwa_prefix,
                 downsample_to, num_pairs_by_sample, dedup=dedup)
 
@@ -86,9 +118,11 @@ def start_targqc(work_dir, output_dir, samples, target_bed_fpath, parallel_cfg,
         if s.bam:
             info(s.name + ': using alignment ' + s.bam)
 
-    with parallel_view(len(samples), parallel_cfg, join(work_dir, 'sge_bam')) as view:
+    with parallel_view(len(samples), parallel_cfg, join(work_dir, 'sge_bam'), [s.name for s in samples]) as view:
         info('Sorting BAMs...')
-        sorted_bams = view.run(sort_bam, [[s.bam, safe_mkdir(join(work_dir, s.name))] for s in samples])
+        with telemetry.timed('sort_bams'):
+            sorted_bams = view.run_within_memory(sort_bam, [[s.bam, safe_mkdir(join(work_dir, s.name))] for s in samples],
+                                                 [SORT_MEM_M] * len(samples), [SORT_MIN_MEM_M] * len(samples))
         for s, sorted_bam in zip(samples, sorted_bams):
             s.bam = sorted_bam
 
@@ -96,27 +130,52 @@ def start_targqc(work_dir, output_dir, samples, target_bed_fpath, parallel_cfg,
             debug('BAM indexes exists')
         else:
             info('Indexing BAMs...')
-            view.run(index_bam, [[s.bam] for s in samples])
+            with telemetry.timed('index_bams'):
+                view.run(index_bam, [[s.bam] for s in samples])
 
         info('Making general reports...')
-        make_general_reports(view, samples, target, genome, depth_threshs, padding, num_pairs_by_sample,
-                             is_debug=logger.is_debug, reannotate=reannotate, fai_fpath=fai_fpath)
+        with telemetry.timed('general_reports'):
+            make_general_reports(view, samples, target, genome, depth_threshs, padding, num_pairs_by_sample,
+                                 is_debug=logger.is_debug, reannotate=reannotate, fai_fpath=fai_fpath,
+                                 saturation_curve=saturation)
 
     info()
     info('*' * 70)
-    tsv_fpath, html_fpath = make_tarqc_html_report(output_dir, work_dir, samples, bed_fpath=target_bed_fpath)
+    with telemetry.timed('summary_report'):
+        summary_state = load_summary_state(output_dir)
+        cohort = get_cohort(output_dir, work_dir, samples, summary_state) if append else samples
+        if append:
+            info('Summarizing ' + str(len(cohort)) + ' samples, ' + str(len(samples)) + ' of them new or updated')
+        tsv_fpath, html_fpath = make_tarqc_html_report(output_dir, work_dir, cohort, bed_fpath=target_bed_fpath,
+                                                       compact_html=compact_html)
     info('TargQC summary saved in: ')
     info('  ' + html_fpath)
     info('  ' + tsv_fpath)
 
     info()
-    with parallel_view(len(samples), parallel_cfg, join(work_dir, 'sge_bam')) as view:
+    with parallel_view(len(samples), parallel_cfg, join(work_dir, 'sge_bam'), [s.name for s in samples]) as view:
         info('Making region-level reports...')
-        make_region_reports(view, work_dir, samples, target, genome, depth_threshs)
+        with telemetry.timed('region_reports'):
+            make_region_reports(view, work_dir, samples, target, genome, depth_threshs, is_debug=logger.is_debug)
+
+    info()
+    info('*' * 70)
+    with telemetry.timed('combined_region_report'):
+        tsv_region_rep_fpath = combined_regional_reports(work_dir, output_dir, cohort, summary_state, append=append)
+        save_summary_state(output_dir, summary_state)
+
+    if results_db_fpath:
+        from targqc.utilz import results_db
+        with parallel_view(len(samples), parallel_cfg, join(work_dir, 'sge_bam'), [s.name for s in samples]) as view, \
+                telemetry.timed('results_db'):
+            results_db.save_results(view, results_db_fpath, output_dir, samples, target_bed_fpath, genome,
+                                    depth_threshs, version=get_version())
 
     info()
     info('*' * 70)
-    tsv_region_rep_fpath = combined_regional_reports(work_dir, output_dir, samples)
+    telemetry.write_summary(join(output_dir, 'telemetry.json'))
+    if profile or profile_python:
+        telemetry.write_chrome_trace(join(output_dir, 'trace.json'))
 
     info()
     info('*' * 70)
@@ -140,10 +199,11 @@ class Sample(BaseSample):
         self.targqc_json_fpath           = join(self.targqc_dirpath, 'summary.json')
         self.targqc_region_txt           = join(self.targqc_dirpath, 'regions.txt')
         self.targqc_region_tsv           = join(self.targqc_dirpath, 'regions.tsv')
+        self.targqc_saturation_tsv       = join(self.targqc_dirpath, 'saturation.tsv')
 
         self.qualimap_dirpath = join(self.targqc_dirpath, 'qualimap')
         self.qualimap_html_fpath            = join(self.qualimap_dirpath, qualimap_report_fname)
-        self.qualimap_genome_results_fpath  = join(self.qualimap_dirpath, qualimap_report_fname)
+        self.qualimap_genome_results_fpath  = join(self.qualimap_dirpath, qualimap_genome_results_fname)
         self.qualimap_raw_dirpath           = join(self.qualimap_dirpath, qualimap_raw_data_dirname)
         self.qualimap_ins_size_hist_fpath   = join(self.qualimap_raw_dirpath, qualimap_ishist_fname)
         self.qualimap_cov_hist_fpath        = join(self.qualimap_raw_dirpath, qualimap_covhist_fname)
@@ -168,7 +228,7 @@ class OldStyleSample(BaseSample):
 
         self.qualimap_dirpath = join(self.targqc_dirpath, 'qualimap')
         self.qualimap_html_fpath            = join(self.qualimap_dirpath, qualimap_report_fname)
-        self.qualimap_genome_results_fpath  = join(self.qualimap_dirpath, qualimap_report_fname)
+        self.qualimap_genome_results_fpath  = join(self.qualimap_dirpath, qualimap_genome_results_fname)
         self.qualimap_raw_dirpath           = join(self.qualimap_dirpath, qualimap_raw_data_dirname)
         self.qualimap_ins_size_hist_fpath   = join(self.qualimap_raw_dirpath, qualimap_ishist_fname)
         self.qualimap_cov_hist_fpath        = join(self.qualimap_raw_dirpath, qualimap_covhist_fname)
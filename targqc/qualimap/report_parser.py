@@ -1,4 +1,10 @@
-from targqc.utilz.logger import warn
+import re
+from collections import OrderedDict
+
+import numpy as np
+
+from targqc.utilz.file_utils import verify_file
+from targqc.utilz.logger import warn, critical
 
 metric_names = [
     'Reference size',
@@ -42,7 +48,9 @@ metric_names = [
 ALLOWED_UNITS = ['%']
 
 
-def parse_qualimap_sample_report(report_fpath):
+def parse_qualimap_sample_report(report_fpath, stop_after_metrics=None):
+    """ Scrapes metrics from qualimapReport.html. Stops reading once all of stop_after_metrics are found.
+    """
     value_by_metric = dict()
 
     def __get_td_tag_contents(line):
@@ -160,5 +168,167 @@ def parse_qualimap_sample_report(report_fpath):
             if cur_metric_name and line.find('class=column2') != -1:
                 __fill_record(cur_metric_name, line)
                 cur_metric_name = None
+                if stop_after_metrics and all(m in value_by_metric for m in stop_after_metrics):
+                    break
 
     return value_by_metric
+
+
+# (section, key) in genome_results.txt -> metric name as in the HTML report;
+# sections with the " inside" suffix hold the on-target values
+genome_results_metrics = {
+    ('Reference',             'number of bases'):                      'Reference size',
+    ('Globals',               'regions size'):                         'Regions size/percentage of reference',
+    ('Globals',               'number of reads'):                      'Number of reads',
+    ('Globals',               'number of mapped reads'):               'Mapped reads',
+    ('Globals',               'number of duplicated reads (flagged)'): 'Duplicated reads (flagged)',
+    ('Mapping quality',       'mean mapping quality'):                 'Mean Mapping Quality',
+    ('Mismatches and indels', 'number of mismatches'):                 'Mismatches',
+    ('Mismatches and indels', 'number of insertions'):                 'Insertions',
+    ('Mismatches and indels', 'number of deletions'):                  'Deletions',
+    ('Mismatches and indels', 'homopolymer indels'):                   'Homopolymer indels',
+    ('Coverage',              'mean coverageData'):                    'Coverage Mean',
+    ('Coverage',              'std coverageData'):                     'Coverage Standard Deviation',
+}
+# metrics that only the HTML report has
+html_only_metric_names = [
+    'Read min length',
+    'Read max length',
+    'Read mean length',
+    'Paired reads',
+]
+
+_VALUE_RE = re.compile(r'^([0-9][0-9,]*(?:\.[0-9]+)?)\s*(bp|X|%)?\s*(?:\(([0-9.]+)%\))?')
+
+
+def _parse_value(val):
+    """ "1,234 (97.24%)" -> (1234, 0.9724), "12.4X" -> (12.4, None), "53.8%" -> (0.538, None)
+    """
+    m = _VALUE_RE.match(val)
+    if not m:
+        return None, None
+    num, unit, pct = m.groups()
+    num = num.replace(',', '')
+    num = float(num) if '.' in num else int(num)
+    if unit == '%':
+        num = float(num) / 100
+    return num, float(pct) / 100 if pct else None
+
+
+def parse_genome_results(genome_results_fpath):
+    """ Reads QualiMap genome_results.txt into a dict with the same metric names as parse_qualimap_sample_report
+    """
+    value_by_metric = dict()
+    paired_by_section = dict()
+    section = None
+    suffix = ''
+    with open(genome_results_fpath) as f:
+        for line in f:
+            if line.startswith('>>>'):
+                section = line.strip('> \n')
+                suffix = ''
+                if section.endswith(' inside'):
+                    section = section[:-len(' inside')]
+                    suffix = ' (on target)'
+                continue
+            key, sep, val = line.partition(' = ')
+            if not sep or section is None:
+                continue
+            key = key.strip()
+            if key == 'percentage of reference':
+                value_by_metric['Regions size/percentage of reference' + suffix + ' %'] = _parse_value(val.strip())[0]
+                continue
+            if key in ('number of mapped paired reads (first in pair)', 'number of mapped paired reads (second in pair)') \
+                    and section == 'Globals':
+                paired_by_section[suffix] = paired_by_section.get(suffix, 0) + (_parse_value(val.strip())[0] or 0)
+                continue
+            metric_name = genome_results_metrics.get((section, key))
+            if not metric_name:
+                continue
+            num, pct = _parse_value(val.strip())
+            if num is None:
+                continue
+            value_by_metric[metric_name + suffix] = num
+            if pct is not None:
+                value_by_metric[metric_name + suffix + ' %'] = pct
+
+    total, mapped = value_by_metric.get('Number of reads'), value_by_metric.get('Mapped reads')
+    for suffix in ['', ' (on target)']:
+        if suffix in paired_by_section:
+            value_by_metric['Mapped paired reads' + suffix] = paired_by_section[suffix]
+        for name in ['Duplicated reads (flagged)', 'Mapped paired reads']:
+            if name + suffix in value_by_metric and total:  # percentages of all reads, as in the HTML report
+                value_by_metric[name + suffix + ' %'] = 1.0 * value_by_metric[name + suffix] / total
+    if total is not None and mapped is not None:
+        value_by_metric['Unmapped reads'] = total - mapped
+        if total:
+            value_by_metric['Unmapped reads %'] = 1.0 * (total - mapped) / total
+    return value_by_metric
+
+
+def read_histogram(hist_fpath):
+    """ Numeric columns of a QualiMap raw_data histogram as a 2-d float array
+    """
+    with open(hist_fpath) as f:
+        rows = [l.split() for l in f if l.strip() and not l.startswith('#')]
+    if not rows:
+        return np.zeros((0, 2))
+    ncols = min(len(r) for r in rows)
+    return np.array([r[:ncols] for r in rows], dtype=float)
+
+
+def _first_over_half(values, counts):
+    if not len(counts):
+        return None
+    cum_counts = np.cumsum(counts)
+    return values[int(np.searchsorted(cum_counts, cum_counts[-1] / 2.0))]
+
+
+def parse_coverage_hist(hist):
+    depths = hist[:, 0].astype(np.int64)
+    bases = hist[:, 1].astype(np.int64)
+    bases_by_depth = OrderedDict(zip(depths.tolist(), bases.tolist()))
+    median_depth = _first_over_half(depths, bases)
+    return bases_by_depth, int(median_depth) if median_depth is not None else None
+
+
+def parse_gc_content_hist(hist):
+    gc = np.round(hist[:, 0])
+    avg_gc = float(np.sum(gc * hist[:, 1] / 100.0))
+    avg_human_gc = float(np.sum(gc * hist[:, 2] / 100.0)) if hist.shape[1] > 2 else 0
+    return avg_gc, avg_human_gc
+
+
+def parse_insert_size_hist(hist):
+    sizes = np.round(hist[:, 0]).astype(np.int64)
+    nonzero = sizes != 0
+    median_ins_size = _first_over_half(sizes[nonzero], hist[nonzero, 1])
+    return int(median_ins_size) if median_ins_size is not None else None
+
+
+def parse_qualimap_outputs(genome_results_fpath, html_fpath, cov_hist_fpath, gc_hist_fpath, ins_size_hist_fpath):
+    """ Loads all QualiMap outputs of a sample. genome_results.txt is preferred over the HTML report,
+        which is only read for the metrics missing in genome_results.txt (read lengths and paired reads)
+        or when genome_results.txt doesn't exist.
+    """
+    if verify_file(genome_results_fpath, silent=True):
+        value_by_metric = parse_genome_results(genome_results_fpath)
+        if any(m not in value_by_metric for m in html_only_metric_names) and verify_file(html_fpath, silent=True):
+            for m, v in parse_qualimap_sample_report(html_fpath, stop_after_metrics=html_only_metric_names).items():
+                value_by_metric.setdefault(m, v)
+    elif verify_file(html_fpath):
+        value_by_metric = parse_qualimap_sample_report(html_fpath)
+    else:
+        critical('QualiMap report was not found')
+
+    bases_by_depth, median_depth = parse_coverage_hist(read_histogram(cov_hist_fpath))
+    median_gc, median_human_gc = parse_gc_content_hist(read_histogram(gc_hist_fpath))
+    median_ins_size = parse_insert_size_hist(read_histogram(ins_size_hist_fpath))
+    return dict(
+        value_by_metric = value_by_metric,
+        bases_by_depth  = bases_by_depth,
+        median_depth    = median_depth,
+        median_gc       = median_gc,
+        median_human_gc = median_human_gc,
+        median_ins_size = median_ins_size,
+    )
@@ -13,12 +13,23 @@ from targqc.utilz.reporting.reporting import write_tsv_rows
 from targqc.utilz.sambamba import sort_bam
 
 
+QUALIMAP_MIN_HEAP_M = 1200
+QUALIMAP_MAX_HEAP_M = 16000
+JVM_OVERHEAD_M = 512  # JVM memory used on top of the heap
+
+
 def get_qualimap_max_mem(bam):
     mem_m = getsize(bam) / 3 / 1024 / 1024
-    mem_m = min(max(mem_m, 1200), 16000)
+    mem_m = min(max(mem_m, QUALIMAP_MIN_HEAP_M), QUALIMAP_MAX_HEAP_M)
     return mem_m
 
 
+def get_qualimap_mem_estimate(bam):
+    """ Memory of the QualiMap process in megabytes: the heap plus the JVM overhead
+    """
+    return int(get_qualimap_max_mem(bam)) + JVM_OVERHEAD_M
+
+
 def find_executable():
     executable = which('qualimap')
     if not executable:
@@ -26,15 +37,21 @@ def find_executable():
     return executable
 
 
-def run_qualimap(work_dir, output_dir, output_fpaths, bam_fpath, genome, bed_fpath=None, threads=1):
+def run_qualimap(work_dir, output_dir, output_fpaths, bam_fpath, genome, bed_fpath=None, threads=1, mem_m=None):
+    """ mem_m: total memory for the process in megabytes (see get_qualimap_mem_estimate),
+        by default estimated from the BAM size
+    """
     info('Analysing ' + bam_fpath)
 
     safe_mkdir(dirname(output_dir))
     safe_mkdir(output_dir)
 
     mem_cmdl = ''
-    mem_m = get_qualimap_max_mem(bam_fpath)
-    mem = str(int(mem_m)) + 'M'
+    if mem_m:
+        heap_m = max(mem_m - JVM_OVERHEAD_M, QUALIMAP_MIN_HEAP_M)
+    else:
+        heap_m = get_qualimap_max_mem(bam_fpath)
+    mem = str(int(heap_m)) + 'M'
     mem_cmdl = '--java-mem-size=' + mem
 
     cmdline = (find_executable() + ' bamqc --skip-duplicated -nt {threads} {mem_cmdl} -nr 5000 '
@@ -60,7 +77,7 @@ def run_qualimap(work_dir, output_dir, output_fpaths, bam_fpath, genome, bed_fpa
             if 'The alignment file is unsorted.' in e.output:
                 info()
                 info('BAM file is unsorted; trying to sort and rerun QualiMap')
-                sorted_bam_fpath = sort_bam(bam_fpath)
+                sorted_bam_fpath = sort_bam(bam_fpath, work_dir, threads=threads)
                 cmdline = cmdline.replace(bam_fpath, sorted_bam_fpath)
                 run(cmdline, env_vars=dict(DISPLAY=None))
 
@@ -94,13 +111,25 @@ def fix_bed_for_qualimap(bed_fpath, qualimap_bed_fpath):
             out.write('\t'.join(fields) + '\n')
 
 
+PLOTS_SAMPLES_FNAME = '.samples'  # names of the samples the plots were made for
+
+
+def _read_plots_samples(plots_dirpath):
+    fpath = join(plots_dirpath, PLOTS_SAMPLES_FNAME)
+    if not isfile(fpath):
+        return None
+    with open(fpath) as f:
+        return [l.rstrip('\n') for l in f]
+
+
 def run_multisample_qualimap(output_dir, work_dir, samples, targqc_full_report):
     """ 1. Generates Qualimap2 plots and put into plots_dirpath
         2. Adds records to targqc_full_report.plots
+        Existing plots are reused if they were made for the same samples, and after their reports.
     """
     plots_dirpath = join(output_dir, 'plots')
     individual_report_fpaths = [s.qualimap_html_fpath for s in samples]
-    if isdir(plots_dirpath) and not any(
+    if isdir(plots_dirpath) and _read_plots_samples(plots_dirpath) == [s.name for s in samples] and not any(
             not can_reuse(join(plots_dirpath, f), individual_report_fpaths)
             for f in listdir(plots_dirpath) if not f.startswith('.')):
         debug('Qualimap miltisample plots exist - ' + plots_dirpath + ', reusing...')
@@ -132,6 +161,8 @@ def run_multisample_qualimap(output_dir, work_dir, samples, targqc_full_report):
                     if exists(plots_dirpath):
                         shutil.rmtree(plots_dirpath)
                     shutil.move(qualimap_plots_dirpath, plots_dirpath)
+                    with open(join(plots_dirpath, PLOTS_SAMPLES_FNAME), 'w') as f:
+                        f.writelines(s.name + '\n' for s in samples)
             else:
                 warn('Warning: Qualimap for multi-sample analysis was not found. TargQC will not contain plots.')
                 return None
@@ -2,17 +2,17 @@
 
 import ensembl as ebl
 from collections import defaultdict
-from os.path import isfile, join
+from os.path import isfile, join, basename
 from targqc.utilz.bed_utils import count_bed_cols
-from targqc.utilz import reference_data
+from targqc.utilz import reference_data, telemetry
 from targqc.utilz.call_process import run
-from targqc.utilz.file_utils import intermediate_fname, verify_file, file_transaction, can_reuse
+from targqc.utilz.file_utils import intermediate_fname, verify_file, file_transaction, can_reuse, splitext_plus
 from targqc.utilz.logger import info, debug
-from targqc.utilz.sambamba import sambamba_depth
+from targqc.utilz.sambamba import sambamba_depth_stream
 from targqc.utilz.utils import OrderedDefaultDict
 
 
-def make_region_reports(view, work_dir, samples, target, genome, depth_thresholds):
+def make_region_reports(view, work_dir, samples, target, genome, depth_thresholds, is_debug=False):
     bed_fpath = target.bed_fpath or target.wgs_bed_fpath
 
     if all(can_reuse(s.targqc_region_tsv, [s.bam, bed_fpath]) for s in samples):
@@ -26,25 +26,59 @@ def make_region_reports(view, work_dir, samples, target, genome, depth_threshold
         depth_thresholds_by_sample[s.name] = depth_thresholds
 
     debug()
-    debug('Running sambamba...')
-    sambamba_depth_output_fpaths = view.run(sambamba_depth,
-        [[s.work_dir, bed_fpath, s.bam, depth_thresholds_by_sample[s.name], None, s.name]
+    debug('Running sambamba and writing results...')
+    view.run(_make_region_report,
+        [[s.work_dir, bed_fpath, s.bam, s.name, depth_thresholds_by_sample[s.name], s.targqc_region_tsv, is_debug]
          for s in samples])
-    assert len(sambamba_depth_output_fpaths) == len(samples), \
-        'Number of sambamba results = ' + str(len(sambamba_depth_output_fpaths)) + \
-        ' which is less then the number of samples ' + str(len(samples))
-
-    debug()
-    debug('Parsing sambamba results and writing results...')
-    view.run(_proc_sambamba_depth,
-        [[sambamba_output_fpath, s.targqc_region_tsv, s.name, depth_thresholds_by_sample[s.name]]
-         for sambamba_output_fpath, s in zip(sambamba_depth_output_fpaths, samples)])
 
     info('Done.')
     return [s.targqc_region_tsv for s in samples]
 
 
+@telemetry.profiled('make_region_report')
+def _make_region_report(work_dir, bed_fpath, bam, sample_name, depth_thresholds, output_fpath,
+                        keep_depth_output=False):
+    """ Pipes the output of "sambamba depth region" straight into the region report writer, without
+        saving the sambamba table. With keep_depth_output (in debug mode), the table is saved into work_dir as well.
+    """
+    if can_reuse(output_fpath, [bam, bed_fpath]):
+        return output_fpath
+
+    debug('Reading coverage statistics from sambamba and writing regions to ' + output_fpath)
+    raw_fpath = None
+    if keep_depth_output:
+        raw_fpath = join(work_dir, splitext_plus(basename(bed_fpath))[0] + '_' + sample_name + '_sambamba_depth.txt')
+    with file_transaction(None, output_fpath) as tx:
+        with sambamba_depth_stream(bed_fpath, bam, depth_thresholds) as depth_lines, open(tx, 'w') as out:
+            if raw_fpath:
+                with file_transaction(None, raw_fpath) as tx_raw, open(tx_raw, 'w') as raw_out:
+                    _write_region_report(_tee(depth_lines, raw_out), out, depth_thresholds)
+            else:
+                _write_region_report(depth_lines, out, depth_thresholds)
+    return output_fpath
+
+
+def _tee(lines, f):
+    for l in lines:
+        f.write(l)
+        yield l
+
+
+@telemetry.profiled('proc_sambamba_depth')
 def _proc_sambamba_depth(sambamba_depth_output_fpath, output_fpath, sample_name, depth_thresholds):
+    if can_reuse(output_fpath, sambamba_depth_output_fpath):
+        return output_fpath
+
+    debug('Reading coverage statistics and writing regions to ' + output_fpath)
+    with file_transaction(None, output_fpath) as tx:
+        with open(sambamba_depth_output_fpath) as sambabma_depth_file, open(tx, 'w') as out:
+            _write_region_report(sambabma_depth_file, out, depth_thresholds)
+    return output_fpath
+
+
+def _write_region_report(depth_lines, out, depth_thresholds):
+    """ Converts lines of "sambamba depth region" output into the region report, written into the out file
+    """
     read_count_col = None
     mean_cov_col = None
     median_cov_col = None
@@ -52,99 +86,90 @@ def _proc_sambamba_depth(sambamba_depth_output_fpath, output_fpath, sample_name,
     std_dev_col = None
     wn_20_pcnt_col = None
 
-    regions_by_genekey = defaultdict(list)
-    #####################################
-    #####################################
-    if can_reuse(output_fpath, sambamba_depth_output_fpath):
-        return output_fpath
-
-    debug('Reading coverage statistics and writing regions to ' + output_fpath)
-
     def write_line(f, fields):
         f.write('\t'.join(fields) + '\n')
 
-    with file_transaction(None, output_fpath) as tx:
-        with open(sambamba_depth_output_fpath) as sambabma_depth_file, open(tx, 'w') as out:
-            total_regions_count = 0
-            for line in sambabma_depth_file:
-                fs = line.strip('\n').split('\t')
-                if line.startswith('#'):
-                    fs = line.split('\t')
-                    read_count_col = fs.index('readCount') + 1
-                    mean_cov_col = fs.index('meanCoverage') + 1
-                    #median_cov_col = fs.index('medianCoverage') if 'medianCoverage' in fs else None
-                    #min_depth_col = fs.index('minDepth') if 'minDepth' in fs else None
-                    #std_dev_col = fs.index('stdDev') if 'stdDev' in fs else None
-                    #wn_20_pcnt_col = fs.index('percentWithin20PercentOfMedian') if 'percentWithin20PercentOfMedian' in fs else None
-
-                    write_line(out, [
-                        'chrom',
-                        'start',
-                        'end',
-                        'size',
-                        'gene',
-                        'exon',
-                        'strand',
-                        'feature',
-                        'biotype',
-                        'transcript',
-                        'trx_overlap',
-                        'exome_overlap',
-                        'cds_overlap',
-                        # 'min_depth',
-                        'avg_depth',
-                        # 'median_depth',
-                        # 'std_dev',
-                        # 'within_20pct_of_median',
-                    ] + ['at{}x'.format(ths) for ths in depth_thresholds])
-                    continue
-
-                chrom = fs[0]
-                start, end = int(fs[1]), int(fs[2])
-                region_size = end - start
-                gene_name = fs[ebl.BedCols.GENE] if read_count_col != ebl.BedCols.GENE else '.'
-                exon = fs[ebl.BedCols.EXON]
-                strand = fs[ebl.BedCols.STRAND]
-                feature = fs[ebl.BedCols.FEATURE]
-                biotype = fs[ebl.BedCols.BIOTYPE]
-                transcript = fs[ebl.BedCols.ENSEMBL_ID]
-                transcript_overlap = fs[ebl.BedCols.TX_OVERLAP_PERCENTAGE]
-                exome_overlap = fs[ebl.BedCols.EXON_OVERLAPS_PERCENTAGE]
-                cds_overlap = fs[ebl.BedCols.CDS_OVERLAPS_PERCENTAGE]
-                avg_depth = float(fs[mean_cov_col])
-                # min_depth = int(fs[min_depth_col]) if min_depth_col is not None else '.'
-                # std_dev = float(fs[std_dev_col]) if std_dev_col is not None else '.'
-                # median_depth = int(fs[median_cov_col]) if median_cov_col is not None else '.'
-                # rate_within_normal = float(fs[wn_20_pcnt_col]) if wn_20_pcnt_col is not None else '.'
-                last_cov_col = max(mean_cov_col or 0, median_cov_col or 0, std_dev_col or 0, wn_20_pcnt_col or 0)
-                rates_within_threshs = fs[last_cov_col+1:-1]
-
-                write_line(out, [str(v) if v not in ['', None, '.'] else '.' for v in [
-                        chrom,
-                        start,
-                        end,
-                        region_size,
-                        gene_name,
-                        exon,
-                        strand,
-                        feature,
-                        biotype,
-                        transcript,
-                        ((transcript_overlap + '%') if transcript_overlap not in ['', None, '.'] else '.'),
-                        ((exome_overlap + '%') if exome_overlap not in ['', None, '.'] else '.'),
-                        ((cds_overlap + '%') if cds_overlap not in ['', None, '.'] else '.'),
-                        # min_depth,
-                        avg_depth,
-                        # median_depth,
-                        # std_dev,
-                        # rate_within_normal,
-                    ] + rates_within_threshs])
-
-                total_regions_count += 1
-                if total_regions_count > 0 and total_regions_count % 10000 == 0:
-                    debug('  Processed {0:,} regions'.format(total_regions_count))
-        debug('Total regions: ' + str(len(regions_by_genekey)))
-    return output_fpath
+    total_regions_count = 0
+    for line in depth_lines:
+        fs = line.strip('\n').split('\t')
+        if line.startswith('#'):
+            fs = line.split('\t')
+            read_count_col = fs.index('readCount') + 1
+            mean_cov_col = fs.index('meanCoverage') + 1
+            #median_cov_col = fs.index('medianCoverage') if 'medianCoverage' in fs else None
+            #min_depth_col = fs.index('minDepth') if 'minDepth' in fs else None
+            #std_dev_col = fs.index('stdDev') if 'stdDev' in fs else None
+            #wn_20_pcnt_col = fs.index('percentWithin20PercentOfMedian') if 'percentWithin20PercentOfMedian' in fs else None
+
+            write_line(out, [
+                'chrom',
+                'start',
+                'end',
+                'size',
+                'gene',
+                'exon',
+                'strand',
+                'feature',
+                'biotype',
+                'transcript',
+                'trx_overlap',
+                'exome_overlap',
+                'cds_overlap',
+                # 'min_depth',
+                'avg_depth',
+                # 'median_depth',
+                # 'std_dev',
+                # 'within_20pct_of_median',
+            ] + ['at{}x'.format(ths) for ths in depth_thresholds])
+            continue
+
+        chrom = fs[0]
+        start, end = int(fs[1]), int(fs[2])
+        region_size = end - start
+        gene_name = fs[ebl.BedCols.GENE] if read_count_col != ebl.BedCols.GENE else '.'
+        exon = fs[ebl.BedCols.EXON]
+        strand = fs[ebl.BedCols.STRAND]
+        feature = fs[ebl.BedCols.FEATURE]
+        biotype = fs[ebl.BedCols.BIOTYPE]
+        transcript = fs[ebl.BedCols.ENSEMBL_ID]
+        transcript_overlap = fs[ebl.BedCols.TX_OVERLAP_PERCENTAGE]
+        exome_overlap = fs[ebl.BedCols.EXON_OVERLAPS_PERCENTAGE]
+        cds_overlap = fs[ebl.BedCols.CDS_OVERLAPS_PERCENTAGE]
+        avg_depth = float(fs[mean_cov_col])
+        # min_depth = int(fs[min_depth_col]) if min_depth_col is not None else '.'
+        # std_dev = float(fs[std_dev_col]) if std_dev_col is not None else '.'
+        # median_depth = int(fs[median_cov_col]) if median_cov_col is not None else '.'
+        # rate_within_normal = float(fs[wn_20_pcnt_col]) if wn_20_pcnt_col is not None else '.'
+        last_cov_col = max(mean_cov_col or 0, median_cov_col or 0, std_dev_col or 0, wn_20_pcnt_col or 0)
+        rates_within_threshs = fs[last_cov_col+1:-1]
+
+        write_line(out, [str(v) if v not in ['', None, '.'] else '.' for v in [
+                chrom,
+                start,
+                end,
+                region_size,
+                gene_name,
+                exon,
+                strand,
+                feature,
+                biotype,
+                transcript,
+                ((transcript_overlap + '%') if transcript_overlap not in ['', None, '.'] else '.'),
+                ((exome_overlap + '%') if exome_overlap not in ['', None, '.'] else '.'),
+                ((cds_overlap + '%') if cds_overlap not in ['', None, '.'] else '.'),
+                # min_depth,
+                avg_depth,
+                # median_depth,
+                # std_dev,
+                # rate_within_normal,
+            ] + rates_within_threshs])
+
+        total_regions_count += 1
+        if total_regions_count > 0 and total_regions_count % 10000 == 0:
+            debug('  Processed {0:,} regions'.format(total_regions_count))
+    debug('Total regions: ' + str(total_regions_count))
+    return total_regions_count
+
 
 # def _get_values_from_row(fields, cols):
 #     return [fields[col] if col else None for col in cols]
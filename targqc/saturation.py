@@ -0,0 +1,230 @@
+# coding=utf-8
+"""Library saturation curve from nested read subsets.
+
+Every read pair gets a single uniform value derived from a hash of its name, so a subset
+for fraction f is simply "all pairs with value < f", and subsets for smaller fractions
+are nested into larger ones. One pass over the on-target alignments is enough to count
+unique reads and on-target bases for all fractions at once: a group of duplicates (reads
+sharing the same unclipped 5' position, strand and mate position) contributes one unique
+read to a subset as soon as any of its members is sampled, i.e. when the minimal hash
+value in the group is below the fraction.
+
+The unique reads curve is fitted with a Michaelis-Menten model U(x) = Umax * x / (K + x),
+which is then used to project depth to the full (non-downsampled) dataset.
+
+Every distinct fragment is kept in memory during the pass, so the stage is optional
+(targqc --saturation).
+"""
+import zlib
+from bisect import bisect_right
+from collections import defaultdict
+
+import six
+
+from targqc.utilz import sambamba
+from targqc.utilz.call_process import stream_lines
+from targqc.utilz.file_utils import file_transaction, can_reuse, verify_file
+from targqc.utilz.logger import info, debug
+
+HASH_RANGE = float(2 ** 32)
+
+_REF_CONSUMING = set('MDN=X')
+_ALIGNED_BLOCK = set('M=X')
+
+
+def calc_saturation(work_dir, bam_fpath, bed_fpath, output_fpath, fractions, sample_name=None):
+    """ Runs a single pass over reads overlapping bed_fpath (merged, at least 3 columns)
+        and writes the saturation table into output_fpath. Returns output_fpath.
+    """
+    if can_reuse(output_fpath, [bam_fpath, bed_fpath]):
+        return output_fpath
+
+    sample_name = sample_name or bam_fpath
+    fractions = sorted(set(float(f) for f in fractions))
+    intervals_by_chrom = _read_intervals(bed_fpath)
+    target_size = sum(e - s for ivs in intervals_by_chrom.values() for s, e in zip(*ivs))
+
+    info(sample_name + ': counting unique on-target reads for ' + str(len(fractions)) + ' nested subsets')
+    min_hash_by_group, total_by_fraction = _scan_reads(bam_fpath, bed_fpath, intervals_by_chrom, fractions)
+    debug(sample_name + ': ' + str(len(min_hash_by_group)) + ' distinct on-target fragments')
+
+    unique_by_fraction = [0] * len(fractions)
+    bases_by_fraction = [0] * len(fractions)
+    for h, bp in min_hash_by_group.values():
+        for i in range(_first_fraction_index(fractions, h), len(fractions)):
+            unique_by_fraction[i] += 1
+            bases_by_fraction[i] += bp
+
+    umax, k = fit_michaelis_menten(fractions, unique_by_fraction)
+
+    with file_transaction(work_dir, output_fpath) as tx:
+        with open(tx, 'w') as out:
+            out.write('## target_size=' + str(target_size) + '\n')
+            if umax is not None:
+                out.write('## umax=' + repr(umax) + '\n')
+                out.write('## k=' + repr(k) + '\n')
+            out.write('\t'.join(['fraction', 'reads', 'unique_reads', 'depth', 'fitted_unique_reads']) + '\n')
+            for f, total, uniq, bp in zip(fractions, total_by_fraction, unique_by_fraction, bases_by_fraction):
+                depth = 1.0 * bp / target_size if target_size else 0.0
+                fitted = umax * f / (k + f) if umax is not None else '.'
+                out.write('\t'.join(str(v) for v in [f, total, uniq, depth, fitted]) + '\n')
+    return output_fpath
+
+
+def read_saturation(saturation_fpath):
+    """ Returns dict(fractions, reads, unique_reads, depths, umax, k, target_size)
+        or None if the file is missing
+    """
+    if not verify_file(saturation_fpath, silent=True):
+        return None
+    res = dict(fractions=[], reads=[], unique_reads=[], depths=[], umax=None, k=None, target_size=None)
+    with open(saturation_fpath) as f:
+        for l in f:
+            if l.startswith('## '):
+                key, val = l[3:].strip().split('=')
+                res[key] = float(val) if key != 'target_size' else int(val)
+                continue
+            if l.startswith('fraction'):
+                continue
+            fs = l.strip('\n').split('\t')
+            res['fractions'].append(float(fs[0]))
+            res['reads'].append(int(fs[1]))
+            res['unique_reads'].append(int(fs[2]))
+            res['depths'].append(float(fs[3]))
+    return res
+
+
+def project_depth(saturation, times_sequenced, observed_depth=None):
+    """ Projects mean depth when the library is sequenced times_sequenced more
+        than the analysed BAM (e.g. the inverse of the downsampling fraction).
+        observed_depth defaults to the depth of the full subset from the curve.
+        Returns None when the curve could not be fitted.
+    """
+    if not saturation or saturation['umax'] is None or not saturation['fractions']:
+        return None
+    umax, k = saturation['umax'], saturation['k']
+    observed_fraction = saturation['fractions'][-1]
+    if observed_depth is None:
+        observed_depth = saturation['depths'][-1]
+    observed_unique = umax * observed_fraction / (k + observed_fraction)
+    if observed_unique <= 0:
+        return None
+    x = observed_fraction * times_sequenced
+    return observed_depth * (umax * x / (k + x)) / observed_unique
+
+
+def calc_library_saturation(saturation):
+    """ Share of the estimated library complexity (Umax) reached by the analysed reads
+    """
+    if not saturation or saturation['umax'] is None or not saturation['unique_reads']:
+        return None
+    return min(1.0, 1.0 * saturation['unique_reads'][-1] / saturation['umax'])
+
+
+def fit_michaelis_menten(xs, ys):
+    """ Least squares fit of y = umax * x / (k + x) using the Hanes-Woolf linearization
+        x / y = x / umax + k / umax. Returns (umax, k), or (None, None) if not enough points.
+    """
+    points = [(x, 1.0 * x / y) for x, y in zip(xs, ys) if x > 0 and y > 0]
+    if len(points) < 2:
+        return None, None
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_r = sum(r for _, r in points) / n
+    sxx = sum((x - mean_x) ** 2 for x, _ in points)
+    if sxx == 0:
+        return None, None
+    slope = sum((x - mean_x) * (r - mean_r) for x, r in points) / sxx
+    intercept = mean_r - slope * mean_x
+    if slope <= 0:  # no visible saturation: unique reads grow linearly or faster
+        return None, None
+    umax = 1.0 / slope
+    k = max(intercept * umax, 0.0)
+    return umax, k
+
+
+def _first_fraction_index(fractions, h):
+    """ Index of the smallest fraction f such that h < f
+    """
+    return bisect_right(fractions, h)
+
+
+def _read_intervals(bed_fpath):
+    starts_by_chrom = defaultdict(list)
+    ends_by_chrom = defaultdict(list)
+    with open(bed_fpath) as f:
+        for l in f:
+            if not l.strip() or l.startswith('#'):
+                continue
+            fs = l.split('\t')
+            starts_by_chrom[fs[0]].append(int(fs[1]))
+            ends_by_chrom[fs[0]].append(int(fs[2]))
+    intervals_by_chrom = dict()
+    for chrom in starts_by_chrom:
+        ivs = sorted(zip(starts_by_chrom[chrom], ends_by_chrom[chrom]))
+        intervals_by_chrom[chrom] = ([s for s, e in ivs], [e for s, e in ivs])
+    return intervals_by_chrom
+
+
+def _parse_cigar(cigar):
+    ops = []
+    num = 0
+    for c in cigar:
+        if c.isdigit():
+            num = num * 10 + ord(c) - 48
+        else:
+            ops.append((c, num))
+            num = 0
+    return ops
+
+
+def _overlap_bp(starts, ends, block_start, block_end):
+    """ Overlap of [block_start, block_end) with sorted non-overlapping intervals
+    """
+    bp = 0
+    i = max(bisect_right(starts, block_start) - 1, 0)
+    while i < len(starts) and starts[i] < block_end:
+        bp += max(0, min(ends[i], block_end) - max(starts[i], block_start))
+        i += 1
+    return bp
+
+
+def _scan_reads(bam_fpath, bed_fpath, intervals_by_chrom, fractions):
+    sambamba.index_bam(bam_fpath)
+    cmdl = [sambamba.get_executable(), 'view',
+            '-F', 'not (unmapped or secondary_alignment or supplementary or failed_quality_control)',
+            '-L', bed_fpath, bam_fpath]
+
+    min_hash_by_group = dict()
+    total_by_fraction = [0] * len(fractions)
+    with stream_lines(cmdl) as lines:
+        for line in lines:
+            fs = line.split('\t', 9)
+            qname, flag, chrom, pos, cigar, rnext, pnext = fs[0], int(fs[1]), fs[2], int(fs[3]) - 1, fs[5], fs[6], fs[7]
+            if cigar == '*' or chrom not in intervals_by_chrom:
+                continue
+            h = (zlib.crc32(qname.encode() if six.PY3 else qname) & 0xffffffff) / HASH_RANGE
+            for i in range(_first_fraction_index(fractions, h), len(fractions)):
+                total_by_fraction[i] += 1
+
+            starts, ends = intervals_by_chrom[chrom]
+            ref_pos = pos
+            on_target_bp = 0
+            ops = _parse_cigar(cigar)
+            for op, length in ops:
+                if op in _ALIGNED_BLOCK:
+                    on_target_bp += _overlap_bp(starts, ends, ref_pos, ref_pos + length)
+                if op in _REF_CONSUMING:
+                    ref_pos += length
+
+            is_reverse = flag & 0x10
+            if is_reverse:
+                five_prime = ref_pos + (ops[-1][1] if ops[-1][0] == 'S' else 0)
+            else:
+                five_prime = pos - (ops[0][1] if ops[0][0] == 'S' else 0)
+            group = (chrom, five_prime, is_reverse, flag & 0x40, rnext, pnext)
+
+            prev = min_hash_by_group.get(group)
+            if prev is None or h < prev[0]:
+                min_hash_by_group[group] = (h, on_target_bp)
+    return min_hash_by_group, total_by_fraction
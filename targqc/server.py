@@ -0,0 +1,346 @@
+""" Daemon mode: keeps the imported modules, reference data and prepared target panels in memory,
+and runs TargQC jobs sent over a local Unix socket or HTTP on localhost.
+
+    targqc --serve --socket /tmp/targqc.sock -t 8
+    curl --unix-socket /tmp/targqc.sock http://localhost/jobs -H 'Content-Type: application/json' \\
+         -d '{"bams": ["s1.bam", "s2.bam"], "bed": "panel.bed", "output_dir": "out", "wait": true}'
+
+API (JSON in and out):
+    POST /jobs         start a job. Fields: bams (paths, or "path,sample_name"), output_dir, and optionally
+                       work_dir, bed, genome, padding, depth_thresholds, dedup, reannotate, debug, profile,
+                       wait (reply when the job is finished instead of right away)
+    GET  /jobs/<id>    job status: queued, running, done or failed
+    GET  /jobs         all jobs
+    GET  /health       server status
+
+Only requests to localhost are served (checked with the Host header), POST requests must be
+application/json, and the Unix socket is only accessible by its owner: this keeps web pages open in
+a browser from submitting jobs.
+
+Target panels are prepared in the server process and kept by the BED file, its modification time and
+the preparation options. Each job runs in its own process, so its logging, telemetry and environment don't leak into the server or other jobs. The server
+runs threads, so the job processes are not forked from it but from a single-threaded fork server. The fork
+server starts from a fresh interpreter and preloads the pipeline and the reference data of the default genome
+(see targqc.forkserver_preload); jobs get the prepared target from the server. Worker pools are not shared
+between jobs: the local stages of a job run in joblib's loky process pool, which is started in the job process
+and reused by its stages.
+"""
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join, abspath, basename, isfile
+
+from targqc import config
+from targqc.utilz import logger
+from targqc.utilz.file_utils import safe_mkdir, adjust_path
+from targqc.utilz.logger import info, err, debug
+
+# The pipeline stages, imported by warm_up and preloaded into the fork server the jobs are started from
+# (targqc.main imports them only when a run starts, to keep the command line fast)
+PIPELINE_MODULES = [
+    'targqc.main',
+    'targqc.Target',
+    'targqc.fastq',
+    'targqc.general_report',
+    'targqc.region_coverage',
+    'targqc.summarize',
+    'targqc.qualimap.runner',
+    'targqc.qualimap.report_parser',
+    'targqc.utilz.reference_data',
+    'joblib',
+]
+FORKSERVER_PRELOAD_MODULE = 'targqc.forkserver_preload'
+
+MAX_REQUEST_SIZE = 1024 * 1024  # bytes of a POST request body
+
+JOB_FIELDS = ['bams', 'output_dir', 'work_dir', 'bed', 'genome', 'padding', 'depth_thresholds',
+              'dedup', 'reannotate', 'debug', 'profile', 'wait']
+
+
+class TargQCServer:
+    def __init__(self, work_dir, parallel_cfg, cache_dir=None, max_jobs=1, genome=config.genome):
+        self.work_dir = safe_mkdir(work_dir)
+        self.parallel_cfg = parallel_cfg
+        self.cache_dir = cache_dir
+        self.genome = genome
+        self.targets = dict()  # panel key -> Target
+        self.jobs = OrderedDict()  # job id -> status dict
+        self._targets_lock = threading.Lock()
+        self._jobs_lock = threading.Lock()
+        self._job_slots = threading.Semaphore(max_jobs)
+        self._job_counter = 0
+        self._mp = multiprocessing.get_context('forkserver')
+        self._mp.set_forkserver_preload(PIPELINE_MODULES + [FORKSERVER_PRELOAD_MODULE])
+
+    def warm_up(self):
+        """ Imports the pipeline stages (PIPELINE_MODULES), loads the reference data of the default genome
+            and starts the fork server, which does the same before forking the first job
+        """
+        from multiprocessing import forkserver
+        from targqc.forkserver_preload import PRELOAD_GENOME_ENV_VAR, preload
+        for module_name in PIPELINE_MODULES:
+            importlib.import_module(module_name)
+        info('Loading reference data for ' + self.genome)
+        preload(self.genome)
+        os.environ[PRELOAD_GENOME_ENV_VAR] = self.genome  # kept, as the fork server is restarted if it dies
+        forkserver.ensure_running()
+
+    def get_target(self, bed_fpath, genome, padding, reannotate):
+        """ Prepared Target of the panel, made once per BED file version and options.
+            Targets are made one at a time, as preparing them uses process-wide state (logging, BedTool temp files).
+        """
+        from targqc.Target import Target
+        import targqc.utilz.reference_data as ref
+        import ensembl as ebl
+        st = os.stat(bed_fpath) if bed_fpath else None
+        key = (bed_fpath, st.st_mtime if st else None, st.st_size if st else None, genome, padding, reannotate)
+        with self._targets_lock:
+            if key not in self.targets:
+                target_dirpath = safe_mkdir(join(self.work_dir, 'targets', hashlib.md5(repr(key).encode()).hexdigest()))
+                info('Preparing target ' + (bed_fpath or 'WGS (' + genome + ')') + ' in ' + target_dirpath)
+                ebl.set_canonical_index_dirs(cache_dir=self.cache_dir, work_dir=self.work_dir)
+                self.targets[key] = Target(target_dirpath, target_dirpath, ref.get_fai(genome), padding=padding,
+                    bed_fpath=bed_fpath, reannotate=reannotate, genome=genome, is_debug=logger.is_debug,
+                    cache_dir=self.cache_dir)
+            return self.targets[key]
+
+    def submit(self, params):
+        """ Validates the job and starts it in a background thread. Returns the job status.
+        """
+        unknown = [k for k in params if k not in JOB_FIELDS]
+        if unknown:
+            raise ValueError('Unknown fields: ' + ', '.join(unknown))
+        if not params.get('bams'):
+            raise ValueError('"bams" is required')
+        if not params.get('output_dir'):
+            raise ValueError('"output_dir" is required')
+        params = dict(params)
+        params['bed'] = adjust_path(params['bed']) if params.get('bed') else None
+        if params['bed'] and not isfile(params['bed']):
+            raise ValueError('BED file not found: ' + params['bed'])
+        params['output_dir'] = adjust_path(params['output_dir'])
+
+        with self._jobs_lock:
+            self._job_counter += 1
+            job = OrderedDict([
+                ('id', str(self._job_counter)),
+                ('status', 'queued'),
+                ('output_dir', params['output_dir']),
+                ('submitted', time.time()),
+            ])
+            self.jobs[job['id']] = job
+        t = threading.Thread(target=self._run_job, args=(job, params), name='targqc-job-' + job['id'])
+        t.daemon = True
+        t.start()
+        if params.get('wait'):
+            t.join()
+        return self.get_job(job['id'])
+
+    def get_job(self, job_id):
+        """ Copy of the job status, or None. Job threads update the statuses under _jobs_lock,
+            so the copies are made under it too.
+        """
+        with self._jobs_lock:
+            job = self.jobs.get(job_id)
+            return OrderedDict(job) if job is not None else None
+
+    def get_jobs(self):
+        with self._jobs_lock:
+            return [OrderedDict(job) for job in self.jobs.values()]
+
+    def _update_job(self, job, **fields):
+        with self._jobs_lock:
+            job.update(fields)
+
+    def _run_job(self, job, params):
+        with self._job_slots:
+            started = time.time()
+            self._update_job(job, status='running', started=started)
+            error = None
+            try:
+                genome = params.get('genome') or self.genome
+                padding = params.get('padding', config.padding)
+                target = self.get_target(params['bed'], genome, padding, params.get('reannotate', config.reannotate))
+                exit_code = self._start_job_process(params, target, genome, padding)
+            except BaseException as e:  # critical() in target preparation raises SystemExit
+                err('Job ' + job['id'] + ' failed: ' + repr(e))
+                error = traceback.format_exc()
+                exit_code = None
+            finished = time.time()
+            status = 'done' if exit_code == 0 else 'failed'
+            fields = OrderedDict([('exit_code', exit_code), ('finished', finished), ('wall_s', finished - started)])
+            if error:
+                fields['error'] = error
+            if exit_code == 0:
+                fields['summary_html'] = join(params['output_dir'], 'summary.html')
+            self._update_job(job, status=status, **fields)
+            info('Job ' + job['id'] + ' ' + status + ' in ' + '%.1f' % (finished - started) + 's: ' + params['output_dir'])
+
+    def _start_job_process(self, params, target, genome, padding):
+        proc = self._mp.Process(target=_job_process, args=(params, target, genome, padding, self.parallel_cfg,
+                                                           self.cache_dir), name='targqc-job')
+        proc.start()
+        proc.join()
+        return proc.exitcode
+
+
+def _job_process(params, target, genome, padding, parallel_cfg, cache_dir):
+    code = 1
+    try:
+        code = _run_in_child(params, target, genome, padding, parallel_cfg, cache_dir)
+    finally:
+        logger.flush()
+    sys.exit(code)
+
+
+def _run_in_child(params, target, genome, padding, parallel_cfg, cache_dir):
+    """ Runs start_targqc for the job in the job process, with its own log and work directory
+    """
+    import targqc.main
+    from targqc.utilz.proc_args import find_bams, set_up_dirs
+
+    logger.is_debug = bool(params.get('debug'))
+    output_dir, work_dir, log_fpath = set_up_dirs(targqc.main.targqc_name, params['output_dir'], params.get('work_dir'))
+    with open(os.devnull, 'w') as devnull, open(join(work_dir, 'log', 'targqc.stderr'), 'w') as stderr_f:
+        os.dup2(devnull.fileno(), 1)
+        os.dup2(stderr_f.fileno(), 2)
+
+    samples = []
+    for sname, bam_fpath in find_bams(list(params['bams'])).items():
+        samples.append(targqc.main.Sample(sname, join(output_dir, sname), work_dir=join(work_dir, sname), bam=bam_fpath))
+    samples.sort(key=lambda _s: _s.key_to_sort())
+    for s in samples:
+        safe_mkdir(s.work_dir)
+        safe_mkdir(s.dirpath)
+
+    # the capture BED is one of the outputs: copy it from the server's target directory
+    if target.capture_bed_fpath:
+        capture_bed_fpath = join(output_dir, basename(target.capture_bed_fpath))
+        shutil.copy(target.capture_bed_fpath, capture_bed_fpath)
+        target.capture_bed_fpath = capture_bed_fpath
+
+    html_fpath = targqc.main.start_targqc(work_dir, output_dir, samples, params['bed'], parallel_cfg, None,
+        genome=genome,
+        depth_threshs=params.get('depth_thresholds') or config.depth_thresholds,
+        padding=padding,
+        dedup=params.get('dedup', config.dedup),
+        reannotate=params.get('reannotate', config.reannotate),
+        cache_dir=cache_dir,
+        profile=bool(params.get('profile')),
+        target=target)
+    return 0 if html_fpath else 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'TargQC'
+
+    def do_GET(self):
+        app = self.server.app
+        if not self._host_allowed():
+            return self._reply(403, dict(error='Host not allowed: ' + str(self.headers.get('Host'))))
+        if self.path == '/health':
+            self._reply(200, OrderedDict([('status', 'ok'), ('pid', os.getpid()),
+                                          ('targets', len(app.targets)), ('jobs', len(app.jobs))]))
+        elif self.path == '/jobs':
+            self._reply(200, app.get_jobs())
+        elif self.path.startswith('/jobs/') and self.path[len('/jobs/'):] in app.jobs:
+            self._reply(200, app.get_job(self.path[len('/jobs/'):]))
+        else:
+            self._reply(404, dict(error='Not found: ' + self.path))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_REQUEST_SIZE:
+            return self._reply(413, dict(error='Request is larger than ' + str(MAX_REQUEST_SIZE) + ' bytes'))
+        body = self.rfile.read(length)  # read before replying, so that a rejected client isn't cut off while sending
+        if not self._host_allowed():
+            return self._reply(403, dict(error='Host not allowed: ' + str(self.headers.get('Host'))))
+        if self.path != '/jobs':
+            return self._reply(404, dict(error='Not found: ' + self.path))
+        if self.headers.get_content_type() != 'application/json':
+            return self._reply(415, dict(error='Content-Type must be application/json'))
+        try:
+            params = json.loads(body.decode())
+            job = self.server.app.submit(params)
+        except ValueError as e:
+            return self._reply(400, dict(error=str(e)))
+        if job['status'] in ('queued', 'running'):
+            self._reply(202, job)
+        else:
+            self._reply(200 if job['status'] == 'done' else 500, job)
+
+    def _host_allowed(self):
+        """ Rejects requests addressed to other host names, so that a web page can't reach the server
+            through a DNS name rebound to 127.0.0.1
+        """
+        hosts = ['localhost', '127.0.0.1']
+        if isinstance(self.server.server_address, tuple):
+            hosts += [h + ':' + str(self.server.server_address[1]) for h in hosts]
+        return self.headers.get('Host') in hosts
+
+    def _reply(self, code, data):
+        body = (json.dumps(data, indent=2) + '\n').encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, fmt, *args):
+        debug(self.address_string() + ' ' + fmt % args)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = socketserver.UnixStreamServer.get_request(self)
+        return request, None
+
+
+def serve(app, socket_fpath=None, port=None):
+    """ Serves the app on a Unix socket, or on localhost:port, until SIGTERM or Ctrl+C
+    """
+    if socket_fpath:
+        socket_fpath = abspath(socket_fpath)
+        if os.path.exists(socket_fpath):
+            os.remove(socket_fpath)
+        prev_umask = os.umask(0o177)  # the socket is created with 0600 permissions
+        try:
+            httpd = _UnixHTTPServer(socket_fpath, _Handler)
+        finally:
+            os.umask(prev_umask)
+        where = 'socket ' + socket_fpath
+    else:
+        httpd = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        where = 'http://127.0.0.1:' + str(port)
+    httpd.app = app
+
+    def _stop(signum, frame):
+        threading.Thread(target=httpd.shutdown).start()
+    signal.signal(signal.SIGTERM, _stop)
+
+    info('Serving TargQC jobs on ' + where)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if socket_fpath and os.path.exists(socket_fpath):
+            os.remove(socket_fpath)
+        info('Stopped')
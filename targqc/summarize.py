@@ -1,8 +1,10 @@
+import json
 import os
 import shutil
 import targqc
 import targqc.config as tc
 from collections import OrderedDict, defaultdict
+from itertools import groupby
 from os import listdir
 from os.path import relpath, join, exists, dirname, basename, abspath, splitext
 from targqc.general_report import get_header_metric_storage
@@ -24,7 +26,47 @@ def _make_targetcov_symlinks(samples):
         info('TargetCov TXT symlink saved to ' + new_link)
 
 
-def make_tarqc_html_report(output_dir, work_dir, samples, bed_fpath=None, tag_by_sample=None):
+SUMMARY_STATE_FNAME = 'summary_state.json'
+
+
+def load_summary_state(output_dir):
+    """ State of the cohort summarized in output_dir: the samples in it, with the size and modification time
+        of the region report they were summarized from.
+    """
+    state_fpath = join(output_dir, SUMMARY_STATE_FNAME)
+    if not verify_file(state_fpath, silent=True):
+        return dict(samples=OrderedDict())
+    with open(state_fpath) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def save_summary_state(output_dir, state):
+    with file_transaction(None, join(output_dir, SUMMARY_STATE_FNAME)) as tx:
+        with open(tx, 'w') as f:
+            json.dump(state, f, indent=2)
+
+
+def _region_report_stamp(sample):
+    st = os.stat(sample.targqc_region_tsv) if verify_file(sample.targqc_region_tsv, silent=True) else None
+    return [st.st_size, st.st_mtime] if st else None
+
+
+def get_cohort(output_dir, work_dir, new_samples, state):
+    """ Samples summarized in output_dir before, and the new ones (replacing the old ones with the same name)
+    """
+    from targqc.main import Sample
+    new_names = set(s.name for s in new_samples)
+    samples = [Sample(name, join(output_dir, name), work_dir=join(work_dir, name))
+               for name in state['samples'] if name not in new_names]
+    samples = [s for s in samples if verify_file(s.targqc_json_fpath, silent=True)] + list(new_samples)
+    samples.sort(key=lambda _s: _s.key_to_sort())
+    return samples
+
+
+def make_tarqc_html_report(output_dir, work_dir, samples, bed_fpath=None, tag_by_sample=None, compact_html=None):
+    """ compact_html: render the summary table in the browser from a JSON blob, page by page.
+                      By default, only for large cohorts (see FullReport.save_html)
+    """
     # header_storage = get_header_metric_storage(tc.depth_thresholds,
     #                                            is_wgs=bed_fpath is not None,
     #                                            padding=tc.padding)
@@ -36,7 +78,8 @@ def make_tarqc_html_report(output_dir, work_dir, samples, bed_fpath=None, tag_by
     if not jsons_by_sample:
         return None, None, None
 
-    targqc_full_report = FullReport.construct_from_sample_report_jsons(samples, output_dir, jsons_by_sample, htmls_by_sample)
+    targqc_full_report = FullReport.construct_from_sample_report_jsons(samples, output_dir, jsons_by_sample, htmls_by_sample,
+                                                                        cache_dirpath=join(work_dir, 'report_cache'))
 
     for sample_report in targqc_full_report.sample_reports:
         if tag_by_sample:
@@ -54,16 +97,25 @@ def make_tarqc_html_report(output_dir, work_dir, samples, bed_fpath=None, tag_by
 
     fn = splitext(basename(samples[0].targqc_txt_fpath))[0]
     tsv_fpath = targqc_full_report.save_tsv(join(output_dir, fn + '.tsv'))
-    html_fpath = targqc_full_report.save_html(join(output_dir, fn + '.html'), 'TargQC')
+    html_fpath = targqc_full_report.save_html(join(output_dir, fn + '.html'), 'TargQC', compact=compact_html)
 
     return tsv_fpath, html_fpath
 
 
-def combined_regional_reports(work_dir, output_dir, samples):
+def combined_regional_reports(work_dir, output_dir, samples, state=None, append=False):
+    """ state (see load_summary_state) is updated with the samples written.
+        With append, only the samples not in the state or with a changed region report
+        are added to the existing combined report.
+    """
     if not any(verify_file(s.targqc_region_tsv, silent=True) for s in samples):
         return None, None
 
     tsv_region_rep_fpath = join(output_dir, basename(samples[0].targqc_region_tsv))
+    if append and state['samples'] and verify_file(tsv_region_rep_fpath, silent=True):
+        if _append_regional_reports(work_dir, tsv_region_rep_fpath, samples, state):
+            return tsv_region_rep_fpath
+        debug('Rows in ' + tsv_region_rep_fpath + ' are not in the order of the samples, rewriting it')
+
     debug('Combining regional reports, writing to ' + tsv_region_rep_fpath)
     with file_transaction(work_dir, tsv_region_rep_fpath) as tx_tsv:
         with open(tx_tsv, 'w') as tsv_out:
@@ -90,9 +142,83 @@ def combined_regional_reports(work_dir, output_dir, samples):
                                 tsv_out.write(s.name + '\t' + l)
                     sample_i += 1
 
+    if state is not None:
+        state['samples'] = OrderedDict((s.name, _region_report_stamp(s)) for s in samples)
     return tsv_region_rep_fpath
 
 
+class _RowsOutOfOrder(Exception):
+    pass
+
+
+def _write_sample_rows(tsv_out, sample):
+    if verify_file(sample.targqc_region_tsv, silent=True):
+        with open(sample.targqc_region_tsv) as tsv_in:
+            next(tsv_in)  # header
+            for l in tsv_in:
+                tsv_out.write(sample.name + '\t' + l)
+
+
+def _append_regional_reports(work_dir, tsv_region_rep_fpath, samples, state):
+    """ Adds the rows of new and changed samples to the combined report, keeping the rows in the order of
+        samples (sorted as by get_cohort), as in a full rebuild. If the new samples go after all the others,
+        their rows are appended in place (rolled back on failure). Otherwise, the report is rewritten in a single
+        pass, copying the rows of the unchanged samples, and dropping the previous rows of the changed samples
+        and the rows of the samples no longer in the cohort. Returns False if the rows of the unchanged samples
+        are not in the order of samples, so the report needs a full rebuild.
+    """
+    changed = [s for s in samples if _region_report_stamp(s) != state['samples'].get(s.name)]
+    if not changed:
+        debug('Combined regional report ' + tsv_region_rep_fpath + ' is up to date')
+        return True
+    changed_names = set(s.name for s in changed)
+    first_changed_i = min(i for i, s in enumerate(samples) if s.name in changed_names)
+    last_kept_i = max([i for i, s in enumerate(samples) if s.name not in changed_names] or [-1])
+
+    if first_changed_i > last_kept_i and not any(s.name in state['samples'] for s in changed):
+        debug('Appending ' + str(len(changed)) + ' samples to ' + tsv_region_rep_fpath)
+        size_before = os.path.getsize(tsv_region_rep_fpath)
+        try:
+            with open(tsv_region_rep_fpath, 'a') as tsv_out:
+                for s in changed:
+                    _write_sample_rows(tsv_out, s)
+        except:
+            with open(tsv_region_rep_fpath, 'a') as f:  # roll back to the previous state
+                f.truncate(size_before)
+            raise
+        for s in changed:
+            state['samples'][s.name] = _region_report_stamp(s)
+        return True
+
+    debug('Merging ' + str(len(changed)) + ' new or changed samples into ' + tsv_region_rep_fpath)
+    kept_names = set(s.name for s in samples if s.name not in changed_names)
+    try:
+        with file_transaction(work_dir, tsv_region_rep_fpath) as tx_tsv:
+            with open(tsv_region_rep_fpath) as tsv_in, open(tx_tsv, 'w') as tsv_out:
+                tsv_out.write(next(tsv_in))  # header
+                groups = groupby(tsv_in, key=lambda l: l.split('\t', 1)[0])
+                for s in samples:
+                    if s.name in changed_names:
+                        _write_sample_rows(tsv_out, s)
+                        continue
+                    if state['samples'].get(s.name) is None:  # had no region report
+                        continue
+                    for name, lines in groups:  # skipping the rows of changed and removed samples
+                        if name == s.name:
+                            tsv_out.writelines(lines)
+                            break
+                        if name in kept_names:
+                            raise _RowsOutOfOrder()
+                    else:
+                        if verify_file(s.targqc_region_tsv, silent=True):
+                            raise _RowsOutOfOrder()
+    except _RowsOutOfOrder:
+        return False
+    state['samples'] = OrderedDict((s.name, state['samples'].get(s.name) if s.name not in changed_names
+                                    else _region_report_stamp(s)) for s in samples)
+    return True
+
+
 # def summarize_targqc(summary_threads, output_dir, work_dir, samples, bed_fpath=None, tag_by_sample=None):
     # best_for_regions_fpath = None
     # if any(verify_file(s.targqc_region_tsv, silent=True) for s in samples):
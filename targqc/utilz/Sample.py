@@ -1,8 +1,5 @@
-from natsort import natsort_keygen
-
-
 class BaseSample:
-    natsort_key = natsort_keygen()
+    natsort_key = None  # made on first use, to not import natsort on startup
 
     def __init__(self, name=None, dirpath=None, work_dir=None, bam=None, bed=None, vcf=None, genome=None,
                  targqc_dirpath=None, clinical_report_dirpath=None,
@@ -37,6 +34,9 @@ class BaseSample:
         return self.key_to_sort() < other.key_to_sort()
 
     def key_to_sort(self):
+        if BaseSample.natsort_key is None:
+            from natsort import natsort_keygen
+            BaseSample.natsort_key = natsort_keygen()
         return BaseSample.natsort_key(self.name)
 
         # parts = []
@@ -1,10 +1,17 @@
 from __future__ import division
 
+import array
+import heapq
 import math
+import mmap
 import os
 import pybedtools
+import shutil
 import sys
+import tempfile
 from collections import OrderedDict
+
+import numpy as np
 from os.path import isfile, join, abspath, basename, dirname, getctime, getmtime, splitext, realpath
 from pybedtools import BedTool
 from subprocess import check_output
@@ -19,9 +26,7 @@ from targqc.utilz.logger import info, critical, warn, err, debug
 
 
 def get_chrom_order(genome=None, fai_fpath=None):
-    chr_lengths = ref.get_chrom_lengths(genome, fai_fpath)
-    chr_order = {c: i for i, (c, l) in enumerate(chr_lengths)}
-    return chr_order
+    return ref.get_chrom_order(genome, fai_fpath)
 
 
 class SortableByChrom:
@@ -54,6 +59,78 @@ class Region(SortableByChrom):
         return self.__str__()
 
 
+class RegionSet:
+    """ Regions of a BED file held in NumPy arrays, with the original lines kept
+        so that subsets can be written back without re-parsing.
+    """
+    def __init__(self, chroms, starts, ends, lines):
+        self.chrom_names, self.chrom_codes = np.unique(np.array(chroms, dtype=object), return_inverse=True) \
+            if chroms else (np.array([], dtype=object), np.array([], dtype=int))
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.lines = lines
+
+    @classmethod
+    def from_bed(cls, bed_fpath):
+        chroms, starts, ends, lines = [], [], [], []
+        with open(bed_fpath) as f:
+            for l in f:
+                if not l.strip() or l.startswith('#'):
+                    continue
+                l = l.rstrip('\n')
+                fs = l.split('\t', 3)
+                chroms.append(fs[0])
+                starts.append(int(fs[1]))
+                ends.append(int(fs[2]))
+                lines.append(l)
+        return cls(chroms, starts, ends, lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def column(self, index):
+        """ Values of the column index (0-based), None for lines that are shorter
+        """
+        return [fs[index] if len(fs) > index else None for fs in (l.split('\t') for l in self.lines)]
+
+    def save(self, work_dir, output_fpath, mask=None, cols=None):
+        """ Writes the lines (or the first cols columns) selected by the boolean mask
+        """
+        idxs = np.flatnonzero(mask) if mask is not None else range(len(self.lines))
+        with file_transaction(work_dir, output_fpath) as tx:
+            with open(tx, 'w') as out:
+                for i in idxs:
+                    l = self.lines[i]
+                    if cols:
+                        l = '\t'.join(l.split('\t')[:cols])
+                    out.write(l + '\n')
+        return output_fpath
+
+    def merged(self, padding=0, chrom_lengths=None):
+        """ Same as bedtools slop (if padding) | sort | merge: returns a list of (chrom, start, end),
+            sorted lexicographically by chromosome, with overlapping and book-ended regions merged
+        """
+        starts = np.maximum(self.starts - padding, 0)
+        ends = self.ends + padding
+        if padding and chrom_lengths:
+            max_ends = np.array([chrom_lengths.get(c, np.iinfo(np.int64).max) for c in self.chrom_names], dtype=np.int64)
+            ends = np.minimum(ends, max_ends[self.chrom_codes]) if len(ends) else ends
+
+        merged = []
+        for code, chrom in enumerate(self.chrom_names):
+            idx = np.flatnonzero(self.chrom_codes == code)
+            order = np.lexsort((ends[idx], starts[idx]))
+            c_starts, c_ends = starts[idx][order], ends[idx][order]
+            running_end = np.maximum.accumulate(c_ends)
+            new_group = np.ones(len(c_starts), dtype=bool)
+            new_group[1:] = c_starts[1:] > running_end[:-1]
+            group_starts = np.flatnonzero(new_group)
+            group_ends = np.append(group_starts[1:], len(c_starts)) - 1
+            for s, e in zip(c_starts[group_starts].tolist(), running_end[group_ends].tolist()):
+                merged.append((chrom, s, e))
+        return merged
+
+
 def bam_to_bed(bam_fpath, to_gzip=True):
     debug('Converting the BAM to BED to save some memory.')  # from here: http://davetang.org/muse/2015/08/05/creating-a-coverage-plot-using-bedtools-and-r/
     bam_bed_fpath = splitext_plus(bam_fpath)[0] + ('.bed.gz' if to_gzip else '.bed')
@@ -197,8 +274,6 @@ def sort_bed(input_bed_fpath, output_bed_fpath=None, work_dir=None, fai_fpath=No
         debug(output_bed_fpath + ' exists, reusing')
         return output_bed_fpath
 
-    regions = []
-
     if not chr_order:
         if fai_fpath:
             fai_fpath = verify_file(fai_fpath)
@@ -208,33 +283,124 @@ def sort_bed(input_bed_fpath, output_bed_fpath=None, work_dir=None, fai_fpath=No
             critical('Either of chr_order, fai_fpath, or genome build name must be specified')
         chr_order = get_chrom_order(fai_fpath=fai_fpath)
 
-    with open(input_bed_fpath) as f:
-        with file_transaction(work_dir, output_bed_fpath) as tx:
-            with open(tx, 'w') as out:
-                for l in f:
-                    if not l.strip():
-                        continue
-                    if l.strip().startswith('#'):
-                        out.write(l)
-                        continue
-
-                    fs = l.strip().split('\t')
-                    chrom = fs[0]
-                    start = int(fs[1])
-                    end = int(fs[2])
-                    other_fields = fs[3:]
-                    order = chr_order.get(chrom, -1)
-                    regions.append(Region(chrom, start, end, other_fields, order))
-
-                for region in sorted(regions, key=lambda r: r.get_key()):
-                    fs = [region.chrom, str(region.start), str(region.end)]
-                    fs.extend(region.other_fields)
-                    out.write('\t'.join(fs) + '\n')
-
-    debug('Sorted ' + str(len(regions)) + ' regions, saved to ' + output_bed_fpath)
+    spill_dirs = []
+    try:
+        with open(input_bed_fpath, 'rb') as f:
+            header_lines, chunks, regions_num = _sort_bed_chunks(
+                f, chr_order, work_dir or dirname(output_bed_fpath), spill_dirs)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if regions_num else None
+            try:
+                with file_transaction(work_dir, output_bed_fpath) as tx:
+                    with open(tx, 'wb') as out:
+                        for l in header_lines:
+                            out.write(l)
+                        for fs in _merge_sorted_chunks(chunks, mm):
+                            out.write(b'\t'.join(fs) + b'\n')
+            finally:
+                if mm is not None:
+                    mm.close()
+    finally:
+        for spill_dir in spill_dirs:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+    debug('Sorted ' + str(regions_num) + ' regions, saved to ' + output_bed_fpath)
     return output_bed_fpath
 
 
+SORT_BED_CHUNK_SIZE = 2000000  # regions kept in memory at once by sort_bed
+_SORT_KEY_DTYPE = [('order', 'i4'), ('start', 'i8'), ('end', 'i8'), ('offset', 'i8'), ('length', 'i8')]
+
+
+def _sort_bed_chunks(f, chr_order, tmp_dir, spill_dirs, chunk_size=None):
+    """ Parses f into compact key arrays (chrom order, start, end, line offset and length),
+        sorts them by chunks and spills every chunk but the last one into a temporary directory in tmp_dir.
+        The directory is made only when there is more than one chunk, and added to spill_dirs for the caller
+        to remove. Returns header lines, a list of sorted chunks (arrays or memory-mapped .npy), and the number of regions.
+    """
+    chunk_size = chunk_size or SORT_BED_CHUNK_SIZE
+    order_by_chrom = dict((c.encode() if not isinstance(c, bytes) else c, o) for c, o in chr_order.items())
+    header_lines = []
+    chunks = []
+    regions_num = 0
+    cols = [array.array('i')] + [array.array('l') for _ in range(4)]
+
+    def _flush():
+        keys = np.empty(len(cols[0]), dtype=_SORT_KEY_DTYPE)
+        for (name, _), col in zip(_SORT_KEY_DTYPE, cols):
+            keys[name] = np.frombuffer(col, dtype='i' + str(col.itemsize))
+            del col[:]
+        keys = keys[np.lexsort((keys['offset'], keys['end'], keys['start'], keys['order']))]
+        if chunks:  # the previous chunk goes to disk, only the last one stays in memory
+            if not spill_dirs:
+                spill_dirs.append(tempfile.mkdtemp(dir=tmp_dir))
+            spill_fpath = join(spill_dirs[0], str(len(chunks) - 1) + '.npy')
+            np.save(spill_fpath, chunks[-1])
+            chunks[-1] = np.load(spill_fpath, mmap_mode='r')
+        chunks.append(keys)
+
+    offset = 0
+    for l in f:
+        line_offset = offset
+        offset += len(l)
+        stripped = l.strip()
+        if not stripped:
+            continue
+        if stripped.startswith(b'#'):
+            header_lines.append(l)
+            continue
+        fs = stripped.split(b'\t', 3)
+        cols[0].append(order_by_chrom.get(fs[0], -1))
+        cols[1].append(int(fs[1]))
+        cols[2].append(int(fs[2]))
+        cols[3].append(line_offset)
+        cols[4].append(len(l))
+        regions_num += 1
+        if len(cols[0]) >= chunk_size:
+            _flush()
+    if len(cols[0]):
+        _flush()
+    return header_lines, chunks, regions_num
+
+
+def _iterate_keys(keys, block_size=65536):
+    for i in range(0, len(keys), block_size):
+        for k in keys[i:i + block_size].tolist():
+            yield k
+
+
+def _merge_sorted_chunks(chunks, mm):
+    """ k-way merge of sorted key chunks, yields output fields in the order of the original
+        Region sort: (chrom order, start, end, other fields). Equal coordinates are rare,
+        so other fields are compared only within such groups.
+    """
+    if len(chunks) > 1:
+        keys_iter = heapq.merge(*[_iterate_keys(c) for c in chunks])
+    else:
+        keys_iter = _iterate_keys(chunks[0]) if chunks else iter([])
+
+    def _fields(key):
+        fs = mm[key[3]:key[3] + key[4]].strip().split(b'\t')
+        fs[1] = str(int(fs[1])).encode()
+        fs[2] = str(int(fs[2])).encode()
+        return fs
+
+    group = []
+    for key in keys_iter:
+        if group and key[:3] != group[0][:3]:
+            for fs in _sorted_group(group, _fields):
+                yield fs
+            group = []
+        group.append(key)
+    for fs in _sorted_group(group, _fields):
+        yield fs
+
+
+def _sorted_group(group, get_fields):
+    if len(group) == 1:
+        return [get_fields(group[0])]
+    return sorted((get_fields(k) for k in group), key=lambda fs: fs[3:])
+
+
 def sort_bed_gsort(input_bed_fpath, output_bed_fpath=None, work_dir=None, fai_fpath=None, genome=None):
     input_bed_fpath = verify_bed(input_bed_fpath, is_critical=True)
     output_bed_fpath = adjust_path(output_bed_fpath) if output_bed_fpath \
@@ -0,0 +1,83 @@
+""" Persistent cache shared between projects.
+
+Entries are directories under <cache_dir>/<namespace>/<key>, where the key is a hash of
+the content and parameters the entry was built from. An entry is populated in a temporary
+directory under an exclusive lock and renamed into place, so concurrent runs either wait
+for the first one or see a complete entry.
+"""
+import contextlib
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+from os.path import join, isdir
+
+from targqc import config
+from targqc.utilz.file_utils import safe_mkdir, adjust_path
+from targqc.utilz.logger import debug, warn
+
+
+def get_cache_dir(cache_dir=None):
+    """ cache_dir argument, then config.cache_dir, then $TARGQC_CACHE_DIR.
+        Returns None if none of them is set (caching is off), or if the directory can't be created.
+    """
+    cache_dir = cache_dir or config.cache_dir or os.environ.get('TARGQC_CACHE_DIR')
+    if not cache_dir:
+        return None
+    cache_dir = adjust_path(cache_dir)
+    try:
+        return safe_mkdir(cache_dir)
+    except OSError as e:
+        warn('Cannot create cache directory ' + cache_dir + ', caching is disabled: ' + str(e))
+        return None
+
+
+def content_hash(fpaths=None, params=None):
+    """ md5 of the contents of fpaths and of the string representations of params
+    """
+    h = hashlib.md5()
+    for fpath in fpaths or []:
+        with open(fpath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        h.update(b'\0')
+    for p in params or []:
+        h.update(str(p).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+@contextlib.contextmanager
+def _locked(lock_fpath):
+    with open(lock_fpath, 'a') as lock_f:
+        fcntl.flock(lock_f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+
+def get_or_create_entry(cache_dir, namespace, key, populate_fn):
+    """ Returns the entry directory <cache_dir>/<namespace>/<key>, calling populate_fn(tmp_dirpath)
+        to fill it if it doesn't exist yet.
+    """
+    ns_dirpath = safe_mkdir(join(cache_dir, namespace))
+    entry_dirpath = join(ns_dirpath, key)
+    if isdir(entry_dirpath):
+        debug('Using cached ' + namespace + ' entry ' + entry_dirpath)
+        return entry_dirpath
+
+    with _locked(entry_dirpath + '.lock'):
+        if isdir(entry_dirpath):  # populated by another process while we were waiting
+            debug('Using cached ' + namespace + ' entry ' + entry_dirpath)
+            return entry_dirpath
+        tmp_dirpath = tempfile.mkdtemp(dir=ns_dirpath, prefix='.' + key + '.')
+        try:
+            populate_fn(tmp_dirpath)
+            os.rename(tmp_dirpath, entry_dirpath)
+        except:
+            shutil.rmtree(tmp_dirpath, ignore_errors=True)
+            raise
+    debug('Saved ' + namespace + ' entry to cache ' + entry_dirpath)
+    return entry_dirpath
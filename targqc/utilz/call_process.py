@@ -2,19 +2,29 @@
 """
 from __future__ import division
 
+import asyncio
 import collections
+import contextlib
+import io
+import multiprocessing
 import os
+import signal
 import six
 import subprocess
+import tempfile
+import threading
+import time
 from os.path import isfile
 
-from targqc.utilz.logger import info, err
+from targqc.utilz import logger, telemetry
+from targqc.utilz.logger import info, err, debug
 from targqc.utilz.file_utils import file_transaction, verify_file
 
 
 def run(cmd, output_fpath=None, input_fpath=None, checks=None, stdout_to_outputfile=True,
-        stdout_tx=True, reuse=False, env_vars=None):
+        stdout_tx=True, reuse=False, env_vars=None, timeout=None):
     """Run the provided command, logging details and checking for errors.
+    With timeout (in seconds), the command is killed when it runs longer, raising subprocess.TimeoutExpired.
     """
     if output_fpath and reuse:
         if verify_file(output_fpath, silent=True):
@@ -24,14 +34,7 @@ def run(cmd, output_fpath=None, input_fpath=None, checks=None, stdout_to_outputf
             info(output_fpath + '.gz exists, reusing')
             return output_fpath
 
-    env = os.environ.copy()
-    if env_vars:
-        for k, v in env_vars.items():
-            if v is None:
-                if k in env:
-                    del env[k]
-            else:
-                env[k] = v
+    env = _make_env(env_vars)
 
     if checks is None:
         checks = [file_nonempty_check]
@@ -39,7 +42,7 @@ def run(cmd, output_fpath=None, input_fpath=None, checks=None, stdout_to_outputf
     def _try_run(_cmd, _output_fpath, _input_fpath):
         try:
             info(' '.join(str(x) for x in _cmd) if not isinstance(_cmd, six.string_types) else _cmd)
-            _do_run(_cmd, checks, env, _output_fpath, _input_fpath)
+            _do_run(_cmd, checks, env, _output_fpath, _input_fpath, timeout)
         except:
             raise
 
@@ -68,6 +71,18 @@ def run(cmd, output_fpath=None, input_fpath=None, checks=None, stdout_to_outputf
         _try_run(cmd, None, input_fpath)
 
 
+def _make_env(env_vars):
+    env = os.environ.copy()
+    if env_vars:
+        for k, v in env_vars.items():
+            if v is None:
+                if k in env:
+                    del env[k]
+            else:
+                env[k] = v
+    return env
+
+
 def find_bash():
     for test_bash in [find_cmd("bash"), "/bin/bash", "/usr/bin/bash", "/usr/local/bin/bash"]:
         if test_bash and os.path.exists(test_bash):
@@ -97,44 +112,267 @@ def _normalize_cmd_args(cmd):
         return [str(x) for x in cmd], False, None
 
 
-def _do_run(cmd, checks, env=None, output_fpath=None, input_fpath=None):
+def _do_run(cmd, checks, env=None, output_fpath=None, input_fpath=None, timeout=None):
     """Perform running and check results, raising errors for issues.
     """
     cmd, shell_arg, executable_arg = _normalize_cmd_args(cmd)
-    s = subprocess.Popen(cmd, shell=shell_arg, executable=executable_arg,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT, close_fds=True, env=env)
-    debug_stdout = collections.deque(maxlen=100)
-    while 1:
-        line = s.stdout.readline()
-        if line:
-            if six.PY3: line = line.decode(errors='replace')
-            debug_stdout.append(line)
-            info('  ' + line.rstrip())
-        exitcode = s.poll()
-        if exitcode is not None:
-            for line in s.stdout:
-                if six.PY3: line = line.decode(errors='replace')
-                debug_stdout.append(line)
-            if exitcode is not None and exitcode != 0:
-                error_msg = " ".join(cmd) if not isinstance(cmd, six.string_types) else cmd
-                error_msg += "\n"
-                error_msg += "".join(debug_stdout)
-                s.communicate()
-                s.stdout.close()
-                raise subprocess.CalledProcessError(exitcode, cmd=cmd, output=error_msg)
-            else:
-                break
-    s.communicate()
-    s.stdout.close()
+    start = time.time()
+    exitcode, rusage, output_lines = _wait_future(
+        asyncio.run_coroutine_threadsafe(_supervise(cmd, shell_arg, executable_arg, env, timeout), _get_loop()))
+    telemetry.record_command(cmd, start, rusage, exitcode)
+    _log_output(output_lines)
+    if exitcode != 0:
+        raise subprocess.CalledProcessError(exitcode, cmd=cmd, output=_error_msg(cmd, output_lines))
     # Check for problems not identified by shell return codes
     if checks:
         for check in checks:
             if not check(output_fpath, input_fpath):
                 raise IOError("External command failed")
-        # except subprocess.CalledProcessError as e:
-        #     e.returncode
-        #     e.cmd
+
+
+@contextlib.contextmanager
+def stream_lines(cmd, env_vars=None):
+    """Run the command, giving its stdout as a text stream to read lines from while it runs.
+    stderr is kept in a temporary file and its tail is reported if the command fails. Use as:
+        with stream_lines(cmd) as lines:
+            for l in lines: ...
+    The stream must be read to the end; the command is killed if the block raises.
+    The command takes one of the MAX_PROCESSES slots shared with run() until it exits.
+    """
+    info(' '.join(str(x) for x in cmd) if not isinstance(cmd, six.string_types) else cmd)
+    cmd, shell_arg, executable_arg = _normalize_cmd_args(cmd)
+    loop = _get_loop()
+    _wait_future(asyncio.run_coroutine_threadsafe(_acquire_slot(), loop))
+    try:
+        with _streamed_process(cmd, shell_arg, executable_arg, env_vars) as out:
+            yield out
+    finally:
+        loop.call_soon_threadsafe(_release_slot)
+
+
+@contextlib.contextmanager
+def _streamed_process(cmd, shell_arg, executable_arg, env_vars):
+    start = time.time()
+    with tempfile.TemporaryFile() as stderr_f:
+        proc = subprocess.Popen(cmd, shell=shell_arg, executable=executable_arg,
+                                stdout=subprocess.PIPE, stderr=stderr_f,
+                                close_fds=True, env=_make_env(env_vars), start_new_session=True)
+        try:
+            with io.TextIOWrapper(proc.stdout, errors='replace') as out:
+                yield out
+        except BaseException:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            proc.wait()
+            raise
+        exitcode, rusage = _wait_with_rusage(proc)
+        telemetry.record_command(cmd, start, rusage, exitcode)
+        stderr_f.seek(0)
+        tail = _OutputTail()
+        tail.feed(stderr_f.read())
+        _log_output(tail.get_lines())
+        if exitcode != 0:
+            raise subprocess.CalledProcessError(exitcode, cmd=cmd, output=_error_msg(cmd, tail.get_lines()))
+
+
+# External commands are supervised by a single event loop running in a background thread: worker
+# threads only wait for the result, and all the output is read by the loop into ring buffers.
+MAX_PROCESSES = int(os.environ.get('TARGQC_MAX_PROCESSES') or max(4, multiprocessing.cpu_count()))
+OUTPUT_TAIL_LINES = 100
+KILL_GRACE_S = 5
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+_semaphore = None
+
+
+def _get_loop():
+    global _loop, _loop_pid, _semaphore
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():  # the loop thread doesn't survive fork
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            _semaphore = None
+            t = threading.Thread(target=_loop.run_forever, name='targqc-processes')
+            t.daemon = True
+            t.start()
+        return _loop
+
+
+def _get_semaphore():
+    """ Created lazily inside the loop thread, as asyncio primitives are bound to the running loop
+    """
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_PROCESSES)
+    return _semaphore
+
+
+async def _acquire_slot():
+    await _get_semaphore().acquire()
+
+
+def _release_slot():
+    _get_semaphore().release()
+
+
+def _wait_future(future):
+    """ Waits for the result in the calling thread; if the wait is interrupted (e.g. by Ctrl+C),
+        cancels the coroutine, which kills the process group.
+    """
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+
+class _OutputTail(object):
+    """ Ring buffer keeping the last lines of the output of a process
+    """
+    def __init__(self, max_lines=OUTPUT_TAIL_LINES):
+        self.lines = collections.deque(maxlen=max_lines)
+        self.partial = b''
+
+    def feed(self, data):
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        self.lines.extend(lines[-self.lines.maxlen:])
+
+    def get_lines(self):
+        lines = list(self.lines) + ([self.partial] if self.partial else [])
+        return [l.decode(errors='replace') for l in lines[-self.lines.maxlen:]]
+
+
+async def _supervise(cmd, shell_arg, executable_arg, env, timeout):
+    """ Runs the command in a new session (so the whole pipeline can be killed with its process group).
+        Returns (exit code, rusage, last lines of stdout and stderr).
+    """
+    async with _get_semaphore():
+        proc = subprocess.Popen(cmd, shell=shell_arg, executable=executable_arg,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                close_fds=True, env=env, start_new_session=True)
+        tail = _OutputTail()
+        try:
+            try:
+                exitcode, rusage = await asyncio.wait_for(_communicate(proc, tail), timeout)
+            except asyncio.TimeoutError:
+                await _kill_group(proc)
+                raise subprocess.TimeoutExpired(cmd, timeout, output=_error_msg(cmd, tail.get_lines()))
+            except BaseException:  # cancelled
+                await _kill_group(proc)
+                raise
+        finally:
+            proc.stdout.close()
+        return exitcode, rusage, tail.get_lines()
+
+
+async def _communicate(proc, tail):
+    await _read_output(proc.stdout, tail)
+    return await _wait_exit(proc)
+
+
+async def _read_output(pipe, tail):
+    """ Reads the pipe in big chunks as data becomes available, until EOF
+    """
+    loop = asyncio.get_event_loop()
+    fd = pipe.fileno()
+    os.set_blocking(fd, False)
+    eof = loop.create_future()
+
+    def _on_readable():
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        if data:
+            tail.feed(data)
+        elif not eof.done():
+            eof.set_result(None)
+
+    loop.add_reader(fd, _on_readable)
+    try:
+        await eof
+    finally:
+        loop.remove_reader(fd)
+
+
+async def _wait_exit(proc):
+    """ Waits for the process without blocking the loop, then reaps it with wait4 to get
+        its resource usage. Uses a pidfd where available, and polls otherwise.
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        pidfd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    if pidfd is not None:
+        exited = loop.create_future()
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+        return _wait_with_rusage(proc)
+    delay = 0.01
+    while True:
+        res = _wait_with_rusage(proc, os.WNOHANG)
+        if res is not None:
+            return res
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+async def _kill_group(proc):
+    """ SIGTERM to the process group, then SIGKILL if it's still running after KILL_GRACE_S
+    """
+    for sig, wait_s in [(signal.SIGTERM, KILL_GRACE_S), (signal.SIGKILL, None)]:
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:  # already gone
+            pass
+        waited = 0.0
+        while wait_s is None or waited < wait_s:
+            if _wait_with_rusage(proc, os.WNOHANG) is not None:
+                return
+            await asyncio.sleep(0.05)
+            waited += 0.05
+
+
+def _wait_with_rusage(proc, options=0):
+    """ Waits for proc with wait4 to get its resource usage, including the children it waited for.
+        Returns (exit code, rusage), rusage is None if the process was already reaped;
+        None with os.WNOHANG if the process is still running.
+    """
+    try:
+        pid, status, rusage = os.wait4(proc.pid, options)
+    except OSError:
+        return proc.wait(), None
+    if pid == 0:
+        return None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode, rusage
+
+
+def _error_msg(cmd, output_lines):
+    error_msg = " ".join(cmd) if not isinstance(cmd, six.string_types) else cmd
+    error_msg += "\n"
+    error_msg += "".join(l + "\n" for l in output_lines)
+    return error_msg
+
+
+def _log_output(output_lines):
+    """ The output is logged in one go after the command finishes: just the tail, and only in debug mode
+    """
+    if output_lines and logger.is_debug:
+        debug('\n'.join('  ' + l.rstrip() for l in output_lines))
 
 
 def file_nonempty_check(output_fpath=None, input_fpath=None):
@@ -1,17 +1,21 @@
+import atexit
 import getpass
 import os
 import six
-import smtplib
 import sys
+import threading
 import traceback
 from datetime import datetime
-from email.mime.text import MIMEText
 from os.path import exists, getctime
+from six.moves.queue import Queue, Empty
 from subprocess import check_output
 from targqc.utilz.utils import is_cluster, is_local
-from time import sleep
 
-log_fpath = None
+LOG_ENV_VAR = 'TARGQC_LOG_FPATH'  # passes the log path to worker processes started with spawn
+LOG_QUEUE_SIZE = 10000            # messages; writing blocks when the writer falls that much behind
+FLUSH_TIMEOUT = 30                # seconds
+
+log_fpath = os.environ.get(LOG_ENV_VAR)
 project_name = None
 project_fpath = None
 proc_name = None
@@ -57,7 +61,9 @@ past_msgs = []
 def set_log_path(log_fpath_, save_previous=False):
     assert log_fpath_
     global log_fpath, past_msgs
+    _close_writer()
     log_fpath = log_fpath_
+    os.environ[LOG_ENV_VAR] = log_fpath
     if save_previous:
         swap_file(log_fpath)
     for msg in past_msgs:
@@ -112,6 +118,7 @@ def critical(msg=''):
             return
         for m in msg:
             err(m, severity='critical')
+    flush()
     raise CriticalError(msg)
 
 
@@ -170,6 +177,8 @@ def send_email(msg_other='', subj='', only_me=False, addr_by_username=None, addr
         if proc_name:
             subj += ' - ' + proc_name
 
+    import smtplib
+    from email.mime.text import MIMEText
     msg_other = MIMEText(msg_other)
     msg_me = MIMEText(msg_me)
 
@@ -238,27 +247,127 @@ def _log(out, msg='', ending='\n', print_date=True, severity=None):
     if severity == 'warning':
         warning_msgs.append(msg)
 
-    sys.stdout.flush()
-    sys.stderr.flush()
-    if is_debug and is_local():
-        sleep(0.01)
-
     if log_fpath:
-        _write_to_file(msg_debug + ending)
+        _write_to_file(msg_debug + ending)  # the writer thread flushes stdout and stderr after each batch
     else:
+        sys.stdout.flush()
+        sys.stderr.flush()
         past_msgs.append(msg_debug + ending)
 
 
+class _Flush:
+    def __init__(self):
+        self.done = threading.Event()
+
+_STOP = object()
+
+
+class _LogWriter:
+    """ Appends messages to the log file from a background thread. Everything queued since the last
+        write goes into a single os.write on an O_APPEND descriptor, so lines from several processes
+        writing into the same log don't get mixed.
+    """
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.pid = os.getpid()
+        self._queue = Queue(maxsize=LOG_QUEUE_SIZE)
+        self._fd = None
+        self._thread = threading.Thread(target=self._run, name='targqc-log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, text):
+        self._queue.put(text)
+
+    def flush(self):
+        f = _Flush()
+        self._queue.put(f)
+        f.done.wait(FLUSH_TIMEOUT)
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join(FLUSH_TIMEOUT)
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            texts = [i for i in items if isinstance(i, six.string_types)]
+            if texts:
+                self._append(''.join(texts))
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            except (IOError, ValueError):
+                pass
+            for i in items:
+                if isinstance(i, _Flush):
+                    i.done.set()
+            if any(i is _STOP for i in items):
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+                return
+
+    def _append(self, text):
+        data = text.encode('utf-8') if isinstance(text, six.text_type) else text
+        try:
+            if self._fd is None:
+                self._fd = os.open(self.fpath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            while data:
+                data = data[os.write(self._fd, data):]
+        except OSError:
+            sys.stderr.write('Logging: cannot write to ' + self.fpath + '\n')
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer():
+    """ The writer of this process; a forked child starts its own, as the parent's thread is not copied
+    """
+    global _writer
+    if _writer is None or _writer.pid != os.getpid() or _writer.fpath != log_fpath:
+        with _writer_lock:
+            if _writer is None or _writer.pid != os.getpid() or _writer.fpath != log_fpath:
+                if _writer is not None and _writer.pid == os.getpid():
+                    _writer.close()
+                _writer = _LogWriter(log_fpath)
+    return _writer
+
+
+def _close_writer():
+    global _writer
+    if _writer is not None and _writer.pid == os.getpid():
+        _writer.close()
+    _writer = None
+
+
+def flush():
+    """ Blocks until all messages logged so far are written to the log file
+    """
+    if _writer is not None and _writer.pid == os.getpid():
+        _writer.flush()
+
+
+def _reset_after_fork():
+    global _writer, _writer_lock
+    _writer = None
+    _writer_lock = threading.Lock()
+
+atexit.register(_close_writer)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 def _write_to_file(text):
     if log_fpath:
-        try:
-            open(log_fpath, 'a').write(text)
-        except IOError:
-            sys.stderr.write('Logging: cannot append to ' + log_fpath + '\n')
-            try:
-                open(log_fpath, 'w').write(text)
-            except IOError:
-                sys.stderr.write('Logging: cannot write to ' + log_fpath + '\n')
+        _get_writer().write(text)
 
 
 def swap_file(fpath):
@@ -1,7 +1,9 @@
 import contextlib
 import os
 import subprocess
-from joblib import Parallel, delayed
+import threading
+from multiprocessing.pool import ThreadPool
+from targqc.utilz import telemetry
 from targqc.utilz.utils import is_cluster
 from targqc.utilz.file_utils import safe_mkdir
 from targqc.utilz.logger import debug, err
@@ -14,10 +16,12 @@ class ParallelCfg:
                  resources=None,
                  threads=None,
                  tag=None,
-                 local=False):
+                 local=False,
+                 max_mem=None):
         self.scheduler = scheduler
         self.queue = queue
         self.threads = threads or 1
+        self.max_mem = max_mem  # memory budget for local jobs in megabytes, default is the available memory
         self.extra_params = dict()
     
         self.extra_params['run_local'] = local or not is_cluster()
@@ -35,6 +39,14 @@ class ParallelCfg:
     def cores_per_job(self, n_jobs):
         return max(1, self.threads // n_jobs)
 
+    def mem_budget_m(self):
+        if self.max_mem:
+            return self.max_mem
+        available_m = get_available_mem_m()
+        if available_m is None:
+            return None
+        return max(available_m - SYSTEM_MEM_RESERVE_M, 0)
+
     def get_cluster_params(self, n_samples):
         return dict(
             scheduler=self.scheduler,
@@ -45,21 +57,107 @@ class ParallelCfg:
             extra_params=self.extra_params)
 
 
-def get_parallel_view(n_samples, parallel_cfg):
+SYSTEM_MEM_RESERVE_M = 1024  # left for the system and the main process when the budget is not set explicitly
+
+
+def get_available_mem_m():
+    """ MemAvailable from /proc/meminfo in megabytes, or the physical memory size if it's not there
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for l in f:
+                if l.startswith('MemAvailable:'):
+                    return int(l.split()[1]) // 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 1024 // 1024
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def parse_mem_m(mem):
+    """ "48G" -> 49152, "500M" -> 500, "1024" -> 1024 (megabytes)
+    """
+    if mem is None:
+        return None
+    mem = str(mem).strip().upper().rstrip('B')
+    factor = 1
+    if mem.endswith('T'):
+        factor = 1024 * 1024
+    elif mem.endswith('G'):
+        factor = 1024
+    if mem and mem[-1] in 'TGM':
+        mem = mem[:-1]
+    return int(float(mem) * factor)
+
+
+class MemoryScheduler:
+    """ Admits jobs while their memory estimates fit into budget_m. A job that doesn't fit into the free
+        memory is shrunk down to no less than its min_mem_m, with threads reduced proportionally, or waits
+        for running jobs to finish if even that doesn't fit. A job is always admitted when nothing else runs.
+    """
+    def __init__(self, budget_m):
+        self.budget_m = budget_m
+        self.used_m = 0
+        self.running = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, mem_m, min_mem_m, threads):
+        """ Blocks until the job is admitted, returns the granted (threads, mem_m)
+        """
+        min_mem_m = min(min_mem_m or mem_m, mem_m)
+        with self._cond:
+            while True:
+                if self.budget_m is None:
+                    granted_m = mem_m
+                    break
+                free_m = self.budget_m - self.used_m
+                if mem_m <= free_m:
+                    granted_m = mem_m
+                    break
+                if min_mem_m <= free_m:
+                    granted_m = free_m
+                    break
+                if self.running == 0:
+                    granted_m = min_mem_m
+                    break
+                self._cond.wait()
+            self.used_m += granted_m
+            self.running += 1
+        if granted_m < mem_m:
+            debug('Memory budget: shrinking job from ' + str(mem_m) + 'M to ' + str(granted_m) + 'M')
+            threads = max(1, int(threads * granted_m // mem_m))
+        return threads, granted_m
+
+    def release(self, mem_m):
+        with self._cond:
+            self.used_m -= mem_m
+            self.running -= 1
+            self._cond.notify_all()
+
+
+def _call_with_resources(fn, params, threads, mem_m):
+    return fn(*params, threads=threads, mem_m=mem_m)
+
+
+def get_parallel_view(n_samples, parallel_cfg, sample_names=None):
     if parallel_cfg.scheduler and parallel_cfg.threads > 1:
         debug('Starting' + (' test' if not is_cluster() else '') + ' cluster (scheduler: ' + parallel_cfg.scheduler + ', queue: ' + parallel_cfg.queue + ') '
               'using ' + str(parallel_cfg.num_jobs(n_samples)) + ' nodes, ' + str(parallel_cfg.cores_per_job(n_samples)) + ' threads per each sample')
-        return ClusterView(n_samples, parallel_cfg)
+        return ClusterView(n_samples, parallel_cfg, sample_names)
     else:
         debug('Running locally using ' + str(parallel_cfg.num_jobs(n_samples)) + ' thread(s)')
-        return ThreadedView(n_samples, parallel_cfg)
+        return ThreadedView(n_samples, parallel_cfg, sample_names)
 
 
 @contextlib.contextmanager
-def parallel_view(n_samples, parallel_cfg, work_dir):
+def parallel_view(n_samples, parallel_cfg, work_dir, sample_names=None):
+    """ sample_names: names of samples the jobs run for, in the order of param lists, to tag telemetry records
+    """
     prev_dir = os.getcwd()
     os.chdir(safe_mkdir(work_dir))
-    view = get_parallel_view(n_samples, parallel_cfg)
+    view = get_parallel_view(n_samples, parallel_cfg, sample_names)
     os.chdir(prev_dir)
     try:
         yield view
@@ -68,23 +166,39 @@ def parallel_view(n_samples, parallel_cfg, work_dir):
 
 
 class BaseView:
-    def __init__(self, n_samples, parallel_cfg):
+    def __init__(self, n_samples, parallel_cfg, sample_names=None):
         self.n_samples = n_samples
         self.parallel_cfg = parallel_cfg
         self.num_jobs = parallel_cfg.num_jobs(n_samples)
         self.cores_per_job = parallel_cfg.cores_per_job(n_samples)
+        self.sample_names = sample_names
         self._view = None
 
+    def _job_tags(self, job_i):
+        tags = telemetry.get_tags()
+        if self.sample_names and job_i < len(self.sample_names):
+            tags['sample'] = self.sample_names[job_i]
+        tags['dir'] = telemetry.get_dir()
+        tags['profile_dir'] = os.environ.get(telemetry.PROFILE_ENV_VAR)
+        return tags
+
     def run(self, fn, param_lists):
         raise NotImplementedError
 
+    def run_within_memory(self, fn, param_lists, mem_m_by_job, min_mem_m_by_job=None):
+        """ Runs fn(*params, threads=threads, mem_m=mem_m) for each job. Cluster jobs get the requested
+            memory, as the nodes are managed by the scheduler.
+        """
+        return self.run(_call_with_resources,
+            [[fn, params, self.cores_per_job, mem_m] for params, mem_m in zip(param_lists, mem_m_by_job)])
+
     def stop(self):
         raise NotImplementedError
 
 
 class ClusterView(BaseView):
-    def __init__(self, n_samples, parallel_cfg):
-        BaseView.__init__(self, n_samples, parallel_cfg)
+    def __init__(self, n_samples, parallel_cfg, sample_names=None):
+        BaseView.__init__(self, n_samples, parallel_cfg, sample_names)
         from cluster_helper.cluster import ClusterView as CV
         self._view = CV(**parallel_cfg.get_cluster_params(n_samples))
         debug('Starting cluster with ' + str(self.num_jobs) + ' open nodes, ' + str(self.cores_per_job) + ' cores per node')
@@ -100,7 +214,9 @@ class ClusterView(BaseView):
             if len(params) != n_params:
                 err('Parameter list for sample ' + str(sample_i) + ' (' + str(len(params)) +
                     ') does not equal to the one for sample 1 (' + str(n_params) + ')')
-        res = self._view.view.map(fn, *([params[param_i] for params in param_lists] for param_i in range(n_params)))
+        with telemetry.span('batch', fn.__name__):
+            res = self._view.view.map(telemetry.run_tagged, [fn] * len(param_lists),
+                                      [self._job_tags(i) for i in range(len(param_lists))], param_lists)
         return res
 
     def stop(self):
@@ -108,14 +224,44 @@ class ClusterView(BaseView):
 
 
 class ThreadedView(BaseView):
-    def __init__(self, n_samples, parallel_cfg):
-        BaseView.__init__(self, n_samples, parallel_cfg)
+    def __init__(self, n_samples, parallel_cfg, sample_names=None):
+        BaseView.__init__(self, n_samples, parallel_cfg, sample_names)
+        from joblib import Parallel
         self._view = Parallel(n_jobs=self.num_jobs)
 
     def run(self, fn, param_lists):
         debug('Starting multithreaded function' + str(fn))
         assert self.n_samples == len(param_lists)
-        return self._view(delayed(fn)(*params) for params in param_lists)
+        from joblib import delayed
+        with telemetry.span('batch', fn.__name__):
+            return self._view(delayed(telemetry.run_tagged)(fn, self._job_tags(i), params)
+                              for i, params in enumerate(param_lists))
+
+    def run_within_memory(self, fn, param_lists, mem_m_by_job, min_mem_m_by_job=None):
+        """ Runs fn(*params, threads=threads, mem_m=mem_m) for each job in threads (the jobs are expected
+            to spend their time in subprocesses), admitting jobs in order while they fit into the memory budget.
+        """
+        assert self.n_samples == len(param_lists)
+        min_mem_m_by_job = min_mem_m_by_job or mem_m_by_job
+        budget_m = self.parallel_cfg.mem_budget_m()
+        debug('Starting ' + str(fn) + ' with memory budget ' + (str(budget_m) + 'M' if budget_m is not None else 'unlimited') +
+              ', requested ' + ', '.join(str(m) + 'M' for m in mem_m_by_job))
+        scheduler = MemoryScheduler(budget_m)
+
+        def _run_job(i):
+            threads, mem_m = scheduler.acquire(mem_m_by_job[i], min_mem_m_by_job[i], self.cores_per_job)
+            try:
+                return telemetry.run_tagged(fn, self._job_tags(i), param_lists[i], dict(threads=threads, mem_m=mem_m))
+            finally:
+                scheduler.release(mem_m)
+
+        pool = ThreadPool(max(1, self.num_jobs))
+        try:
+            with telemetry.span('batch', fn.__name__):
+                return pool.map(_run_job, range(len(param_lists)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
 
     def stop(self):
         return
@@ -1,6 +1,8 @@
-from os.path import dirname, join, abspath, splitext, isfile
+import os
+import tempfile
+from os.path import dirname, join, abspath, splitext, isfile, getmtime
 from targqc.utilz.logger import critical, debug
-from targqc.utilz.file_utils import verify_file, adjust_path, verify_dir
+from targqc.utilz.file_utils import verify_file, adjust_path, verify_dir, file_transaction
 
 SUPPORTED_GENOMES = ['hg19', 'hg19-noalt', 'hg38', 'hg38-noalt', 'hg19-chr21', 'GRCh37', 'mm10']
 
@@ -25,7 +27,22 @@ def _get(relative_path, genome=None):
 def get_fai(genome):
     return _get(join('fai', '{genome}.fa.fai'), genome)
 
-def get_chrom_lengths(genome=None, fai_fpath=None):
+class ChromInfo:
+    """ Chromosome names and lengths of one reference, in the reference order
+    """
+    def __init__(self, chr_lengths):
+        self.chr_lengths = chr_lengths
+        self.length_by_chrom = dict(chr_lengths)
+        self.order_by_chrom = {c: i for i, (c, l) in enumerate(chr_lengths)}
+
+
+_chrom_info_by_key = dict()
+
+
+def _get_chrom_info(genome=None, fai_fpath=None):
+    """ Process-wide registry of ChromInfo, keyed by the resolved path and its modification time,
+        so each reference is read at most once while it stays unchanged
+    """
     assert genome or fai_fpath, 'One of genome or fai_fpath should be not None: ' \
                                 'genome=' + str(genome) + ' fai_fpath=' + str(fai_fpath)
 
@@ -37,32 +54,82 @@ def get_chrom_lengths(genome=None, fai_fpath=None):
         if not fai_fpath.endswith('.fai') and not fai_fpath.endswith('.fa'):
             critical('Error: .fai or .fa is accepted.')
 
-    chr_lengths = []
+    key = (fai_fpath, getmtime(fai_fpath))
+    chrom_info = _chrom_info_by_key.get(key)
+    if chrom_info is None:
+        if fai_fpath.endswith('.fa'):
+            chr_lengths = _read_fai(_index_fasta(fai_fpath))
+        else:
+            chr_lengths = _read_fai(fai_fpath)
+        chrom_info = _chrom_info_by_key[key] = ChromInfo(chr_lengths)
+    return chrom_info
 
-    if fai_fpath.endswith('.fa'):
-        debug('Reading genome sequence (.fa) to get chromosome lengths')
-        with open(fai_fpath, 'r') as handle:
-            from Bio import SeqIO
-            reference_records = SeqIO.parse(handle, 'fasta')
-            for record in reference_records:
-                chrom = record.id
-                chr_lengths.append((chrom, len(record.seq)))
 
-    else:
-        debug('Reading genome index file (.fai) to get chromosome lengths')
-        with open(fai_fpath, 'r') as handle:
-            for line in handle:
-                line = line.strip()
-                if line:
-                    chrom, length = line.split()[0], int(line.split()[1])
-                    chr_lengths.append((chrom, length))
+def get_chrom_lengths(genome=None, fai_fpath=None):
+    return list(_get_chrom_info(genome, fai_fpath).chr_lengths)
 
+def get_chrom_order(genome=None, fai_fpath=None):
+    return dict(_get_chrom_info(genome, fai_fpath).order_by_chrom)
+
+def get_chrom_length(chrom, genome=None, fai_fpath=None):
+    """ Returns the length of chrom, or None if the reference doesn't have it
+    """
+    return _get_chrom_info(genome, fai_fpath).length_by_chrom.get(chrom)
+
+
+def _read_fai(fai_fpath):
+    debug('Reading genome index file (.fai) to get chromosome lengths')
+    chr_lengths = []
+    with open(fai_fpath, 'r') as handle:
+        for line in handle:
+            line = line.strip()
+            if line:
+                fs = line.split()
+                chr_lengths.append((fs[0], int(fs[1])))
     return chr_lengths
 
-def get_chrom_order(genome=None, fai_fpath=None):
-    chr_lengths = get_chrom_lengths(genome, fai_fpath)
-    chr_order = {c: i for i, (c, l) in enumerate(chr_lengths)}
-    return chr_order
+
+def _index_fasta(fa_fpath):
+    """ Returns the .fai path next to fa_fpath, building it with one streaming pass
+        over the sequence if it's missing or older than the FASTA. If the index
+        can't be written next to the FASTA, it's kept in a temporary file.
+    """
+    fai_fpath = fa_fpath + '.fai'
+    if isfile(fai_fpath) and getmtime(fai_fpath) >= getmtime(fa_fpath):
+        return fai_fpath
+
+    debug('Indexing genome sequence (.fa) to get chromosome lengths')
+    records = []
+    with open(fa_fpath, 'rb') as handle:
+        rec = None
+        offset = 0
+        for line in handle:
+            line_len = len(line)
+            if line.startswith(b'>'):
+                if rec:
+                    records.append(rec)
+                name = line[1:].split()[0].decode()
+                rec = [name, 0, offset + line_len, None, None]
+            elif rec is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if rec[3] is None:
+                    rec[3], rec[4] = bases, line_len
+                rec[1] += bases
+            offset += line_len
+        if rec:
+            records.append(rec)
+
+    fai_lines = ''.join('\t'.join(str(v if v is not None else 0) for v in rec) + '\n' for rec in records)
+    try:
+        with file_transaction(None, fai_fpath) as tx:
+            with open(tx, 'w') as out:
+                out.write(fai_lines)
+    except (IOError, OSError):
+        debug('Cannot write ' + fai_fpath + ', keeping the index in a temporary file')
+        fd, fai_fpath = tempfile.mkstemp(suffix='.fai')
+        with os.fdopen(fd, 'w') as out:
+            out.write(fai_lines)
+    return fai_fpath
 
 def ucsc_to_ensembl(genome):
     """ mysql --user=genome --host=genome-mysql.cse.ucsc.edu -A -N -e "select * from ucscToEnsembl;" hg19 > hg19.ucscToEnsembl.tsv
@@ -1,19 +1,25 @@
 from __future__ import division
 
+import base64
 import datetime
+import hashlib
 import io
 import itertools
+import os
+import marshal
+import re
 import shutil
 import six
 import traceback
 from collections import OrderedDict
 from itertools import repeat
-from json import load, dump
+from json import load, dump, dumps
 from math import floor
+from multiprocessing.pool import ThreadPool
 from os.path import join, relpath, dirname, abspath, basename
 
 from targqc.utilz import jsontemplate
-from targqc.utilz import logger
+from targqc.utilz import logger, telemetry
 from targqc.utilz.file_utils import file_transaction, verify_file, safe_mkdir
 from targqc.utilz.logger import critical, info, err, warn, debug
 from targqc.utilz.utils import mean
@@ -25,6 +31,9 @@ except ImportError:
 
 
 EMBED_ASSETS = True
+REPORT_CACHE_VERSION = 1  # bump when the format of cached sample report JSONs changes
+LOAD_THREADS = 8
+COMPACT_HTML_MIN_SAMPLES = 500
 
 
 def get_int_val(v):
@@ -375,7 +384,7 @@ class BaseReport:
 
     def save_html(self, output_fpath, caption='',  #type_=None,
                   extra_js_fpaths=list(), extra_css_fpaths=list(),
-                  tmpl_fpath=None, data_dict=None):
+                  tmpl_fpath=None, data_dict=None, compact=False):
         # class Encoder(JSONEncoder):
         #     def default(self, o):
         #         if isinstance(o, (VariantCaller, BCBioSample)):
@@ -390,7 +399,7 @@ class BaseReport:
         safe_mkdir(dirname(output_fpath))
         fpath = write_html_report(self, output_fpath, caption=caption,
                                   extra_js_fpaths=extra_js_fpaths, extra_css_fpaths=extra_css_fpaths,
-                                  tmpl_fpath=tmpl_fpath, data_dict=data_dict)
+                                  tmpl_fpath=tmpl_fpath, data_dict=data_dict, compact=compact)
         self.html_fpath = fpath
         return fpath
 
@@ -497,10 +506,10 @@ class SampleReport(BaseReport):
 
     def save_html(self, output_fpath, caption='', #type_=None,
             extra_js_fpaths=list(), extra_css_fpaths=list(),
-            tmpl_fpath=None, data_dict=None):
+            tmpl_fpath=None, data_dict=None, compact=False):
         return BaseReport.save_html(self, output_fpath, caption=caption, #type_='SampleReport',
                     extra_js_fpaths=extra_js_fpaths, extra_css_fpaths=extra_css_fpaths,
-                    tmpl_fpath=tmpl_fpath, data_dict=data_dict)
+                    tmpl_fpath=tmpl_fpath, data_dict=data_dict, compact=compact)
 
     def __repr__(self):
         return self.display_name + (', ' + self.report_name if self.report_name else '')
@@ -587,10 +596,15 @@ class PerRegionSampleReport(SampleReport):
             sections = [sections]
 
         rows = []
+        metrics = self.metric_storage.get_metrics(sections=sections, skip_general_section=True)
         for i, row in enumerate(self.rows):
             recs = []
-            for metric in self.metric_storage.get_metrics(sections=sections, skip_general_section=True):
-                rec = BaseReport.find_record(row.records, metric.name)
+            rec_by_metric = dict()
+            for rec in row.records:  # the first record of a metric, as in find_record
+                if rec.metric is not None:
+                    rec_by_metric.setdefault(rec.metric.name, rec)
+            for metric in metrics:
+                rec = rec_by_metric.get(metric.name)
                 if rec:
                     recs.append(rec)
                 else:
@@ -709,27 +723,35 @@ class FullReport(BaseReport):
 
     @staticmethod
     def construct_from_sample_report_jsons(samples, output_dirpath,
-            jsons_by_sample, htmls_by_sample, bcbio_structure=None):
+            jsons_by_sample, htmls_by_sample, bcbio_structure=None, cache_dirpath=None):
+        """ cache_dirpath: where parsed JSONs are cached between runs (see load_report_json)
+        """
         ms = None
         sample_reports = []
-        for sample in samples:
-            if sample.name in jsons_by_sample:
-                with open(jsons_by_sample[sample.name]) as f:
-                    data = load(f, object_pairs_hook=OrderedDict)
-                    sr = SampleReport.load(data, sample, bcbio_structure)
-                    sr.html_fpath = htmls_by_sample.get(sample.name)
-                    if sr.html_fpath:
-                        sr.url = relpath(sr.html_fpath, output_dirpath)
-                    sample_reports.append(sr)
-                    if ms is None:
-                        ms = sr.metric_storage
-                    else:  # Maximize metric storage
-                        FullReport._sync_sections(ms.general_section, sr.metric_storage.general_section)
-                        for section in sr.metric_storage.sections:
-                            if section.name not in ms.sections_by_name:
-                                ms.add_section(section)
-                            else:
-                                FullReport._sync_sections(ms.sections_by_name[section.name], section)
+        samples = [s for s in samples if s.name in jsons_by_sample]
+        if cache_dirpath:
+            safe_mkdir(cache_dirpath)
+        pool = ThreadPool(max(1, min(LOAD_THREADS, len(samples))))
+        try:
+            datas = pool.map(lambda s: load_report_json(jsons_by_sample[s.name], cache_dirpath), samples)
+        finally:
+            pool.close()
+            pool.join()
+        for sample, data in zip(samples, datas):
+            sr = SampleReport.load(data, sample, bcbio_structure)
+            sr.html_fpath = htmls_by_sample.get(sample.name)
+            if sr.html_fpath:
+                sr.url = relpath(sr.html_fpath, output_dirpath)
+            sample_reports.append(sr)
+            if ms is None:
+                ms = sr.metric_storage
+            else:  # Maximize metric storage
+                FullReport._sync_sections(ms.general_section, sr.metric_storage.general_section)
+                for section in sr.metric_storage.sections:
+                    if section.name not in ms.sections_by_name:
+                        ms.add_section(section)
+                    else:
+                        FullReport._sync_sections(ms.sections_by_name[section.name], section)
 
         for sr in sample_reports:
             sr.metric_storage = ms
@@ -748,17 +770,22 @@ class FullReport(BaseReport):
             self.save_tsv(base_path + '.tsv', sections), \
             self.save_html(base_path + '.html', caption)
 
+    @telemetry.profiled('save_html')
     def save_html(self, output_fpath, caption='',  #type_=None,
                   display_name=None, extra_js_fpaths=None, extra_css_fpaths=None,
-                  tmpl_fpath=None, data_dict=None):
+                  tmpl_fpath=None, data_dict=None, compact=None):
+        """ compact: see write_html_report. By default, compact for COMPACT_HTML_MIN_SAMPLES samples or more.
+        """
         safe_mkdir(dirname(output_fpath))
         if len(self.sample_reports) == 0:
             err('No sample reports found: HTML summary will not be made.')
             return None
+        if compact is None:
+            compact = len(self.sample_reports) >= COMPACT_HTML_MIN_SAMPLES
 
         return BaseReport.save_html(self, output_fpath, caption=caption,  #type_='FullReport',
             extra_js_fpaths=extra_js_fpaths, extra_css_fpaths=extra_css_fpaths,
-            tmpl_fpath=tmpl_fpath, data_dict=data_dict)
+            tmpl_fpath=tmpl_fpath, data_dict=data_dict, compact=compact)
 
     def __repr__(self):
         return self.name
@@ -855,7 +882,11 @@ class MetricStorage:
         self.sections_by_name[section_name].add_metric(metric)
 
     def find_metric(self, metric_name):
-        return next((m for m in self.get_metrics() if m.name == metric_name), None)
+        for section in self.sections + [self.general_section]:
+            metric = section.find_metric(metric_name)
+            if metric is not None:
+                return metric
+        return None
 
     def remove_metric(self, metric_name):
         for section in self.sections:
@@ -891,6 +922,50 @@ def read_sample_names(sample_fpath):
     return sample_names
 
 
+def load_report_json(json_fpath, cache_dirpath=None):
+    """ Parsed report JSON. With cache_dirpath, the parsed data is cached there in marshal format
+        (plain dicts and lists, nothing is executed on load), used while the JSON has the same path,
+        modification time and size.
+    """
+    if not cache_dirpath:
+        with open(json_fpath) as f:
+            return load(f, object_pairs_hook=OrderedDict)
+
+    json_fpath = abspath(json_fpath)
+    st = os.stat(json_fpath)
+    stamp = (REPORT_CACHE_VERSION, json_fpath, st.st_mtime, st.st_size)
+    cache_fpath = join(cache_dirpath, hashlib.md5(json_fpath.encode()).hexdigest() + '.marshal')
+    if verify_file(cache_fpath, silent=True):
+        try:
+            with open(cache_fpath, 'rb') as f:
+                cached_stamp, data = marshal.load(f)
+        except Exception:
+            debug('Cannot read the cache ' + cache_fpath + ', parsing ' + json_fpath)
+        else:
+            if tuple(cached_stamp) == stamp:
+                return data
+
+    with open(json_fpath) as f:
+        data = load(f, object_pairs_hook=OrderedDict)
+    try:
+        with file_transaction(cache_dirpath, cache_fpath) as tx:
+            with open(tx, 'wb') as f:
+                marshal.dump((stamp, _to_plain(data)), f)
+    except (IOError, OSError, ValueError) as e:
+        debug('Cannot cache ' + json_fpath + ': ' + str(e))
+    return data
+
+
+def _to_plain(data):
+    """ data with OrderedDicts turned into dicts (which keep the order), as marshal only takes the built-in types
+    """
+    if isinstance(data, dict):
+        return dict((k, _to_plain(v)) for k, v in data.items())
+    if isinstance(data, list):
+        return [_to_plain(v) for v in data]
+    return data
+
+
 def load_records(json_fpath):
     with open(json_fpath) as f:
         data = load(f, object_pairs_hook=OrderedDict)
@@ -1037,6 +1112,7 @@ js_files = [
     # 'bootstrap/bootstrap-tooltip-5px-lower.min.js',
     'dragtable.js',
     'table_sorter/tsort.js',
+    'scripts/compact_table.js',
 ]
 image_files = [
     # 'table_sorter/arrow_asc.png',
@@ -1163,21 +1239,11 @@ def make_cell_td(rec, class_=''):
     if rec.metric.is_hidden:
         class_ += ' always_hidden_row'
 
-    style = ''
-    if rec.metric.style:
-        style += rec.metric.style + '; '
-    if rec.metric.td_style:
-        style += rec.metric.td_style + '; '
+    style = _metric_td_style(rec.metric)
     if rec.color:
         style += 'background-color: ' + rec.color + '; '
     if rec.text_color:
         style += 'color: ' + rec.text_color + '; '
-    if rec.metric.max_width is not None:
-        style += 'max-width: {w}px; width: {w}px; '.format(w=rec.metric.max_width)
-    if rec.metric.min_width is not None:
-        style += 'min-width: {w}px; '.format(w=rec.metric.min_width)
-    if rec.metric.align:
-        style += 'text-align: ' + rec.metric.align + '; '
 
     html += '\n<td metric="' + rec.metric.name + '" style="' + style + '"'
     if rec.id:
@@ -1208,8 +1274,27 @@ def make_cell_td(rec, class_=''):
     html += '"'
     # if rec.metric.width is not None:
     #     html += ' width=' + str(rec.metric.width)
-    html += '>'
+    html += '>' + _cell_contents_html(rec) + '</td>'
+    return html
+
 
+def _metric_td_style(metric):
+    style = ''
+    if metric.style:
+        style += metric.style + '; '
+    if metric.td_style:
+        style += metric.td_style + '; '
+    if metric.max_width is not None:
+        style += 'max-width: {w}px; width: {w}px; '.format(w=metric.max_width)
+    if metric.min_width is not None:
+        style += 'min-width: {w}px; '.format(w=metric.min_width)
+    if metric.align:
+        style += 'text-align: ' + metric.align + '; '
+    return style
+
+
+def _cell_contents_html(rec):
+    html = ''
     if rec.right_shift:
         padding_style = 'margin-left: ' + str(rec.right_shift) + 'px; margin-right: -' + str(rec.right_shift) + 'px;'
     else:
@@ -1233,7 +1318,6 @@ def make_cell_td(rec, class_=''):
     else:
         html += '<span style="' + str(padding_style) + '" ' + \
                 __get_meta_tag_contents(rec) + '>' + rec.cell_contents + '</span>'
-    html += '</td>'
     return html
 
 
@@ -1318,6 +1402,88 @@ def build_section_html(report, section, sortable=True):
     return html
 
 
+def build_compact_report_html(report):
+    """ Same as build_report_html, but the tables are empty placeholders, and the records are
+        in a JSON blob rendered page by page in the browser by scripts/compact_table.js.
+    """
+    data = build_report_data(report)
+
+    report_html = _build_common_records(report.get_common_records())
+    if len(data['sections']) > 1:
+        report_html += '<div class="space_8px"></div>'
+        report_html += '<div>'
+        for section in data['sections']:
+            report_html += '<a class="dotted-link" href="#' + section['name'] + '">' + section['title'] + '</a><span>&nbsp;&nbsp;&nbsp;</span>'
+        report_html += '</div>'
+        report_html += '<div class="space_4px"></div>'
+
+    for section in data['sections']:
+        if len(data['sections']) > 1:
+            report_html += '<a name="' + section['name'] + '"></a>'
+        if section['title']:
+            report_html += '\n<h3 class="table_name">' + section['title'] + '</h3>'
+        report_html += '\n<div class="compact_section" id="compact_section_' + section['name'] + '"></div>'
+
+    # "</" would end the script element
+    report_html += '\n<script type="application/json" id="report_data">' + \
+                   dumps(data, separators=(',', ':')).replace('</', '<\\/') + '</script>\n'
+    return report_html
+
+
+def build_report_data(report):
+    """ Sections of the report with the records column by column: cell contents HTML, numbers
+        to sort by, and heatmap colors. Color lists are None when no cell of the column is colored.
+    """
+    sections = []
+    for section in report.metric_storage.sections:
+        rows = report.get_rows_of_records(sections=[section])
+        if not rows:
+            continue
+        calc_cell_contents(report, rows)
+        if not report.keep_order:
+            rows.sort(key=lambda r: r.records[0].num if r.records[0].metric.numbers else r.records[0].value)
+
+        header = build_table_header_row(section)
+        metrics = [m for m in section.get_metrics() if m.values or m.is_mandatory]
+        columns = []
+        for col_num, metric in enumerate(metrics):
+            class_ = 'td ' + ('left_column_td ' if col_num == 0 else '') + metric.td_class + ' ' + metric.class_
+            if metric.is_hidden:
+                class_ += ' always_hidden_row'
+            columns.append(OrderedDict([
+                ('metric', metric.name),
+                ('style', _metric_td_style(metric)),
+                ('class_', class_),
+                ('cells', []),
+                ('nums', []),
+                ('colors', []),
+                ('text_colors', []),
+            ]))
+        for row in rows:
+            recs = [rec for rec in row.records if rec.metric.values or rec.metric.is_mandatory]
+            for column, rec in zip(columns, recs):
+                column['cells'].append(_cell_contents_html(rec))
+                column['nums'].append(rec.num)
+                column['colors'].append(rec.color)
+                column['text_colors'].append(rec.text_color)
+        for column in columns:
+            for key in ['colors', 'text_colors']:
+                if not any(column[key]):
+                    column[key] = None
+
+        row_colors = [row.color for row in rows]
+        highlighted = [1 if row.highlighted else 0 for row in rows]
+        sections.append(OrderedDict([
+            ('name', section.name),
+            ('title', section.title),
+            ('header', header),
+            ('columns', columns),
+            ('row_colors', row_colors if any(row_colors) else None),
+            ('highlighted', highlighted if any(highlighted) else None),
+        ]))
+    return dict(sections=sections)
+
+
 def __get_meta_tag_contents(rec):
     # meta = rec.meta
     #
@@ -1556,34 +1722,28 @@ def calc_cell_contents(report, rows):
 
 def write_html_report(report, html_fpath, caption='',
                       extra_js_fpaths=None, extra_css_fpaths=None, image_by_key=None,
-                      tmpl_fpath=None, data_dict=None):
-
-    report_html = build_report_html(report)
+                      tmpl_fpath=None, data_dict=None, compact=False):
+    """ compact: records go into the page as a JSON blob, and the tables are rendered page by page
+        in the browser. For reports with too many rows for a browser to lay out as one table.
+    """
+    report_html = build_compact_report_html(report) if compact else build_report_html(report)
     plots_html = ''.join('<img src="' + plot + '"/>' for plot in report.plots)
 
     tmpl_fpath = tmpl_fpath or template_fpath
-    with open(tmpl_fpath) as in_f:
-        with file_transaction(None, html_fpath) as tx:
-            debug('__write_html: work_dir=' + dirname(tx))
-            debug('__write_html: html_fpath=' + html_fpath)
-            debug('__write_html: tx=' + tx)
-            safe_mkdir(dirname(tx))
-            
-            with io.open(tx, 'w', encoding='utf-8') as out_f:
-                for l in in_f:
-                    l = _embed_css_and_scripts(l, dirname(html_fpath), extra_js_fpaths, extra_css_fpaths)
-                    l = _embed_images(l, dirname(html_fpath), image_by_key)
-                    l = _insert_into_html(l, caption, 'caption')
-                    l = _insert_into_html(l, datetime.datetime.now().strftime('%d %B %Y, %A, %H:%M:%S'), 'report_date')
-                    l = _insert_into_html(l, report_html, 'report')
-                    l = _insert_into_html(l, plots_html, 'plots')
-                    if data_dict:
-                        for keyword, text in data_dict.items():
-                            l = _insert_into_html(l, text, keyword)
-                    if six.PY2:
-                        l = l.decode('utf-8')
-                    out_f.write(l)
-    return html_fpath
+    with io.open(tmpl_fpath, encoding='utf-8') as f:
+        html = f.read()
+
+    html = _embed_css_and_scripts(html, dirname(html_fpath), extra_js_fpaths, extra_css_fpaths)
+    html = _embed_images(html, dirname(html_fpath), image_by_key)
+
+    text_by_keyword = dict(data_dict or {})
+    text_by_keyword['caption'] = caption
+    text_by_keyword['report_date'] = datetime.datetime.now().strftime('%d %B %Y, %A, %H:%M:%S')
+    text_by_keyword['report'] = report_html
+    text_by_keyword['plots'] = plots_html
+    html = _fill_template(html, text_by_keyword)
+
+    return __write_html(html, html_fpath, extra_js_fpaths, extra_css_fpaths, image_by_key)
 
 
 def calc_heatmap_stats(metric):
@@ -1648,7 +1808,24 @@ def calc_heatmap_stats(metric):
 #             copy_aux_file(aux_f_relpath)
 
 
-import base64
+_asset_cache = dict()  # (file path, modification time, kind) -> contents ready to embed
+
+
+def _read_asset(fpath, kind):
+    """ Contents of a static file to embed into reports: base64 data URI for kind="image",
+        indented ASCII text for kind="text". Read and encoded once per process and file version.
+    """
+    key = (fpath, os.path.getmtime(fpath), kind)
+    if key not in _asset_cache:
+        if kind == 'image':
+            with open(fpath, 'rb') as f:
+                contents = 'data:image/png;base64,' + base64.b64encode(f.read()).decode('ascii')
+        else:
+            with io.open(fpath, encoding='utf-8') as f:
+                contents = _to_ascii('\n'.join(' ' * 8 + l for l in f.read().split('\n')))
+        _asset_cache[key] = contents
+    return _asset_cache[key]
+
 
 def _embed_images(html, report_dirpath, image_by_key):
     ptrn = '<img src="{key}"'
@@ -1667,10 +1844,7 @@ def _embed_images(html, report_dirpath, image_by_key):
         if not EMBED_ASSETS:  # Not embedding, just adding links
             new_piece = old_piece.replace(key, relpath(fpath, report_dirpath))
         else:
-            with open(fpath, 'rb') as f:
-                encoded_string = base64.b64encode(f.read())
-            binary_image = 'data:image/png;base64,' + encoded_string
-            new_piece = old_piece.replace(key, binary_image)
+            new_piece = old_piece.replace(key, _read_asset(fpath, 'image'))
 
         html = html.replace(old_piece, new_piece)
         debug('Done.', print_date=False)
@@ -1693,6 +1867,9 @@ def _embed_css_and_scripts(html, report_dirpath, extra_js_fpaths=None, extra_css
     if '<link' not in html and '<script' not in html:
         return html
 
+    if EMBED_ASSETS:
+        html = _to_ascii(html)
+
     for line_tmpl, files, l_tag, r_tag in [
             (js_line_tmpl, extra_js_fpaths + js_files, js_l_tag, js_r_tag),
             (css_line_tmpl, extra_css_fpaths + css_files, css_l_tag, css_r_tag),
@@ -1718,39 +1895,37 @@ def _embed_css_and_scripts(html, report_dirpath, extra_js_fpaths=None, extra_css
                 line_formatted = line.replace(rel_fpath, relpath_in_aux)
                 html = html.replace(line, line_formatted)
 
-            else:
-                with io.open(fpath, encoding='utf-8') as f:
-                    contents = f.read()
-                    contents = '\n'.join(' ' * 8 + l for l in contents.split('\n'))
-
-                    try:
-                        html = ''.join(i for i in html if ord(i) < 128)
-                        contents = ''.join(i for i in contents if ord(i) < 128)
-                        if line in html:
-                            debug('Embedding ' + rel_fpath + '...')
-                            html = html.replace(line, l_tag_formatted + '\n' + contents + '\n' + r_tag)
-                    except Exception:
-                        err()
-                        # print contents
-                        err()
-                        err(traceback.format_exc())
-                        err()
-                        err('Encoding problem embeding this file into html: ' + rel_fpath, print_date=False)
-                        err()
-                        continue
-
-                # try:
-                #     html = html_ascii.encode('ascii').replace(line, l_tag_fmt + '\n' + contents + '\n' + r_tag)
-                # except:
-                #     pass
-                    # err('line - cannot replace')  # + str(l_tag_fmt + '\n' + contents + '\n' + r_tag))
+            elif line in html:
+                try:
+                    contents = _read_asset(fpath, 'text')
+                except UnicodeDecodeError:
+                    err(traceback.format_exc())
+                    err('Encoding problem embeding this file into html: ' + rel_fpath, print_date=False)
+                    continue
+                debug('Embedding ' + rel_fpath + '...')
+                html = html.replace(line, l_tag_formatted + '\n' + contents + '\n' + r_tag)
     return html
 
 
+def _to_ascii(text):
+    return text.encode('ascii', 'ignore').decode('ascii')
+
+
+_template_keyword_re = re.compile(r'{{ (\w+) }}')
+
+
+def _fill_template(html, text_by_keyword):
+    """ Substitutes "{{ keyword }}" in one pass over the template; the inserted texts are not scanned again.
+        Keywords not in text_by_keyword are left as is.
+    """
+    text_by_keyword = dict((k, _to_ascii(v)) for k, v in text_by_keyword.items())
+    return _template_keyword_re.sub(lambda m: text_by_keyword.get(m.group(1), m.group(0)), _to_ascii(html))
+
+
 def _insert_into_html(html, text, keyword):
     # substituting template text with json
     # html_text = re.sub('{{ ' + keyword + ' }}', text, html_text)
-    html = ''.join(i for i in html if ord(i) < 128)
+    html = _to_ascii(html)
     html = html.replace('{{ ' + keyword + ' }}', text)
 
     return html
@@ -0,0 +1,149 @@
+// Renders the tables of a compact report (see write_html_report(compact=True)): the records are in
+// a JSON blob in <script id="report_data">, column by column, and only the current page of rows
+// is put into the DOM.
+
+var compactTable = {
+    pageSizes: [50, 100, 500, 1000],
+    defaultPageSize: 100
+};
+
+compactTable.init = function() {
+    var dataEl = document.getElementById('report_data');
+    if (!dataEl) return;
+    var data = JSON.parse(dataEl.textContent);
+    for (var i = 0; i < data.sections.length; i++) {
+        compactTable.build(data.sections[i]);
+    }
+};
+
+compactTable.build = function(section) {
+    var container = document.getElementById('compact_section_' + section.name);
+    var numRows = section.columns.length ? section.columns[0].cells.length : 0;
+    var state = {
+        section: section,
+        order: [],
+        filtered: null,
+        page: 0,
+        pageSize: compactTable.defaultPageSize,
+        sortCol: null,
+        sortDesc: true
+    };
+    for (var r = 0; r < numRows; r++) state.order.push(r);
+    state.filtered = state.order;
+
+    container.innerHTML =
+        '<div class="compact_controls">' +
+            '<input type="text" class="compact_filter" placeholder="Filter ' + numRows + ' rows"/>&nbsp;&nbsp;' +
+            '<a class="dotted-link compact_prev" href="#">&larr;</a>&nbsp;' +
+            '<span class="compact_pages"></span>&nbsp;' +
+            '<a class="dotted-link compact_next" href="#">&rarr;</a>&nbsp;&nbsp;' +
+            '<select class="compact_page_size">' + compactTable.pageSizes.map(function(n) {
+                return '<option value="' + n + '"' + (n == state.pageSize ? ' selected' : '') + '>' + n + ' rows</option>';
+            }).join('') + '</select>' +
+        '</div>' +
+        '<table cellspacing="0" class="report_table fix-align-char large_table" id="report_table_' + section.name + '">' +
+            '<thead>' + section.header + '</thead><tbody></tbody>' +
+        '</table>';
+
+    state.tbody = container.getElementsByTagName('tbody')[0];
+    state.pagesEl = container.getElementsByClassName('compact_pages')[0];
+
+    var ths = container.getElementsByTagName('th');
+    for (var c = 0; c < ths.length; c++) {
+        ths[c].style.cursor = 'pointer';
+        ths[c].onclick = (function(col) {
+            return function() { compactTable.sort(state, col); };
+        })(c);
+    }
+    container.getElementsByClassName('compact_prev')[0].onclick = function() {
+        compactTable.render(state, state.page - 1);
+        return false;
+    };
+    container.getElementsByClassName('compact_next')[0].onclick = function() {
+        compactTable.render(state, state.page + 1);
+        return false;
+    };
+    container.getElementsByClassName('compact_page_size')[0].onchange = function() {
+        state.pageSize = parseInt(this.value);
+        compactTable.render(state, 0);
+    };
+    container.getElementsByClassName('compact_filter')[0].oninput = function() {
+        compactTable.filter(state, this.value);
+    };
+    compactTable.render(state, 0);
+};
+
+compactTable.text = function(html) {
+    return html === null ? '' : html.replace(/<[^>]*>/g, '').replace(/&nbsp;/g, ' ');
+};
+
+compactTable.filter = function(state, query) {
+    query = query.toLowerCase();
+    if (!query) {
+        state.filtered = state.order;
+    } else {
+        var cells = state.section.columns[0].cells;
+        state.filtered = state.order.filter(function(r) {
+            return compactTable.text(cells[r]).toLowerCase().indexOf(query) != -1;
+        });
+    }
+    compactTable.render(state, 0);
+};
+
+compactTable.sort = function(state, col) {
+    var column = state.section.columns[col];
+    state.sortDesc = state.sortCol === col ? !state.sortDesc : true;
+    state.sortCol = col;
+    var sign = state.sortDesc ? -1 : 1;
+    var keys;
+    if (column.nums.some(function(n) { return n !== null; })) {
+        keys = column.nums;
+    } else {
+        keys = column.cells.map(compactTable.text);
+    }
+    state.order.sort(function(a, b) {
+        var ka = keys[a], kb = keys[b];
+        if (ka === kb) return a - b;
+        if (ka === null) return 1;  // empty values go last in both directions
+        if (kb === null) return -1;
+        return ka < kb ? -sign : sign;
+    });
+    var filterEl = document.getElementById('compact_section_' + state.section.name)
+        .getElementsByClassName('compact_filter')[0];
+    compactTable.filter(state, filterEl.value);
+};
+
+compactTable.render = function(state, page) {
+    var section = state.section;
+    var numPages = Math.max(1, Math.ceil(state.filtered.length / state.pageSize));
+    page = Math.max(0, Math.min(page, numPages - 1));
+    state.page = page;
+
+    var rows = state.filtered.slice(page * state.pageSize, (page + 1) * state.pageSize);
+    var html = [];
+    for (var i = 0; i < rows.length; i++) {
+        var r = rows[i];
+        var trClass = (i == 0 ? 'second_row_tr' : '') + (section.highlighted && section.highlighted[r] ? ' highlighted_row' : '');
+        var trStyle = section.row_colors && section.row_colors[r] ? 'background-color: ' + section.row_colors[r] : '';
+        html.push('<tr class="' + trClass + '" style="' + trStyle + '">');
+        for (var c = 0; c < section.columns.length; c++) {
+            var col = section.columns[c];
+            var num = col.nums[r];
+            var style = col.style;
+            if (col.colors && col.colors[r]) style += 'background-color: ' + col.colors[r] + '; ';
+            if (col.text_colors && col.text_colors[r]) style += 'color: ' + col.text_colors[r] + '; ';
+            html.push('<td style="' + style + '" class="' + col.class_ + (num !== null ? ' number' : '') + '">' +
+                      (col.cells[r] === null ? '<span>-</span>' : col.cells[r]) + '</td>');
+        }
+        html.push('</tr>');
+    }
+    state.tbody.innerHTML = html.join('');
+    state.pagesEl.innerHTML = state.filtered.length ?
+        (page * state.pageSize + 1) + '&ndash;' + (page * state.pageSize + rows.length) + ' of ' + state.filtered.length :
+        'No rows';
+    if (window.$ && $.fn.tooltip) $(state.tbody).find('[rel=tooltip]').tooltip({ animation: false });
+};
+
+$(function() {
+    compactTable.init();
+});
@@ -0,0 +1,244 @@
+""" SQLite database of TargQC results: runs, sample metrics from the summary JSON reports, and region
+and gene coverage from the region reports. One database can collect any number of runs, for trending
+a metric across samples and runs, or looking up coverage of a gene or locus in all samples.
+
+The database is in WAL mode, so parallel workers write their samples at the same time while it's being
+queried. Depth rates at thresholds are kept as comma-separated text, with the thresholds in the run.
+"""
+import json
+import platform
+import sqlite3
+import sys
+import time
+from os.path import isfile
+
+from targqc.utilz.logger import info, debug
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL,
+    output_dir TEXT,
+    bed TEXT,
+    genome TEXT,
+    depth_thresholds TEXT,
+    version TEXT,
+    host TEXT,
+    cmdline TEXT
+);
+CREATE TABLE IF NOT EXISTS samples (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER REFERENCES runs(id),
+    name TEXT,
+    bam TEXT
+);
+CREATE TABLE IF NOT EXISTS sample_metrics (
+    sample_id INTEGER REFERENCES samples(id),
+    metric TEXT,
+    value REAL,
+    text_value TEXT,
+    unit TEXT
+);
+CREATE TABLE IF NOT EXISTS regions (
+    sample_id INTEGER REFERENCES samples(id),
+    chrom TEXT,
+    start INTEGER,
+    end INTEGER,
+    gene TEXT,
+    exon TEXT,
+    strand TEXT,
+    feature TEXT,
+    biotype TEXT,
+    transcript TEXT,
+    avg_depth REAL,
+    rates TEXT
+);
+CREATE TABLE IF NOT EXISTS genes (
+    sample_id INTEGER REFERENCES samples(id),
+    gene TEXT,
+    chrom TEXT,
+    start INTEGER,
+    end INTEGER,
+    size INTEGER,
+    avg_depth REAL,
+    rates TEXT
+);
+CREATE INDEX IF NOT EXISTS samples_name ON samples(name);
+CREATE INDEX IF NOT EXISTS samples_run ON samples(run_id);
+CREATE INDEX IF NOT EXISTS sample_metrics_metric ON sample_metrics(metric, sample_id);
+CREATE INDEX IF NOT EXISTS sample_metrics_sample ON sample_metrics(sample_id);
+CREATE INDEX IF NOT EXISTS regions_gene ON regions(gene);
+CREATE INDEX IF NOT EXISTS regions_locus ON regions(chrom, start);
+CREATE INDEX IF NOT EXISTS regions_sample ON regions(sample_id);
+CREATE INDEX IF NOT EXISTS genes_gene ON genes(gene);
+CREATE INDEX IF NOT EXISTS genes_sample ON genes(sample_id);
+'''
+
+BUSY_TIMEOUT_S = 300
+
+
+def connect(db_fpath):
+    conn = sqlite3.connect(db_fpath, timeout=BUSY_TIMEOUT_S)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def add_run(db_fpath, output_dir, bed_fpath, genome, depth_thresholds, version=None):
+    """ Records the run, returns its id
+    """
+    conn = connect(db_fpath)
+    try:
+        with conn:
+            cur = conn.execute(
+                'INSERT INTO runs (started, output_dir, bed, genome, depth_thresholds, version, host, cmdline) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (time.time(), output_dir, bed_fpath, genome, json.dumps(list(depth_thresholds)), version,
+                 platform.node(), ' '.join(sys.argv)))
+            return cur.lastrowid
+    finally:
+        conn.close()
+
+
+def add_sample(db_fpath, run_id, sample_name, bam_fpath, json_fpath, region_tsv_fpath):
+    """ Loads the sample summary JSON and region report into the database in one transaction.
+        Meant to run in parallel workers, one sample each.
+    """
+    conn = connect(db_fpath)
+    try:
+        with conn:
+            sample_id = conn.execute('INSERT INTO samples (run_id, name, bam) VALUES (?, ?, ?)',
+                                     (run_id, sample_name, bam_fpath)).lastrowid
+            if json_fpath and isfile(json_fpath):
+                conn.executemany('INSERT INTO sample_metrics (sample_id, metric, value, text_value, unit) '
+                                 'VALUES (?, ?, ?, ?, ?)', _read_metrics(sample_id, json_fpath))
+            if region_tsv_fpath and isfile(region_tsv_fpath):
+                regions = list(_read_regions(region_tsv_fpath))
+                conn.executemany('INSERT INTO regions (sample_id, chrom, start, end, gene, exon, strand, feature, '
+                                 'biotype, transcript, avg_depth, rates) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 ((sample_id,) + r for r in regions))
+                conn.executemany('INSERT INTO genes (sample_id, gene, chrom, start, end, size, avg_depth, rates) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                 ((sample_id,) + g for g in _gene_coverage(regions)))
+        debug('Saved ' + sample_name + ' into ' + db_fpath)
+        return sample_id
+    finally:
+        conn.close()
+
+
+def save_results(view, db_fpath, output_dir, samples, bed_fpath, genome, depth_thresholds, version=None):
+    run_id = add_run(db_fpath, output_dir, bed_fpath, genome, depth_thresholds, version)
+    view.run(add_sample, [[db_fpath, run_id, s.name, s.bam, s.targqc_json_fpath, s.targqc_region_tsv]
+                          for s in samples])
+    info('Saved results of ' + str(len(samples)) + ' samples into ' + db_fpath + ' (run ' + str(run_id) + ')')
+    return run_id
+
+
+def _read_metrics(sample_id, json_fpath):
+    with open(json_fpath) as f:
+        data = json.load(f)
+    for rec in data.get('records', []):
+        metric = rec.get('metric')
+        if not metric:
+            continue
+        value = rec.get('_Record__value')
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            num, text = None, (None if value is None else str(value))
+        else:
+            num, text = value, None
+        yield sample_id, metric['name'], num, text, metric.get('unit')
+
+
+def _read_regions(region_tsv_fpath):
+    """ (chrom, start, end, gene, exon, strand, feature, biotype, transcript, avg_depth, rates) from regions.tsv
+    """
+    with open(region_tsv_fpath) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        avg_depth_col = header.index('avg_depth')
+        for l in f:
+            fs = l.rstrip('\n').split('\t')
+            yield (fs[0], int(fs[1]), int(fs[2])) + tuple(None if v == '.' else v for v in fs[4:10]) + \
+                  (_float(fs[avg_depth_col]), ','.join(fs[avg_depth_col + 1:]))
+
+
+def _gene_coverage(regions):
+    """ Size-weighted depth and rates by gene, over capture regions if there are any, otherwise over all regions
+    """
+    if any(r[6] == 'capture' for r in regions):
+        regions = [r for r in regions if r[6] == 'capture']
+    by_gene = dict()
+    for chrom, start, end, gene, _, _, _, _, _, avg_depth, rates in regions:
+        if not gene or avg_depth is None:
+            continue
+        size = end - start
+        g = by_gene.get((gene, chrom))
+        if g is None:
+            g = by_gene[(gene, chrom)] = [start, end, 0, 0.0, None]
+        g[0] = min(g[0], start)
+        g[1] = max(g[1], end)
+        g[2] += size
+        g[3] += avg_depth * size
+        rates = [_float(v) or 0.0 for v in rates.split(',')] if rates else []
+        g[4] = [a + b * size for a, b in zip(g[4], rates)] if g[4] is not None else [b * size for b in rates]
+    for (gene, chrom), (start, end, size, depth_sum, rates_sum) in by_gene.items():
+        if size:
+            yield (gene, chrom, start, end, size, depth_sum / size,
+                   ','.join('%.2f' % (v / size) for v in (rates_sum or [])))
+
+
+def _float(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+
+QUERIES = {
+    'runs': "SELECT r.id, datetime(r.started, 'unixepoch', 'localtime') AS started, r.output_dir, r.bed, r.genome, "
+            "r.host FROM runs r{where} ORDER BY r.id",
+    'samples': "SELECT r.id AS run, datetime(r.started, 'unixepoch', 'localtime') AS started, s.name AS sample, s.bam "
+               "FROM samples s JOIN runs r ON r.id = s.run_id{where} ORDER BY r.id, s.name",
+    'metric': "SELECT datetime(r.started, 'unixepoch', 'localtime') AS started, r.id AS run, s.name AS sample, "
+              "COALESCE(m.value, m.text_value) AS value, m.unit "
+              "FROM sample_metrics m JOIN samples s ON s.id = m.sample_id JOIN runs r ON r.id = s.run_id "
+              "WHERE m.metric = ?{and_where} ORDER BY r.started, s.name",
+    'gene': "SELECT r.id AS run, s.name AS sample, g.gene, g.chrom, g.start, g.end, g.size, "
+            "ROUND(g.avg_depth, 2) AS avg_depth, g.rates, r.depth_thresholds "
+            "FROM genes g JOIN samples s ON s.id = g.sample_id JOIN runs r ON r.id = s.run_id "
+            "WHERE g.gene = ?{and_where} ORDER BY r.started, s.name",
+    'region': "SELECT r.id AS run, s.name AS sample, x.chrom, x.start, x.end, x.gene, x.feature, x.transcript, "
+              "x.avg_depth, x.rates, r.depth_thresholds "
+              "FROM regions x JOIN samples s ON s.id = x.sample_id JOIN runs r ON r.id = s.run_id "
+              "WHERE x.chrom = ? AND x.start < ? AND x.end > ?{and_where} ORDER BY r.started, s.name, x.start",
+}
+
+
+def query(db_fpath, what, args=None, sample=None, run=None):
+    """ Runs one of QUERIES, or arbitrary SQL with what="sql". Returns (column names, rows).
+        region takes a locus as "chrom:start-end".
+    """
+    conn = sqlite3.connect(db_fpath, timeout=BUSY_TIMEOUT_S)
+    try:
+        if what == 'sql':
+            cur = conn.execute(args[0])
+        else:
+            sql = QUERIES[what]
+            params = list(args or [])
+            if what == 'region':
+                chrom, coords = params[0].split(':')
+                start, end = coords.replace(',', '').split('-')
+                params = [chrom, int(end), int(start)]
+            filters = []
+            if sample and what != 'runs':
+                filters.append('s.name = ?')
+                params.append(sample)
+            if run:
+                filters.append('r.id = ?')
+                params.append(int(run))
+            sql = sql.format(where=(' WHERE ' + ' AND '.join(filters)) if filters else '',
+                             and_where=''.join(' AND ' + f for f in filters))
+            cur = conn.execute(sql, params)
+        return [d[0] for d in cur.description or []], cur.fetchall()
+    finally:
+        conn.close()
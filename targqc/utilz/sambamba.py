@@ -5,7 +5,7 @@ import traceback
 from os.path import join, dirname, abspath, basename, isfile, getmtime
 from pybedtools import BedTool
 from targqc.utilz.logger import debug, warn, err, critical
-from targqc.utilz.call_process import run
+from targqc.utilz.call_process import run, stream_lines
 from targqc.utilz.file_utils import verify_file, splitext_plus, which, can_reuse, intermediate_fname
 
 
@@ -24,11 +24,19 @@ def index_bam(bam_fpath, sambamba=None, samtools=None):
         res = run(cmdline, output_fpath=indexed_bam, stdout_to_outputfile=False, stdout_tx=False)
 
 
-def sort_bam(bam_fpath, work_dir, sambamba=None, samtools=None):
+SORT_MEM_M = 2048  # sambamba sort default memory limit
+SORT_MIN_MEM_M = 512
+
+
+def sort_bam(bam_fpath, work_dir, sambamba=None, samtools=None, threads=None, mem_m=None):
     sambamba = sambamba or get_executable()
     sorted_bam = intermediate_fname(work_dir, bam_fpath, 'sorted')
     if not can_reuse(sorted_bam, cmp_f=bam_fpath, silent=True):
         cmdline = '{sambamba} sort {bam_fpath} -o {sorted_bam}'.format(**locals())
+        if threads:
+            cmdline += ' -t ' + str(threads)
+        if mem_m:
+            cmdline += ' -m ' + str(int(mem_m)) + 'M'
         res = run(cmdline, output_fpath=sorted_bam, stdout_to_outputfile=False, stdout_tx=False)
     return sorted_bam
 
@@ -57,14 +65,26 @@ def sambamba_depth(work_dir, bed, bam, depth_thresholds=None,
     if can_reuse(output_fpath, [bam, bed]):
         return output_fpath
 
-    thresholds_str = ''.join([' -T' + str(int(d)) for d in depth_thresholds if d is not None])
-    cmdline = ('depth region -F "not duplicate and not failed_quality_control" '
-               '-t {threads} -L {bed} {thresholds_str} {bam}').format(**locals())
-
-    call_sambamba(cmdline, bam_fpath=bam, output_fpath=output_fpath)
+    call_sambamba(_depth_region_cmdline(bed, bam, depth_thresholds, threads), bam_fpath=bam, output_fpath=output_fpath)
     return output_fpath
 
 
+def sambamba_depth_stream(bed, bam, depth_thresholds=None, threads=1):
+    """ Same as sambamba_depth, but instead of writing the table into a file, returns a context manager
+        giving the output lines as sambamba produces them (see call_process.stream_lines)
+    """
+    if isinstance(bed, BedTool):
+        bed = bed.saveas().fn
+    index_bam(bam)
+    return stream_lines(get_executable() + ' ' + _depth_region_cmdline(bed, bam, depth_thresholds or [], threads))
+
+
+def _depth_region_cmdline(bed, bam, depth_thresholds, threads):
+    thresholds_str = ''.join([' -T' + str(int(d)) for d in depth_thresholds if d is not None])
+    return ('depth region -F "not duplicate and not failed_quality_control" '
+            '-t {threads} -L {bed} {thresholds_str} {bam}').format(**locals())
+
+
 def remove_dups(bam, output_fpath):
     cmdline = 'view --format=bam -F "not duplicate" {bam}'.format(**locals())  # -F (=not) 1024 (=duplicate)
     return call_sambamba(cmdline, bam_fpath=bam, output_fpath=output_fpath, command_name='not_duplicate')
@@ -0,0 +1,293 @@
+""" Resource accounting of external commands and timing of Python stages.
+
+Every process appends records to <telemetry_dir>/<pid>.jsonl, so workers started by joblib or on
+a cluster don't need to send anything back to the main process. The directory is passed to child
+processes through $TARGQC_TELEMETRY_DIR; recording is off when it's not set. Records are tagged with
+the stage and the sample set for the current thread with tagged() or timed().
+
+With profiling on, the records are also exported as a Chrome trace (chrome://tracing, Perfetto),
+and functions decorated with profiled() dump cProfile stats into $TARGQC_PROFILE_DIR.
+"""
+import contextlib
+import cProfile
+import functools
+import itertools
+import json
+import os
+import resource
+import threading
+import time
+from collections import OrderedDict
+from os.path import join, isdir, basename
+
+from targqc.utilz.file_utils import safe_mkdir, file_transaction
+from targqc.utilz.logger import info, debug
+
+ENV_VAR = 'TARGQC_TELEMETRY_DIR'
+PROFILE_ENV_VAR = 'TARGQC_PROFILE_DIR'
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def init(work_dir, profile_dirpath=None):
+    """ Starts recording into <work_dir>/telemetry for this process and its children.
+        With profile_dirpath, functions decorated with profiled() dump their cProfile stats there.
+    """
+    telemetry_dirpath = safe_mkdir(join(work_dir, 'telemetry'))
+    for fname in os.listdir(telemetry_dirpath):
+        if fname.endswith('.jsonl'):
+            os.remove(join(telemetry_dirpath, fname))
+    os.environ[ENV_VAR] = telemetry_dirpath
+    if profile_dirpath:
+        os.environ[PROFILE_ENV_VAR] = safe_mkdir(profile_dirpath)
+    return telemetry_dirpath
+
+
+def get_dir():
+    return os.environ.get(ENV_VAR)
+
+
+def get_tags():
+    return dict(stage=getattr(_local, 'stage', None), sample=getattr(_local, 'sample', None))
+
+
+@contextlib.contextmanager
+def tagged(stage=None, sample=None):
+    """ Tags records made in this thread inside the block. None keeps the outer value.
+    """
+    prev = get_tags()
+    _local.stage = stage or prev['stage']
+    _local.sample = sample or prev['sample']
+    try:
+        yield
+    finally:
+        _local.stage, _local.sample = prev['stage'], prev['sample']
+
+
+def run_tagged(fn, tags, params, kwargs=None):
+    """ Calls fn(*params, **kwargs) as a job span with tags set, for worker processes.
+        tags: as returned by get_tags, plus "dir" and "profile_dir" to pass the environment to cluster nodes
+    """
+    if tags.get('dir') and not get_dir():
+        os.environ[ENV_VAR] = tags['dir']
+    if tags.get('profile_dir') and not os.environ.get(PROFILE_ENV_VAR):
+        os.environ[PROFILE_ENV_VAR] = tags['profile_dir']
+    with tagged(tags.get('stage'), tags.get('sample')):
+        with span('job', getattr(fn, '__name__', str(fn))):
+            return fn(*params, **(kwargs or {}))
+
+
+def _rusage_self():
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    return ru.ru_utime, ru.ru_stime
+
+
+@contextlib.contextmanager
+def span(kind, name):
+    """ Records wall time and CPU time of the block. CPU time is process-wide,
+        so it includes other threads running at the same time.
+    """
+    if not get_dir():
+        yield
+        return
+    start = time.time()
+    utime, stime = _rusage_self()
+    try:
+        yield
+    finally:
+        end_utime, end_stime = _rusage_self()
+        tags = get_tags()
+        _write(OrderedDict([
+            ('kind', kind),
+            ('name', name),
+            ('stage', tags['stage']),
+            ('sample', tags['sample']),
+            ('start', start),
+            ('wall_s', time.time() - start),
+            ('user_s', end_utime - utime),
+            ('sys_s', end_stime - stime),
+            ('max_rss_mb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0),
+        ]))
+
+
+@contextlib.contextmanager
+def timed(stage, sample=None):
+    """ Records the block as a Python stage and tags everything inside with the stage and the sample
+    """
+    with tagged(stage, sample):
+        with span('stage', stage):
+            yield
+
+
+_profile_counter = itertools.count()
+
+
+def profiled(name):
+    """ Decorator running the function under cProfile when $TARGQC_PROFILE_DIR is set, dumping
+        <name>.<sample>.<pid>-<n>.prof there. Calls nested into another profiled function in the same
+        thread are covered by the outer profile.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profile_dirpath = os.environ.get(PROFILE_ENV_VAR)
+            if not profile_dirpath or getattr(_local, 'profiling', False):
+                return fn(*args, **kwargs)
+            prof = cProfile.Profile()
+            _local.profiling = True
+            try:
+                return prof.runcall(fn, *args, **kwargs)
+            finally:
+                _local.profiling = False
+                prof_fname = '.'.join([name, get_tags()['sample'] or 'all',
+                                       str(os.getpid()) + '-' + str(next(_profile_counter)), 'prof'])
+                prof.dump_stats(join(profile_dirpath, prof_fname))
+        return wrapper
+    return decorator
+
+
+def tool_name(cmd):
+    """ Base name of the executable of a command line or an argument list
+    """
+    if not isinstance(cmd, (list, tuple)):
+        cmd = cmd.replace('set -o pipefail;', '').split()
+    return basename(str(cmd[0])) if cmd else ''
+
+
+def record_command(cmd, start, rusage, exit_code):
+    """ Records an external command finished with rusage as returned by os.wait4
+    """
+    if not get_dir():
+        return
+    tags = get_tags()
+    cmd_str = ' '.join(str(x) for x in cmd) if isinstance(cmd, (list, tuple)) else cmd
+    rec = OrderedDict([
+        ('kind', 'command'),
+        ('name', tool_name(cmd)),
+        ('stage', tags['stage']),
+        ('sample', tags['sample']),
+        ('start', start),
+        ('wall_s', time.time() - start),
+        ('exit_code', exit_code),
+        ('cmd', cmd_str),
+    ])
+    if rusage is not None:
+        rec['user_s'] = rusage.ru_utime
+        rec['sys_s'] = rusage.ru_stime
+        rec['max_rss_mb'] = rusage.ru_maxrss / 1024.0
+        rec['read_bytes'] = rusage.ru_inblock * 512
+        rec['write_bytes'] = rusage.ru_oublock * 512
+    _write(rec)
+
+
+def _write(rec):
+    telemetry_dirpath = get_dir()
+    if not telemetry_dirpath:
+        return
+    rec['pid'] = os.getpid()
+    rec['thread'] = threading.current_thread().name
+    line = json.dumps(rec) + '\n'
+    with _write_lock:
+        with open(join(telemetry_dirpath, str(os.getpid()) + '.jsonl'), 'a') as f:
+            f.write(line)
+
+
+def load_records(telemetry_dirpath=None):
+    telemetry_dirpath = telemetry_dirpath or get_dir()
+    recs = []
+    if not telemetry_dirpath or not isdir(telemetry_dirpath):
+        return recs
+    for fname in sorted(os.listdir(telemetry_dirpath)):
+        if fname.endswith('.jsonl'):
+            with open(join(telemetry_dirpath, fname)) as f:
+                recs.extend(json.loads(l) for l in f if l.strip())
+    recs.sort(key=lambda r: r['start'])
+    return recs
+
+
+def summarize(recs):
+    """ Totals of commands by (stage, tool) and by sample
+    """
+    def _add(totals, key, r):
+        t = totals.setdefault(key, OrderedDict([('count', 0), ('wall_s', 0.0), ('user_s', 0.0), ('sys_s', 0.0),
+                                                 ('max_rss_mb', 0.0), ('read_bytes', 0), ('write_bytes', 0)]))
+        t['count'] += 1
+        for k in ['wall_s', 'user_s', 'sys_s', 'read_bytes', 'write_bytes']:
+            t[k] += r.get(k) or 0
+        t['max_rss_mb'] = max(t['max_rss_mb'], r.get('max_rss_mb') or 0)
+
+    by_tool = OrderedDict()
+    by_sample = OrderedDict()
+    for r in recs:
+        if r['kind'] == 'command':
+            _add(by_tool, (r['stage'] or '', r['name']), r)
+            _add(by_sample, r['sample'] or '', r)
+    return by_tool, by_sample
+
+
+def write_chrome_trace(output_fpath, telemetry_dirpath=None):
+    """ Writes the records as complete ("X") events of the Chrome trace event format,
+        one track per process and thread
+    """
+    recs = load_records(telemetry_dirpath)
+    if not recs:
+        return None
+    t0 = recs[0]['start']
+    tid_by_thread = OrderedDict()
+    events = []
+    for r in recs:
+        tid = tid_by_thread.setdefault((r['pid'], r['thread']), len(tid_by_thread) + 1)
+        name = r['name']
+        if r['kind'] != 'stage' and r['sample']:
+            name += ' [' + r['sample'] + ']'
+        events.append(OrderedDict([
+            ('name', name),
+            ('cat', r['kind']),
+            ('ph', 'X'),
+            ('ts', int((r['start'] - t0) * 1e6)),
+            ('dur', int(r['wall_s'] * 1e6)),
+            ('pid', r['pid']),
+            ('tid', tid),
+            ('args', dict((k, v) for k, v in r.items() if k not in ('name', 'kind', 'start', 'wall_s', 'pid', 'thread'))),
+        ]))
+    for (pid, thread), tid in tid_by_thread.items():
+        events.append(OrderedDict([('name', 'thread_name'), ('ph', 'M'), ('pid', pid), ('tid', tid),
+                                   ('args', dict(name=thread))]))
+    with file_transaction(None, output_fpath) as tx:
+        with open(tx, 'w') as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
+    info('Saved trace to ' + output_fpath + ', open it in chrome://tracing or ui.perfetto.dev')
+    return output_fpath
+
+
+def write_summary(output_fpath, telemetry_dirpath=None):
+    """ Writes all records and their totals into output_fpath (telemetry.json) and logs the totals table
+    """
+    recs = load_records(telemetry_dirpath)
+    if not recs:
+        debug('No telemetry records')
+        return None
+    by_tool, by_sample = summarize(recs)
+    data = OrderedDict([
+        ('stages', [r for r in recs if r['kind'] == 'stage']),
+        ('commands', [r for r in recs if r['kind'] == 'command']),
+        ('by_tool', [OrderedDict([('stage', s), ('tool', t)] + list(v.items())) for (s, t), v in by_tool.items()]),
+        ('by_sample', [OrderedDict([('sample', s)] + list(v.items())) for s, v in by_sample.items()]),
+    ])
+    with file_transaction(None, output_fpath) as tx:
+        with open(tx, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    info('Resource usage by stage and tool:')
+    fmt = '  {:<28} {:<16} {:>5} {:>10} {:>10} {:>10} {:>10} {:>10}'
+    info(fmt.format('Stage', 'Tool', 'Runs', 'Wall, s', 'User, s', 'Sys, s', 'RSS, MB', 'IO, MB'))
+    for (stage, tool), t in sorted(by_tool.items(), key=lambda kv: -kv[1]['wall_s']):
+        info(fmt.format(stage[:28], tool[:16], t['count'], '%.1f' % t['wall_s'], '%.1f' % t['user_s'],
+                        '%.1f' % t['sys_s'], '%.0f' % t['max_rss_mb'],
+                        '%.0f' % ((t['read_bytes'] + t['write_bytes']) / 1024.0 / 1024.0)))
+    for r in data['stages']:
+        if r['sample'] is None:
+            info('  ' + r['name'] + ': ' + '%.1f' % r['wall_s'] + 's wall')
+    info('Saved telemetry to ' + output_fpath)
+    return output_fpath
@@ -1,4 +1,6 @@
 import os
+import shutil
+import subprocess
 from collections import namedtuple
 from datetime import datetime
 from genericpath import getmtime
@@ -6,7 +8,7 @@ from nose import SkipTest
 from os.path import dirname, join, exists, isfile, splitext, basename, isdir, relpath
 from targqc.utilz.testing import BaseTestCase, swap_output, check_call
 from tests import BaseTargQC, info
-from targqc.utilz.file_utils import add_suffix
+from targqc.utilz.file_utils import add_suffix, safe_mkdir
 
 
 class AnnotateBedTests(BaseTestCase):
@@ -28,6 +30,15 @@ class AnnotateBedTests(BaseTestCase):
     def test_hg38_ext(self):
         self._test('hg38_ext', 'hg38', ['--extended'])
 
+    def test_hg38_ext_threads(self):
+        # chromosomes annotated in parallel give the same output as one process
+        input_fpath = join(self.data_dir, 'hg38.bed')
+        single_fpath = self._annotate([input_fpath], join(self.results_dir, 'hg38_ext_single.anno.bed'),
+                                      'hg38', ['--extended'])
+        threads_fpath = self._annotate([input_fpath], join(self.results_dir, 'hg38_ext_threads.anno.bed'),
+                                       'hg38', ['--extended', '--threads', '2'])
+        self._assert_same_files(threads_fpath, single_fpath)
+
     def test_hg38_ext_features(self):
         self._test('hg38_ext_features', 'hg38', ['--extended', '--output-features'])
 
@@ -40,6 +51,42 @@ class AnnotateBedTests(BaseTestCase):
     def test_mm10(self):
         self._test('mm10', 'mm10', ['--extended'])
 
+    def test_hg19_batch(self):
+        # each output of a batch is the same as from annotating its input alone
+        input_fpaths = [join(self.data_dir, fname) for fname in ['hg19.bed', 'hg19-chr21.bed']]
+        single_fpaths = [self._annotate([fpath], join(self.results_dir, add_suffix(basename(fpath), 'single')), 'hg19')
+                         for fpath in input_fpaths]
+        for name, opts in [('batch', []), ('batch_threads', ['--threads', '2'])]:
+            output_dir = self._annotate(input_fpaths, join(self.results_dir, name), 'hg19', opts)
+            for input_fpath, single_fpath in zip(input_fpaths, single_fpaths):
+                self._assert_same_files(join(output_dir, add_suffix(basename(input_fpath), 'anno')), single_fpath)
+
+    def test_batch_same_file_names(self):
+        # outputs are named after the inputs, so inputs with the same name would overwrite each other's outputs
+        input_fpath = join(self.data_dir, 'hg19-chr21.bed')
+        other_dir = safe_mkdir(join(self.results_dir, 'same_name'))
+        shutil.copy(input_fpath, other_dir)
+        with self.assertRaises(subprocess.CalledProcessError):
+            self._annotate([input_fpath, join(other_dir, 'hg19-chr21.bed')], join(self.results_dir, 'batch_same_name'), 'hg19')
+
+    def _annotate(self, input_fpaths, output_path, genome, opts=None):
+        """ Runs the script on input_fpaths, output_path being the output file or, for several inputs, directory
+        """
+        os.chdir(self.results_dir)
+        if len(input_fpaths) == 1:
+            swap_output(output_path)
+        cmdl = [self.script] + input_fpaths + ['-o', output_path] + (opts or []) + ['--debug', '-g', genome]
+        info('-' * 100)
+        check_call(cmdl)
+        info('-' * 100)
+        info('')
+        return output_path
+
+    def _assert_same_files(self, fpath, expected_fpath):
+        assert isfile(fpath), 'file does not exist: ' + fpath
+        with open(fpath) as f, open(expected_fpath) as expected_f:
+            assert f.read() == expected_f.read(), fpath + ' differs from ' + expected_fpath
+
     def _test(self, name, genome, opts=None):
         os.chdir(self.results_dir)
         input_fname = genome + '.bed'
@@ -0,0 +1,54 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+from targqc.utilz import bed_utils
+
+
+class SortBedTests(unittest.TestCase):
+    chr_order = dict(('chr' + str(i), i) for i in range(1, 6))
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.input_fpath = join(self.work_dir, 'input.bed')
+        rnd = random.Random(0)
+        lines = ['# header\n']
+        for i in range(200):
+            chrom = 'chr' + str(rnd.randint(1, 5))
+            start = rnd.randint(0, 50) * 10  # few distinct positions, so coordinates often tie
+            lines.append('\t'.join([chrom, str(start), str(start + rnd.choice([10, 20])), 'GENE' + str(rnd.randint(0, 3))]) + '\n')
+        lines.extend(lines[1:6])  # identical lines
+        with open(self.input_fpath, 'w') as f:
+            f.writelines(lines)
+        self.regions = lines[1:]
+        self.chunk_size = bed_utils.SORT_BED_CHUNK_SIZE
+
+    def tearDown(self):
+        bed_utils.SORT_BED_CHUNK_SIZE = self.chunk_size
+        shutil.rmtree(self.work_dir)
+
+    def _sort(self, name, chunk_size):
+        bed_utils.SORT_BED_CHUNK_SIZE = chunk_size
+        sort_dir = tempfile.mkdtemp(dir=self.work_dir)
+        output_fpath = bed_utils.sort_bed(self.input_fpath, join(sort_dir, name + '.bed'), work_dir=sort_dir,
+                                          chr_order=self.chr_order)
+        self.assertEqual(os.listdir(sort_dir), [name + '.bed'])  # spill files removed
+        with open(output_fpath) as f:
+            return f.read()
+
+    def _sorted_in_python(self):
+        def _key(l):
+            fs = l.rstrip('\n').split('\t')
+            return self.chr_order[fs[0]], int(fs[1]), int(fs[2]), fs[3:]
+        return '# header\n' + ''.join(sorted(self.regions, key=_key))
+
+    def test_in_memory(self):
+        self.assertEqual(self._sort('in_memory', 10 ** 6), self._sorted_in_python())
+
+    def test_chunked(self):
+        expected = self._sort('in_memory', 10 ** 6)
+        self.assertEqual(self._sort('chunked', 7), expected)
+        self.assertEqual(self._sort('chunked_by_1', 1), expected)
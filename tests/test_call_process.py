@@ -0,0 +1,88 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from os.path import join
+
+from targqc.utilz import call_process
+
+
+def _is_running(pid):
+    try:
+        with open('/proc/' + str(pid) + '/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+class CallProcessTests(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.pid_fpath = join(self.work_dir, 'child.pid')
+        # a pipeline whose background child would outlive the shell if only the shell was killed
+        self.cmd = 'sleep 60 & echo $! > ' + self.pid_fpath + '; wait'
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _child_pid(self):
+        for _ in range(100):
+            if os.path.exists(self.pid_fpath):
+                with open(self.pid_fpath) as f:
+                    pid = f.read().strip()
+                if pid:
+                    return int(pid)
+            time.sleep(0.05)
+        self.fail('the command did not start')
+
+    def _assert_stopped(self, pid):
+        for _ in range(100):
+            if not _is_running(pid):
+                return
+            time.sleep(0.05)
+        self.fail('process ' + str(pid) + ' is still running')
+
+    def test_timeout(self):
+        start = time.time()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            call_process.run(self.cmd, timeout=0.5)
+        self.assertLess(time.time() - start, call_process.KILL_GRACE_S)
+        self._assert_stopped(self._child_pid())
+
+    def test_cancel_kills_process_group(self):
+        cmd, shell_arg, executable_arg = call_process._normalize_cmd_args(self.cmd)
+        future = asyncio.run_coroutine_threadsafe(
+            call_process._supervise(cmd, shell_arg, executable_arg, None, None), call_process._get_loop())
+        pid = self._child_pid()
+        self.assertTrue(_is_running(pid))
+        future.cancel()
+        self._assert_stopped(pid)
+
+    def test_error_output_tail(self):
+        n = call_process.OUTPUT_TAIL_LINES + 50
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            call_process.run('for i in $(seq 1 ' + str(n) + '); do echo line $i; done; echo error >&2; exit 3')
+        self.assertEqual(ctx.exception.returncode, 3)
+        output_lines = ctx.exception.output.splitlines()[1:]  # the command goes first
+        self.assertEqual(len(output_lines), call_process.OUTPUT_TAIL_LINES)
+        self.assertEqual(output_lines[0], 'line 52')
+        self.assertEqual(output_lines[-2:], ['line ' + str(n), 'error'])
+
+    def test_stream_takes_process_slot(self):
+        max_processes = call_process.MAX_PROCESSES
+        call_process.MAX_PROCESSES = 1
+        call_process._semaphore = None
+        try:
+            with call_process.stream_lines('echo streamed') as lines:
+                future = asyncio.run_coroutine_threadsafe(
+                    call_process._supervise(['echo', 'run'], False, None, None, None), call_process._get_loop())
+                time.sleep(0.5)
+                self.assertFalse(future.done())  # waits for the streamed command to exit
+                self.assertEqual(list(lines), ['streamed\n'])
+            future.result(10)
+        finally:
+            call_process.MAX_PROCESSES = max_processes
+            call_process._semaphore = None
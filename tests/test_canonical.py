@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+from ensembl import canonical
+
+
+class BuildIndexFileTests(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.num_builds = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _get_canon_tx_by_gname(self):
+        self.num_builds += 1
+        return {'TP53': 'ENST00000269305', 'BRCA1': 'ENST00000357654', 'A1BG': 'ENST00000263100'}
+
+    def test_built_once_in_work_dir(self):
+        index_fpath = canonical.build_index_file(self._get_canon_tx_by_gname, key='abc', work_dir=self.work_dir)
+        self.assertEqual(index_fpath, join(self.work_dir, 'canonical_abc.idx'))
+        self.assertEqual(canonical.build_index_file(self._get_canon_tx_by_gname, key='abc', work_dir=self.work_dir),
+                         index_fpath)
+        self.assertEqual(self.num_builds, 1)
+        self.assertEqual([f for f in os.listdir(self.work_dir) if f.endswith('.idx')], ['canonical_abc.idx'])
+
+    def test_lookups(self):
+        index = canonical.CanonicalIndex(
+            canonical.build_index_file(self._get_canon_tx_by_gname, key='abc', work_dir=self.work_dir))
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.get('BRCA1'), 'ENST00000357654')
+        self.assertIsNone(index.get('BRCA2'))
+        self.assertTrue(index.is_canonical('ENST00000269305'))
+        self.assertFalse(index.is_canonical('ENST00000413465'))
@@ -0,0 +1,50 @@
+import shutil
+import tempfile
+import unittest
+from os.path import join, dirname, abspath
+
+from ensembl import generate_ensembl_data
+
+DATA_DIR = join(dirname(abspath(__file__)), 'data', 'ensembl')
+
+# Biomart records of some of the transcripts in small.gtf, as read_biomart returns them
+BIOMART = {
+    'ENST00000300305': {'Transcript ID': 'ENST00000300305', 'Associated Gene Name': 'RUNX1', 'HGNC symbol': 'RUNX1',
+                        'Transcript type': 'protein_coding',
+                        'Transcript Support Level (TSL)': 'tsl1 (assigned to previous version 5)'},
+    'ENST00000344691': {'Transcript ID': 'ENST00000344691', 'Associated Gene Name': 'RUNX1', 'HGNC symbol': 'RUNX1',
+                        'Transcript type': 'protein_coding', 'Transcript Support Level (TSL)': ''},
+    'ENST00000456917': {'Transcript ID': 'ENST00000456917', 'Associated Gene Name': 'RUNX1-IT1',
+                        'HGNC symbol': 'RUNX1-IT1', 'Transcript type': 'sense_intronic',
+                        'Transcript Support Level (TSL)': 'tsl3'},
+    'ENST00000307301': {'Transcript ID': 'ENST00000307301', 'Associated Gene Name': 'MRPL39-AS',
+                        'HGNC symbol': '', 'Transcript type': 'nonsense_mediated_decay',
+                        'Transcript Support Level (TSL)': 'tsl2'},
+}
+
+
+class GtfToBedTests(unittest.TestCase):
+    """ small.ensembl.bed was made from small.gtf and BIOMART by the gffutils-based converter
+        (generate_ensembl_data.py before the streaming one)
+    """
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _check(self, gtf_fname, expected_fname, threads=1):
+        output_fpath = generate_ensembl_data.gtf_to_bed(join(DATA_DIR, gtf_fname), join(self.work_dir, 'ensembl.bed'),
+                                                        BIOMART, 'hg19', threads=threads)
+        with open(output_fpath) as f, open(join(DATA_DIR, expected_fname)) as expected_f:
+            self.assertEqual(f.read().splitlines(), expected_f.read().splitlines())
+
+    def test_same_as_gffutils(self):
+        self._check('small.gtf', 'small.ensembl.bed')
+
+    def test_threads(self):
+        self._check('small.gtf', 'small.ensembl.bed', threads=2)
+
+    def test_inferred_transcripts(self):
+        # the transcript records in small.gtf span their exons, so inferring them gives the same BED
+        self._check('small.no_transcripts.gtf', 'small.ensembl.bed')
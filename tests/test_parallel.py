@@ -0,0 +1,55 @@
+import threading
+import unittest
+
+from targqc.utilz.parallel import MemoryScheduler, parse_mem_m
+
+
+class ParseMemTests(unittest.TestCase):
+    def test_parse_mem_m(self):
+        self.assertEqual(parse_mem_m('48G'), 48 * 1024)
+        self.assertEqual(parse_mem_m('500M'), 500)
+        self.assertEqual(parse_mem_m('1024'), 1024)
+        self.assertEqual(parse_mem_m('2TB'), 2 * 1024 * 1024)
+        self.assertEqual(parse_mem_m(' 1.5g '), 1536)
+        self.assertIsNone(parse_mem_m(None))
+
+
+class MemorySchedulerTests(unittest.TestCase):
+    def test_fits(self):
+        scheduler = MemoryScheduler(1000)
+        self.assertEqual(scheduler.acquire(400, 200, 4), (4, 400))
+        self.assertEqual(scheduler.acquire(600, 200, 4), (4, 600))
+        self.assertEqual((scheduler.used_m, scheduler.running), (1000, 2))
+
+    def test_unlimited(self):
+        self.assertEqual(MemoryScheduler(None).acquire(10 ** 6, 10 ** 5, 8), (8, 10 ** 6))
+
+    def test_shrink(self):
+        # only 400M left: the job gets them, with threads reduced proportionally
+        scheduler = MemoryScheduler(1000)
+        scheduler.acquire(600, 600, 4)
+        self.assertEqual(scheduler.acquire(800, 200, 4), (2, 400))
+        self.assertEqual(scheduler.used_m, 1000)
+
+    def test_wait(self):
+        # not even min_mem_m fits: the job waits for the running one to finish
+        scheduler = MemoryScheduler(1000)
+        scheduler.acquire(800, 800, 4)
+        granted = []
+        t = threading.Thread(target=lambda: granted.append(scheduler.acquire(500, 400, 4)))
+        t.start()
+        t.join(0.2)
+        self.assertTrue(t.is_alive())
+        self.assertEqual(granted, [])
+        scheduler.release(800)
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(granted, [(4, 500)])
+        self.assertEqual((scheduler.used_m, scheduler.running), (500, 1))
+
+    def test_admit_when_idle(self):
+        # a job larger than the whole budget still runs when nothing else does, shrunk to its minimum
+        scheduler = MemoryScheduler(100)
+        self.assertEqual(scheduler.acquire(500, 300, 5), (3, 300))
+        scheduler.release(300)
+        self.assertEqual((scheduler.used_m, scheduler.running), (0, 0))
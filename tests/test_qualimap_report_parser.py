@@ -0,0 +1,25 @@
+import unittest
+from os.path import dirname, join
+
+from targqc.qualimap.report_parser import parse_genome_results, parse_qualimap_sample_report, \
+    genome_results_metrics, metric_names
+
+
+class QualimapReportParserTests(unittest.TestCase):
+    data_dir = join(dirname(__file__), 'data', 'qualimap')
+
+    def test_genome_results_same_as_html(self):
+        # the same sample: genome_results.txt and qualimapReport.html must give the same metrics
+        txt_values = parse_genome_results(join(self.data_dir, 'genome_results.txt'))
+        html_values = parse_qualimap_sample_report(join(self.data_dir, 'qualimapReport.html'))
+
+        for name in set(genome_results_metrics.values()):
+            assert name in txt_values or name + ' (on target)' in txt_values, name + ' is not in the fixture'
+        compared = [m for m in txt_values if m in metric_names]
+        for m in ['Mapped paired reads', 'Mapped paired reads %', 'Unmapped reads', 'Unmapped reads %',
+                  'Duplicated reads (flagged) %', 'Duplicated reads (flagged) (on target) %']:
+            self.assertIn(m, compared)
+        for m in compared:
+            self.assertIn(m, html_values)
+            # HTML percentages are rounded to 2 decimals
+            self.assertAlmostEqual(txt_values[m], html_values[m], delta=0.0001 if m.endswith(' %') else 0.001, msg=m)
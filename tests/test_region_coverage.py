@@ -0,0 +1,52 @@
+import contextlib
+import shutil
+import tempfile
+import unittest
+from os.path import join, dirname, abspath
+
+from targqc import region_coverage
+
+DATA_DIR = join(dirname(abspath(__file__)), 'data', 'sambamba')
+DEPTH_THRESHOLDS = [1, 10, 50, 100]
+
+
+class RegionReportTests(unittest.TestCase):
+    """ regions.tsv was made from depth_region.txt by the file-based _proc_sambamba_depth
+        (region_coverage.py before the report was streamed from sambamba)
+    """
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.depth_fpath = join(DATA_DIR, 'depth_region.txt')
+        self.sambamba_depth_stream = region_coverage.sambamba_depth_stream
+
+        @contextlib.contextmanager
+        def _stream_from_file(bed, bam, depth_thresholds=None, threads=1):
+            with open(self.depth_fpath) as f:
+                yield f
+        region_coverage.sambamba_depth_stream = _stream_from_file
+
+    def tearDown(self):
+        region_coverage.sambamba_depth_stream = self.sambamba_depth_stream
+        shutil.rmtree(self.work_dir)
+
+    def _read(self, fpath):
+        with open(fpath, 'rb') as f:
+            return f.read()
+
+    def _make_region_report(self, **kwargs):
+        return region_coverage._make_region_report(
+            self.work_dir, join(self.work_dir, 'target.bed'), join(self.work_dir, 'syn3-normal.bam'),
+            'syn3-normal', DEPTH_THRESHOLDS, join(self.work_dir, 'streamed.tsv'), **kwargs)
+
+    def test_same_as_file_based(self):
+        streamed = self._read(self._make_region_report())
+        from_file = self._read(region_coverage._proc_sambamba_depth(
+            self.depth_fpath, join(self.work_dir, 'from_file.tsv'), 'syn3-normal', DEPTH_THRESHOLDS))
+        self.assertEqual(streamed, from_file)
+        self.assertEqual(streamed, self._read(join(DATA_DIR, 'regions.tsv')))
+
+    def test_keep_depth_output(self):
+        output_fpath = self._make_region_report(keep_depth_output=True)
+        self.assertEqual(self._read(output_fpath), self._read(join(DATA_DIR, 'regions.tsv')))
+        self.assertEqual(self._read(join(self.work_dir, 'target_syn3-normal_sambamba_depth.txt')),
+                         self._read(self.depth_fpath))
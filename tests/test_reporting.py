@@ -0,0 +1,106 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from os.path import join
+
+from targqc.utilz.reporting import reporting
+from targqc.utilz.reporting.reporting import Metric, MetricStorage, ReportSection, load_report_json
+
+
+class FindMetricTests(unittest.TestCase):
+    def setUp(self):
+        self.depth = Metric('Depth')
+        self.general_depth = Metric('Depth')
+        self.ms = MetricStorage(
+            general_section=ReportSection('general_section', '', [Metric('Reads'), self.general_depth]),
+            sections=[ReportSection('basic', 'Basic', [Metric('Sample'), self.depth]),
+                      ReportSection('depth', 'Depth', [Metric('Median depth')])])
+
+    def test_find(self):
+        self.assertIs(self.ms.find_metric('Median depth'), self.ms.sections_by_name['depth'].metrics[0])
+        self.assertIs(self.ms.find_metric('Reads'), self.ms.general_section.metrics[0])
+        self.assertIsNone(self.ms.find_metric('Coverage'))
+
+    def test_sections_before_general(self):
+        self.assertIs(self.ms.find_metric('Depth'), self.depth)
+
+    def test_added_and_removed(self):
+        added = Metric('Coverage')
+        self.ms.add_metric(added, section_name='depth')
+        self.assertIs(self.ms.find_metric('Coverage'), added)
+        self.ms.sections_by_name['depth'].remove_metric('Coverage')
+        self.assertIsNone(self.ms.find_metric('Coverage'))
+        self.ms.sections_by_name['basic'].remove_metric('Depth')
+        self.assertIs(self.ms.find_metric('Depth'), self.general_depth)
+
+
+class LoadReportJsonTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dirpath = join(self.tmp_dir, 'report_cache')
+        os.mkdir(self.cache_dirpath)
+        self.json_fpath = join(self.tmp_dir, 'sample.json')
+        self.json_load_fn = reporting.load
+        self.num_parsed = 0
+
+        def _counting_load(*args, **kwargs):
+            self.num_parsed += 1
+            return self.json_load_fn(*args, **kwargs)
+        reporting.load = _counting_load
+
+    def tearDown(self):
+        reporting.load = self.json_load_fn
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, data, mtime=None):
+        with open(self.json_fpath, 'w') as f:
+            json.dump(data, f)
+        if mtime is not None:
+            os.utime(self.json_fpath, (mtime, mtime))
+
+    def _load(self):
+        return load_report_json(self.json_fpath, self.cache_dirpath)
+
+    def test_cached(self):
+        data = OrderedDict([('b', 1), ('a', [OrderedDict([('name', 'Depth'), ('value', 10.5)])])])
+        self._write(data)
+        self.assertEqual(self._load(), data)
+        self.assertEqual(self._load(), data)
+        self.assertEqual(list(self._load()), ['b', 'a'])
+        self.assertEqual(self.num_parsed, 1)
+        self.assertEqual([f for f in os.listdir(self.tmp_dir) if f != 'report_cache'], ['sample.json'])
+
+    def test_changed_mtime(self):
+        self._write(dict(value=1), mtime=1000000000)
+        self._load()
+        self._write(dict(value=2), mtime=1000000000)  # same size and mtime: not noticed
+        self.assertEqual(self._load(), dict(value=1))
+        self._write(dict(value=3), mtime=1000000001)
+        self.assertEqual(self._load(), dict(value=3))
+        self.assertEqual(self.num_parsed, 2)
+
+    def test_changed_size(self):
+        self._write(dict(value=1), mtime=1000000000)
+        self._load()
+        self._write(dict(value=10), mtime=1000000000)
+        self.assertEqual(self._load(), dict(value=10))
+        self.assertEqual(self.num_parsed, 2)
+
+    def test_broken_cache(self):
+        self._write(dict(value=1))
+        self._load()
+        for fname in os.listdir(self.cache_dirpath):
+            with open(join(self.cache_dirpath, fname), 'wb') as f:
+                f.write(b'not a cache')
+        self.assertEqual(self._load(), dict(value=1))
+        self.assertEqual(self.num_parsed, 2)
+        self.assertEqual(self._load(), dict(value=1))
+        self.assertEqual(self.num_parsed, 2)
+
+    def test_no_cache(self):
+        self._write(dict(value=1))
+        self.assertEqual(load_report_json(self.json_fpath), dict(value=1))
+        self.assertEqual(os.listdir(self.cache_dirpath), [])
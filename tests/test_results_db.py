@@ -0,0 +1,71 @@
+import json
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+from targqc.utilz import results_db
+
+REGIONS_HEADER = ['chrom', 'start', 'end', 'size', 'gene', 'exon', 'strand', 'feature', 'biotype', 'transcript',
+                  'trx_overlap', 'exome_overlap', 'cds_overlap', 'avg_depth', 'at1x', 'at5x']
+
+
+class ResultsDbTests(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.db_fpath = join(self.work_dir, 'results.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _add_sample(self, run_id, name, mapped_reads, depth_factor):
+        json_fpath = join(self.work_dir, name + '.json')
+        with open(json_fpath, 'w') as f:
+            json.dump(dict(records=[
+                {'metric': {'name': 'Mapped reads', 'unit': ''}, '_Record__value': mapped_reads},
+                {'metric': {'name': 'Sex'}, '_Record__value': 'M'},
+                {'metric': {'name': 'Median insert size'}, '_Record__value': None},
+            ]), f)
+        tsv_fpath = join(self.work_dir, name + '.regions.tsv')
+        with open(tsv_fpath, 'w') as f:
+            f.write('\t'.join(REGIONS_HEADER) + '\n')
+            for fs in [
+                ['chr1', 100, 200, 100, 'GENE1', '1', '+', 'capture', 'protein_coding', 'ENST1', '100%', '100%', '100%', 10.0, 100, 50],
+                ['chr1', 300, 400, 100, 'GENE1', '2', '+', 'capture', 'protein_coding', 'ENST1', '100%', '100%', '100%', 30.0, 100, 100],
+                ['chr1', 500, 550, 50, 'GENE1', '.', '+', 'Intron', 'protein_coding', 'ENST1', '.', '.', '.', 99.0, 100, 100],
+                ['chr2', 100, 300, 200, 'GENE2', '1', '-', 'capture', 'lincRNA', 'ENST2', '100%', '100%', '.', 20.0, 90, 80],
+            ]:
+                if fs[4] == 'GENE1':
+                    fs[13] *= depth_factor
+                f.write('\t'.join(str(v) for v in fs) + '\n')
+        return results_db.add_sample(self.db_fpath, run_id, name, name + '.bam', json_fpath, tsv_fpath)
+
+    def _query(self, what, args=None, sample=None, run=None):
+        columns, rows = results_db.query(self.db_fpath, what, args, sample=sample, run=run)
+        return [dict(zip(columns, row)) for row in rows]
+
+    def test_queries(self):
+        run_id = results_db.add_run(self.db_fpath, self.work_dir, 'panel.bed', 'hg19', [1, 5])
+        self._add_sample(run_id, 's1', 1000, 1)
+        self._add_sample(run_id, 's2', 2000, 2)
+
+        self.assertEqual([(r['sample'], r['value']) for r in self._query('metric', ['Mapped reads'])],
+                         [('s1', 1000), ('s2', 2000)])
+        self.assertEqual([r['value'] for r in self._query('metric', ['Sex'], sample='s2')], ['M'])
+        self.assertEqual([r['value'] for r in self._query('metric', ['Median insert size'])], [None, None])
+
+        # gene coverage is weighted by region size, over capture regions only
+        genes = self._query('gene', ['GENE1'])
+        self.assertEqual([(g['sample'], g['chrom'], g['start'], g['end'], g['size']) for g in genes],
+                         [('s1', 'chr1', 100, 400, 200), ('s2', 'chr1', 100, 400, 200)])
+        self.assertEqual([g['avg_depth'] for g in genes], [20.0, 40.0])
+        self.assertEqual(genes[0]['rates'], '100.00,75.00')
+        self.assertEqual(genes[0]['depth_thresholds'], '[1, 5]')
+        self.assertEqual(self._query('gene', ['GENE3']), [])
+
+        regions = self._query('region', ['chr1:150-320'], sample='s1')
+        self.assertEqual([(r['start'], r['end'], r['gene'], r['feature'], r['avg_depth'], r['rates']) for r in regions],
+                         [(100, 200, 'GENE1', 'capture', 10.0, '100,50'), (300, 400, 'GENE1', 'capture', 30.0, '100,100')])
+        self.assertEqual(self._query('region', ['chr1:200-300']), [])
+        self.assertEqual(len(self._query('region', ['chr2:1-1,000'], run=run_id)), 2)
+        self.assertEqual(self._query('region', ['chr2:1-1000'], run=run_id + 1), [])
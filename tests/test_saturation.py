@@ -0,0 +1,68 @@
+import unittest
+
+from targqc.saturation import fit_michaelis_menten, project_depth, calc_library_saturation, \
+    _first_fraction_index, _parse_cigar, _overlap_bp
+
+
+class SaturationTests(unittest.TestCase):
+    fractions = [0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 1.0]
+
+    def _curve(self, umax, k, depth_per_unique=0.001):
+        uniques = [umax * f / (k + f) for f in self.fractions]
+        return dict(fractions=list(self.fractions), reads=[0] * len(self.fractions), unique_reads=uniques,
+                    depths=[u * depth_per_unique for u in uniques], umax=umax, k=k, target_size=1000)
+
+    def test_fit_michaelis_menten_exact(self):
+        ys = [1e6 * f / (0.4 + f) for f in self.fractions]
+        umax, k = fit_michaelis_menten(self.fractions, ys)
+        self.assertAlmostEqual(umax, 1e6, delta=1)
+        self.assertAlmostEqual(k, 0.4, places=6)
+
+    def test_fit_michaelis_menten_not_enough_points(self):
+        self.assertEqual(fit_michaelis_menten([0.5], [100]), (None, None))
+        self.assertEqual(fit_michaelis_menten([0, 0.5], [0, 100]), (None, None))
+        self.assertEqual(fit_michaelis_menten([0.5, 0.5], [100, 100]), (None, None))
+
+    def test_fit_michaelis_menten_no_saturation(self):
+        # unique reads growing linearly: no curvature to fit
+        self.assertEqual(fit_michaelis_menten(self.fractions, [1000 * f for f in self.fractions]), (None, None))
+
+    def test_first_fraction_index(self):
+        self.assertEqual(_first_fraction_index(self.fractions, 0.0), 0)
+        self.assertEqual(_first_fraction_index(self.fractions, 0.005), 0)
+        self.assertEqual(_first_fraction_index(self.fractions, 0.01), 1)  # subsets take h < f
+        self.assertEqual(_first_fraction_index(self.fractions, 0.15), 4)
+        self.assertEqual(_first_fraction_index(self.fractions, 0.99), 8)
+
+    def test_parse_cigar(self):
+        self.assertEqual(_parse_cigar('100M'), [('M', 100)])
+        self.assertEqual(_parse_cigar('5S40M2I10M3D45M12S'),
+                         [('S', 5), ('M', 40), ('I', 2), ('M', 10), ('D', 3), ('M', 45), ('S', 12)])
+
+    def test_overlap_bp(self):
+        starts, ends = [100, 300, 500], [200, 400, 600]
+        self.assertEqual(_overlap_bp(starts, ends, 0, 100), 0)
+        self.assertEqual(_overlap_bp(starts, ends, 150, 250), 50)
+        self.assertEqual(_overlap_bp(starts, ends, 120, 180), 60)
+        self.assertEqual(_overlap_bp(starts, ends, 150, 550), 50 + 100 + 50)
+        self.assertEqual(_overlap_bp(starts, ends, 600, 700), 0)
+
+    def test_project_depth(self):
+        curve = self._curve(1e6, 0.5)
+        self.assertAlmostEqual(project_depth(curve, 1.0), curve['depths'][-1])
+        # 4 times more reads of a library saturating at 1e6 unique reads
+        expected = curve['depths'][-1] * (4.0 / (0.5 + 4.0)) / (1.0 / (0.5 + 1.0))
+        self.assertAlmostEqual(project_depth(curve, 4.0), expected)
+        self.assertAlmostEqual(project_depth(curve, 4.0, observed_depth=10.0), 10.0 * expected / curve['depths'][-1])
+        # never more than the depth at the full library complexity
+        self.assertLess(project_depth(curve, 1000.0), curve['depths'][-1] * 1.5)
+
+    def test_project_depth_no_curve(self):
+        self.assertIsNone(project_depth(None, 2.0))
+        curve = self._curve(1e6, 0.5)
+        curve['umax'] = curve['k'] = None  # not fitted
+        self.assertIsNone(project_depth(curve, 2.0))
+
+    def test_library_saturation(self):
+        self.assertAlmostEqual(calc_library_saturation(self._curve(1e6, 0.5)), 1.0 / 1.5)
+        self.assertIsNone(calc_library_saturation(None))
@@ -0,0 +1,110 @@
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from http.client import HTTPConnection
+from os.path import join
+
+from targqc import server
+from targqc.utilz.file_utils import safe_mkdir
+
+
+class _App(server.TargQCServer):
+    """ Server with the target preparation and the job processes replaced, to test the API
+    """
+    def __init__(self, work_dir):
+        server.TargQCServer.__init__(self, work_dir, parallel_cfg=None, genome='hg19')
+        self.job_may_finish = threading.Event()
+        self.job_may_finish.set()
+
+    def get_target(self, bed_fpath, genome, padding, reannotate):
+        return None
+
+    def _start_job_process(self, params, target, genome, padding):
+        self.job_may_finish.wait(10)
+        return 0
+
+
+class _UnixHTTPConnection(HTTPConnection):
+    def __init__(self, socket_fpath):
+        HTTPConnection.__init__(self, 'localhost')
+        self.socket_fpath = socket_fpath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_fpath)
+
+
+class ServerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.app = _App(safe_mkdir(join(self.tmp_dir, 'work')))
+        self.socket_fpath = join(self.tmp_dir, 'targqc.sock')
+        self.httpd = server._UnixHTTPServer(self.socket_fpath, server._Handler)
+        self.httpd.app = self.app
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.app.job_may_finish.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _request(self, method, path, data=None, headers=None):
+        headers = dict({'Host': 'localhost', 'Content-Type': 'application/json'}, **(headers or {}))
+        conn = _UnixHTTPConnection(self.socket_fpath)
+        try:
+            conn.request(method, path, body=json.dumps(data).encode() if data is not None else None, headers=headers)
+            resp = conn.getresponse()
+            return resp.status, json.loads(resp.read().decode())
+        finally:
+            conn.close()
+
+    def _job_params(self, **kwargs):
+        return dict(dict(bams=['s1.bam'], output_dir=join(self.tmp_dir, 'out')), **kwargs)
+
+    def test_submit_and_wait(self):
+        code, job = self._request('POST', '/jobs', self._job_params(wait=True))
+        self.assertEqual(code, 200)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['exit_code'], 0)
+        self.assertEqual(self._request('GET', '/jobs/' + job['id']), (200, job))
+        self.assertEqual(self._request('GET', '/jobs'), (200, [job]))
+
+    def test_status(self):
+        self.app.job_may_finish.clear()
+        code, job = self._request('POST', '/jobs', self._job_params())
+        self.assertEqual(code, 202)
+        self.assertIn(job['status'], ['queued', 'running'])
+        self.assertIn(self._request('GET', '/jobs/' + job['id'])[1]['status'], ['queued', 'running'])
+        self.app.job_may_finish.set()
+        for _ in range(100):
+            job = self._request('GET', '/jobs/' + job['id'])[1]
+            if job['status'] == 'done':
+                break
+            time.sleep(0.05)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(self._request('GET', '/jobs/2')[0], 404)
+        self.assertEqual(self._request('GET', '/health')[1]['jobs'], 1)
+
+    def test_invalid_job(self):
+        self.assertEqual(self._request('POST', '/jobs', dict(output_dir='out'))[0], 400)
+        self.assertEqual(self._request('POST', '/jobs', self._job_params(threads=4))[0], 400)
+        self.assertEqual(self.app.get_jobs(), [])
+
+    def test_host_rejected(self):
+        for host in ['example.com', 'localhost.example.com', '127.0.0.1:8080.example.com']:
+            self.assertEqual(self._request('GET', '/jobs', headers={'Host': host})[0], 403)
+            self.assertEqual(self._request('POST', '/jobs', self._job_params(), headers={'Host': host})[0], 403)
+        self.assertEqual(self.app.get_jobs(), [])
+
+    def test_content_type_rejected(self):
+        for content_type in ['text/plain', 'application/x-www-form-urlencoded', 'multipart/form-data']:
+            code, _ = self._request('POST', '/jobs', self._job_params(), headers={'Content-Type': content_type})
+            self.assertEqual(code, 415)
+        self.assertEqual(self.app.get_jobs(), [])
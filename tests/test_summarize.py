@@ -0,0 +1,106 @@
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+from targqc import summarize
+from targqc.summarize import combined_regional_reports, load_summary_state
+from targqc.utilz.file_utils import safe_mkdir
+
+
+class _Sample:
+    def __init__(self, name, dirpath):
+        self.name = name
+        self.targqc_region_tsv = join(safe_mkdir(join(dirpath, name)), 'regions.tsv')
+
+
+class CombinedRegionalReportsTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.work_dir = safe_mkdir(join(self.tmp_dir, 'work'))
+        self.output_dir = safe_mkdir(join(self.tmp_dir, 'output'))
+        self.samples = dict()
+        self.write_sample_rows_fn = summarize._write_sample_rows
+
+    def tearDown(self):
+        summarize._write_sample_rows = self.write_sample_rows_fn
+        shutil.rmtree(self.tmp_dir)
+
+    def _sample(self, name, num_rows=3, depth=10):
+        s = _Sample(name, join(self.tmp_dir, 'samples'))
+        with open(s.targqc_region_tsv, 'w') as f:
+            f.write('chrom\tstart\tend\tavg_depth\n')
+            for i in range(num_rows):
+                f.write('chr1\t' + str(i * 100) + '\t' + str(i * 100 + 50) + '\t' + str(depth + i) + '\n')
+        self.samples[name] = s
+        return s
+
+    def _cohort(self, *names):
+        return [self.samples[n] for n in names]
+
+    def _read(self, fpath):
+        with open(fpath) as f:
+            return f.read()
+
+    def _rebuilt(self, samples):
+        output_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        return self._read(combined_regional_reports(self.work_dir, output_dir, samples))
+
+    def _start(self, *names):
+        state = load_summary_state(self.output_dir)
+        for n in names:
+            self._sample(n)
+        fpath = combined_regional_reports(self.work_dir, self.output_dir, self._cohort(*names), state)
+        return fpath, state
+
+    def test_append(self):
+        fpath, state = self._start('s1', 's3')
+        # after all the samples: appended in place
+        self._sample('s4')
+        self.assertEqual(combined_regional_reports(self.work_dir, self.output_dir, self._cohort('s1', 's3', 's4'),
+                                                   state, append=True), fpath)
+        self.assertEqual(self._read(fpath), self._rebuilt(self._cohort('s1', 's3', 's4')))
+        self.assertEqual(list(state['samples']), ['s1', 's3', 's4'])
+        # between the samples: rows are still in the order of the cohort
+        self._sample('s2')
+        cohort = self._cohort('s1', 's2', 's3', 's4')
+        combined_regional_reports(self.work_dir, self.output_dir, cohort, state, append=True)
+        self.assertEqual(self._read(fpath), self._rebuilt(cohort))
+        self.assertEqual(list(state['samples']), ['s1', 's2', 's3', 's4'])
+
+    def test_replace(self):
+        fpath, state = self._start('s1', 's2', 's3')
+        self._sample('s2', num_rows=5, depth=20)
+        cohort = self._cohort('s1', 's2', 's3')
+        combined_regional_reports(self.work_dir, self.output_dir, cohort, state, append=True)
+        self.assertEqual(self._read(fpath), self._rebuilt(cohort))
+        self.assertEqual(state['samples']['s2'], summarize._region_report_stamp(self.samples['s2']))
+
+    def test_rollback(self):
+        fpath, state = self._start('s1', 's3')
+        content_before, state_before = self._read(fpath), dict(state['samples'])
+
+        def _failing_write(tsv_out, sample):
+            tsv_out.write(sample.name + '\tpartial\n')
+            raise IOError('disk full')
+        summarize._write_sample_rows = _failing_write
+
+        for new_name, cohort in [('s4', ['s1', 's3', 's4']),         # append in place
+                                 ('s2', ['s1', 's2', 's3'])]:        # rewrite
+            self._sample(new_name)
+            with self.assertRaises(IOError):
+                combined_regional_reports(self.work_dir, self.output_dir, self._cohort(*cohort), state, append=True)
+            self.assertEqual(self._read(fpath), content_before)
+            self.assertEqual(dict(state['samples']), state_before)
+
+    def test_rows_out_of_order(self):
+        # a combined report in another order is rebuilt
+        fpath, state = self._start('s1', 's2')
+        with open(fpath) as f:
+            lines = f.readlines()
+        with open(fpath, 'w') as f:
+            f.writelines(lines[:1] + [l for l in lines[1:] if l.startswith('s2')] + [l for l in lines[1:] if l.startswith('s1')])
+        self._sample('s0')
+        cohort = self._cohort('s0', 's1', 's2')
+        combined_regional_reports(self.work_dir, self.output_dir, cohort, state, append=True)
+        self.assertEqual(self._read(fpath), self._rebuilt(cohort))